@@ -11,6 +11,11 @@
 # -d Path to database folder on run environment file system
 # -c Max CPU count
 # -m Max memory amount (GB)
+# -r S3 path to the data prep cache folder (optional)
+# -z Store A3M outputs gzipped, as <name>.a3m.gz
+#
+# In AWS Batch array jobs, the input and output folders are suffixed with
+# ARRAY_INDEX_OFFSET + AWS_BATCH_JOB_ARRAY_INDEX.
 #
 # Example CMD
 # ./AWS-RoseTTAFold/run_aws_e2e_ver.sh \
@@ -35,12 +40,12 @@ unset __conda_setup
 ############################################################
 
 unset -v SCRIPT PIPEDIR UUID INPUT_S3_FOLDER OUTPUT_S3_FOLDER \
-    INPUT_FILE WDIR DBDIR CPU MEM
+    INPUT_FILE WDIR DBDIR CPU MEM CACHE_S3_FOLDER COMPRESS_A3M
 
 SCRIPT=`realpath -s $0`
 SCRIPTDIR=`dirname $SCRIPT`
 
-while getopts "i:o:n:p:w:d:c:m:" option
+while getopts "i:o:n:p:w:d:c:m:r:z" option
 do
     case $option in
     i) INPUT_S3_FOLDER=$OPTARG ;; # s3 URI to input folder
@@ -51,6 +56,8 @@ do
     d) DBDIR=$OPTARG ;; # path to local sequence databases
     c) CPU=$OPTARG ;; # vCPU
     m) MEM=$OPTARG ;; # MEM (GB)
+    r) CACHE_S3_FOLDER=$OPTARG ;; # s3 URI to data prep cache folder
+    z) COMPRESS_A3M=1 ;; # gzip A3M outputs
     *) exit 1 ;;
     esac
 done
@@ -63,6 +70,15 @@ done
 [ -z "$CPU" ] && { CPU="16"; }
 [ -z "$MEM" ] && { MEM="64"; }
 
+## Array jobs submitted by rfutils.submit_fasta_array_job keep every record in
+## a numbered sub-folder of the input and output folders
+if [ -n "$AWS_BATCH_JOB_ARRAY_INDEX" ] || [ -n "$ARRAY_INDEX_OFFSET" ]
+then
+    RECORD_INDEX=$(( ${ARRAY_INDEX_OFFSET:-0} + ${AWS_BATCH_JOB_ARRAY_INDEX:-0} ))
+    INPUT_S3_FOLDER=$INPUT_S3_FOLDER/$RECORD_INDEX
+    OUTPUT_S3_FOLDER=$OUTPUT_S3_FOLDER/$RECORD_INDEX
+fi
+
 if [ -z "$UUID" ]
 then
     if [ -z "$AWS_BATCH_JOB_ID" ]
@@ -73,13 +89,80 @@ then
     fi
 fi
 
+# Profile a command as one stage, see rfutils.profiling
+PROFILE=$WDIR/profile.jsonl
+: > $PROFILE
+profile () {
+    PYTHONPATH=$SCRIPTDIR python -m rfutils.profiling run --stage $1 \
+        --output $PROFILE --job-id $UUID -- "${@:2}"
+}
+
+# S3 uploads run in the background, overlapped with the next stage, and
+# wait_transfers checks that all of them succeeded. With -z, A3M files are
+# stored gzipped as <name>.a3m.gz.
+TRANSFER_PIDS=""
+upload () {
+    local STAGE=$1 FILE=$2 DEST=$3
+    {
+        if [ -n "$COMPRESS_A3M" ] && [[ $FILE == *.a3m ]]
+        then
+            gzip -c $FILE > $FILE.gz && FILE=$FILE.gz && DEST=$DEST.gz
+        fi &&
+        profile $STAGE aws s3 cp --only-show-errors $FILE $DEST
+    } &
+    TRANSFER_PIDS="$TRANSFER_PIDS $!"
+}
+
+wait_transfers () {
+    local PID FAILED=0
+    for PID in $TRANSFER_PIDS
+    do
+        wait $PID || FAILED=$[ $FAILED + 1 ]
+    done
+    TRANSFER_PIDS=""
+    if [ $FAILED -gt 0 ]
+    then
+        echo "${FAILED} S3 transfers failed"
+        exit 1
+    fi
+}
+
 IN=$WDIR/input.fa
-aws s3 cp $INPUT_S3_FOLDER/$INPUT_FILE $IN
+profile s3_download_input aws s3 cp $INPUT_S3_FOLDER/$INPUT_FILE $IN
 
 ls $WDIR
 #LENGTH=`tail -n1 $IN | wc -m`
 LENGTH=`grep -v -e "^>" $IN | tr -d "\n" | wc -m`
 
+############################################################
+# Data prep cache
+############################################################
+# Results are cached under a key derived from the normalized sequence and the
+# database versions. This must match rfutils.cache.get_data_prep_cache_key.
+DB_VERSIONS="UniRef30_2020_06 bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt pdb100_2021Mar03"
+SEQUENCE=`grep -v -e "^>" $IN | tr -d "[:space:]" | tr "[:lower:]" "[:upper:]"`
+CACHE_KEY=`printf "%s\n%s" "$SEQUENCE" "$DB_VERSIONS" | sha256sum | cut -d " " -f 1`
+CACHE_HITS=0
+CACHE_MISSES=0
+CACHE_MISSED_FILES=""
+CACHE_HIT_FILES=""
+
+# Try to fetch a result file (e.g. msa0.a3m) from the cache into $WDIR/t000_.*
+cache_get () {
+    [ -z "$CACHE_S3_FOLDER" ] && return 0
+    [ -s $WDIR/t000_.$1 ] && return 0
+    if profile s3_download_cache_$1 aws s3 cp --only-show-errors \
+        $CACHE_S3_FOLDER/$CACHE_KEY/$1 $WDIR/t000_.$1 > /dev/null 2>&1
+    then
+        echo "Data prep cache hit for $1"
+        CACHE_HITS=$[ $CACHE_HITS + 1 ]
+        CACHE_HIT_FILES="$CACHE_HIT_FILES $1"
+    else
+        CACHE_MISSES=$[ $CACHE_MISSES + 1 ]
+        CACHE_MISSED_FILES="$CACHE_MISSED_FILES $1"
+    fi
+}
+
 conda activate RoseTTAFold
 
 ############################################################
@@ -87,16 +170,20 @@ conda activate RoseTTAFold
 ############################################################
 MSA_START="$(date +%s)"
 
+cache_get msa0.a3m
 if [ ! -s $WDIR/t000_.msa0.a3m ]
 then
     export PIPEDIR=$DBDIR
     echo "Running HHblits"
-    $SCRIPTDIR/input_prep/make_msa.sh $IN $WDIR $CPU $MEM $DBDIR
+    profile hhblits $SCRIPTDIR/input_prep/make_msa.sh $IN $WDIR $CPU $MEM $DBDIR
 fi
 
-MSA_COUNT=`grep "^>" $WDIR/t000_.msa0.a3m -c`
+upload s3_upload_msa $WDIR/t000_.msa0.a3m $OUTPUT_S3_FOLDER/$UUID.msa0.a3m
 
-aws s3 cp $WDIR/t000_.msa0.a3m $OUTPUT_S3_FOLDER/$UUID.msa0.a3m
+MSA_COUNT=`grep "^>" $WDIR/t000_.msa0.a3m -c`
+# Neff, per-position Neff and coverage at 80% identity, see rfutils.msa
+profile msa_stats env PYTHONPATH=$SCRIPTDIR python -m rfutils.msa stats $WDIR/t000_.msa0.a3m \
+    --threshold 0.8 --workers $CPU --indent 2 > $WDIR/msa_stats.yaml
 
 MSA_DURATION=$[ $(date +%s) - ${MSA_START} ]
 echo "${UUID} MSA duration: ${MSA_DURATION} sec"
@@ -105,14 +192,28 @@ echo "${UUID} MSA duration: ${MSA_DURATION} sec"
 # 2. predict secondary structure for HHsearch run
 ############################################################
 SS_START="$(date +%s)"
+
+# While PSIPRED runs, read the template database indexes and the cs219
+# prefilter database, which hhsearch scans in full, into the page cache (see
+# rfutils.ffindex). This is best effort and does not fail the job.
+DB="$DBDIR/pdb100_2021Mar03/pdb100_2021Mar03"
+{
+    profile warm_cs219 env PYTHONPATH=$SCRIPTDIR python -m rfutils.ffindex \
+        warm ${DB}_cs219 --all &&
+    profile warm_a3m_index env PYTHONPATH=$SCRIPTDIR python -m rfutils.ffindex \
+        warm ${DB}_a3m
+} > /dev/null 2>&1 &
+WARM_PID=$!
+
+cache_get ss2
 if [ ! -s $WDIR/t000_.ss2 ]
 then
     export PIPEDIR=$SCRIPTDIR
     echo "Running PSIPRED"
-    $SCRIPTDIR/input_prep/make_ss.sh $WDIR/t000_.msa0.a3m $WDIR/t000_.ss2
+    profile psipred $SCRIPTDIR/input_prep/make_ss.sh $WDIR/t000_.msa0.a3m $WDIR/t000_.ss2
 fi
 
-aws s3 cp $WDIR/t000_.ss2 $OUTPUT_S3_FOLDER/$UUID.ss2
+upload s3_upload_ss2 $WDIR/t000_.ss2 $OUTPUT_S3_FOLDER/$UUID.ss2
 
 SS_DURATION=$[ $(date +%s) - ${SS_START} ]
 echo "${UUID} SS duration: ${SS_DURATION} sec"
@@ -120,25 +221,48 @@ echo "${UUID} SS duration: ${SS_DURATION} sec"
 ############################################################
 # 3. search for templates
 ############################################################
+wait $WARM_PID || echo "Could not warm ${DB}"
 TEMPLATE_START="$(date +%s)"
-DB="$DBDIR/pdb100_2021Mar03/pdb100_2021Mar03"
-if [ ! -s $WDIR/t000_.hhr ]
+cat $WDIR/t000_.ss2 $WDIR/t000_.msa0.a3m > $WDIR/t000_.msa0.ss2.a3m
+cache_get hhr
+cache_get atab
+if [ ! -s $WDIR/t000_.hhr ] || [ ! -s $WDIR/t000_.atab ]
 then
+    # hhr and atab must come from the same hhsearch run, so a cached file of
+    # the pair is replaced and cached again along with the missing one
+    for CACHE_FILE in hhr atab
+    do
+        if [[ " $CACHE_HIT_FILES " == *" $CACHE_FILE "* ]]
+        then
+            CACHE_HITS=$[ $CACHE_HITS - 1 ]
+            CACHE_MISSES=$[ $CACHE_MISSES + 1 ]
+            CACHE_MISSED_FILES="$CACHE_MISSED_FILES $CACHE_FILE"
+        fi
+    done
     echo "Running hhsearch"
     HH="hhsearch -b 50 -B 500 -z 50 -Z 500 -mact 0.05 -cpu $CPU -maxmem $MEM -aliw 100000 -e 100 -p 5.0 -d $DB"
-    cat $WDIR/t000_.ss2 $WDIR/t000_.msa0.a3m > $WDIR/t000_.msa0.ss2.a3m
-    $HH -i $WDIR/t000_.msa0.ss2.a3m -o $WDIR/t000_.hhr -atab $WDIR/t000_.atab -v 2
+    profile hhsearch $HH -i $WDIR/t000_.msa0.ss2.a3m -o $WDIR/t000_.hhr -atab $WDIR/t000_.atab -v 2
 fi
 
 TEMPLATE_COUNT=`grep "^No [[:digit:]]*$" $WDIR/t000_.hhr -c`
 
-aws s3 cp $WDIR/t000_.msa0.ss2.a3m $OUTPUT_S3_FOLDER/$UUID.msa0.ss2.a3m
-aws s3 cp $WDIR/t000_.hhr $OUTPUT_S3_FOLDER/$UUID.hhr
-aws s3 cp $WDIR/t000_.atab $OUTPUT_S3_FOLDER/$UUID.atab
+upload s3_upload_msa_ss2 $WDIR/t000_.msa0.ss2.a3m $OUTPUT_S3_FOLDER/$UUID.msa0.ss2.a3m
+upload s3_upload_hhr $WDIR/t000_.hhr $OUTPUT_S3_FOLDER/$UUID.hhr
+upload s3_upload_atab $WDIR/t000_.atab $OUTPUT_S3_FOLDER/$UUID.atab
 
 TEMPLATE_DURATION=$[ $(date +%s) - ${TEMPLATE_START} ]
 echo "${UUID} template search duration: ${TEMPLATE_DURATION} sec"
 
+# Add newly computed results to the cache
+for CACHE_FILE in $CACHE_MISSED_FILES
+do
+    profile s3_upload_cache_$CACHE_FILE aws s3 cp --only-show-errors \
+        $WDIR/t000_.$CACHE_FILE $CACHE_S3_FOLDER/$CACHE_KEY/$CACHE_FILE &
+    TRANSFER_PIDS="$TRANSFER_PIDS $!"
+done
+
+wait_transfers
+
 TOTAL_DATA_PREP_DURATION=$[ $(date +%s) - ${START} ]
 echo "${UUID} total data prep duration: ${TOTAL_DATA_PREP_DURATION} sec"
 
@@ -146,7 +270,7 @@ echo "${UUID} total data prep duration: ${TOTAL_DATA_PREP_DURATION} sec"
 echo "DATA_PREP:" >> $WDIR/metrics.yaml
 echo "  JOB_ID: ${UUID}" >> $WDIR/metrics.yaml
 echo "  INPUT_S3_FOLDER: ${INPUT_S3_FOLDER}" >> $WDIR/metrics.yaml
-echo "  INPUT_FILE: ${INPUT_S3_FILE}" >> $WDIR/metrics.yaml
+echo "  INPUT_FILE: ${INPUT_FILE}" >> $WDIR/metrics.yaml
 echo "  OUTPUT_S3_FOLDER: ${OUTPUT_S3_FOLDER}" >> $WDIR/metrics.yaml
 echo "  WDIR: ${WDIR}" >> $WDIR/metrics.yaml
 echo "  DBDIR: ${DBDIR}" >> $WDIR/metrics.yaml
@@ -154,13 +278,23 @@ echo "  CPU: ${CPU}" >> $WDIR/metrics.yaml
 echo "  MEM: ${MEM}" >> $WDIR/metrics.yaml
 echo "  LENGTH: ${LENGTH}" >> $WDIR/metrics.yaml
 echo "  MSA_COUNT: ${MSA_COUNT}" >> $WDIR/metrics.yaml
+cat $WDIR/msa_stats.yaml >> $WDIR/metrics.yaml
 echo "  TEMPLATE_COUNT: ${TEMPLATE_COUNT}" >> $WDIR/metrics.yaml
+echo "  CACHE_KEY: ${CACHE_KEY}" >> $WDIR/metrics.yaml
+echo "  CACHE_HITS: ${CACHE_HITS}" >> $WDIR/metrics.yaml
+echo "  CACHE_MISSES: ${CACHE_MISSES}" >> $WDIR/metrics.yaml
 echo "  START_TIME: ${START}" >> $WDIR/metrics.yaml
 echo "  MSA_DURATION: ${MSA_DURATION}" >> $WDIR/metrics.yaml
 echo "  SS_DURATION: ${SS_DURATION}" >> $WDIR/metrics.yaml
 echo "  TEMPLATE_DURATION: ${TEMPLATE_DURATION}" >> $WDIR/metrics.yaml
 echo "  TOTAL_DATA_PREP_DURATION: ${TOTAL_DATA_PREP_DURATION}" >> $WDIR/metrics.yaml
+PYTHONPATH=$SCRIPTDIR python -m rfutils.profiling summary $PROFILE --indent 2 >> $WDIR/metrics.yaml
 
 aws s3 cp $WDIR/metrics.yaml $OUTPUT_S3_FOLDER/metrics.yaml
+aws s3 cp $PROFILE $OUTPUT_S3_FOLDER/$UUID.data_prep.profile.jsonl
+if [ -n "$CACHE_S3_FOLDER" ] && [ $CACHE_MISSES -gt 0 ]
+then
+    aws s3 cp $WDIR/metrics.yaml $CACHE_S3_FOLDER/$CACHE_KEY/metrics.yaml
+fi
 
 echo "Done"
\ No newline at end of file
@@ -0,0 +1,58 @@
+#!/bin/bash
+
+############################################################
+# Run data prep and prediction for one sequence in a single container on AWS
+## Options
+# -i (Required) S3 path to input folder
+# -o (Required) S3 path to output folder
+# -n Input file name (e.g. input.fa)
+# -p Prefix to use for output files
+# -w Path to working folder on run environment file system
+# -d Path to database folder on run environment file system
+# -x Path to model weights folder on run environment
+# -c Max CPU count
+# -m Max memory amount (GB)
+# -r S3 path to the data prep cache folder (optional)
+# -s Max MSA depth, reduces the MSA with rfutils.msa before prediction (optional)
+# -z Store A3M outputs gzipped, as <name>.a3m.gz
+#
+# Runs run_aws_data_prep_ver.sh and then run_aws_predict_ver.sh with -l, so
+# the prediction uses the data prep results in the working folder instead of
+# downloading them again. Both steps still upload their outputs and metrics.
+#
+# Example CMD
+# ./AWS-RoseTTAFold/run_aws_e2e_ver.sh \
+#   -i s3://032243382548-rf-run-data/input \
+#   -o s3://032243382548-rf-run-data/output \
+#   -n input.fa \
+#   -w ~/work \
+#   -d /fsx/RoseTTAFold \
+#   -x /fsx/RoseTTAFold \
+#   -c 8 \
+#   -m 32 \
+
+# make the script stop when error (non-true exit code) is occured
+set -e
+
+SCRIPT=`realpath -s $0`
+SCRIPTDIR=`dirname $SCRIPT`
+
+DATA_PREP_ARGS=()
+PREDICT_ARGS=()
+while getopts "i:o:n:p:w:d:x:c:m:r:s:z" option
+do
+    case $option in
+    i|o|p|w|d|c|m)
+        DATA_PREP_ARGS+=(-$option $OPTARG)
+        PREDICT_ARGS+=(-$option $OPTARG) ;;
+    n|r) DATA_PREP_ARGS+=(-$option $OPTARG) ;;
+    x|s) PREDICT_ARGS+=(-$option $OPTARG) ;;
+    z)
+        DATA_PREP_ARGS+=(-z)
+        PREDICT_ARGS+=(-z) ;;
+    *) exit 1 ;;
+    esac
+done
+
+/bin/bash $SCRIPTDIR/run_aws_data_prep_ver.sh "${DATA_PREP_ARGS[@]}"
+/bin/bash $SCRIPTDIR/run_aws_predict_ver.sh "${PREDICT_ARGS[@]}" -l
@@ -11,6 +11,13 @@
 # -x Pathe to model weights folder on run environment
 # -c Max CPU count
 # -m Max memory amount (GB)
+# -s Max MSA depth, reduces the MSA with rfutils.msa before prediction (optional)
+# -z Read and store A3M files gzipped, as <name>.a3m.gz
+# -l Use the data prep results already in the working folder (fused mode, see
+#    run_aws_e2e_ver.sh) instead of downloading them
+#
+# In AWS Batch array jobs, the input and output folders are suffixed with
+# ARRAY_INDEX_OFFSET + AWS_BATCH_JOB_ARRAY_INDEX.
 #
 # Example CMD
 # ./AWS-RoseTTAFold/run_aws_e2e_ver.sh \
@@ -35,12 +42,13 @@ unset __conda_setup
 ############################################################
 
 unset -v SCRIPT PIPEDIR UUID INPUT_S3_FOLDER OUTPUT_S3_FOLDER \
-    INPUT_FILE WDIR DBDIR MODEL_WEIGHTS_DIR CPU MEM 
+    INPUT_FILE WDIR DBDIR MODEL_WEIGHTS_DIR CPU MEM MAX_MSA_DEPTH COMPRESS_A3M \
+    RUN_MODE
 
 SCRIPT=`realpath -s $0`
 SCRIPTDIR=`dirname $SCRIPT`
 
-while getopts "i:o:p:w:d:x:c:m:" option
+while getopts "i:o:p:w:d:x:c:m:s:zl" option
 do
     case $option in
     i) INPUT_S3_FOLDER=$OPTARG ;; # s3 URI to input folder
@@ -51,6 +59,9 @@ do
     x) MODEL_WEIGHTS_DIR=$OPTARG ;; # path to local weights 
     c) CPU=$OPTARG ;; # vCPU
     m) MEM=$OPTARG ;; # MEM (GB)
+    s) MAX_MSA_DEPTH=$OPTARG ;; # max number of MSA sequences
+    z) COMPRESS_A3M=1 ;; # gzip A3M files
+    l) RUN_MODE=fused ;; # data prep results are in WDIR
     *) exit 1 ;;
     esac
 done
@@ -63,6 +74,16 @@ done
 [ -z "$CPU" ] && { CPU="16"; }
 [ -z "$MEM" ] && { MEM="64"; }
 [ -z "$CUDA_VISIBLE_DEVICES" ] && { CUDA_VISIBLE_DEVICES="99"; }
+[ -z "$RUN_MODE" ] && { RUN_MODE="split"; }
+
+## Array jobs submitted by rfutils.submit_fasta_array_job keep every record in
+## a numbered sub-folder of the input and output folders
+if [ -n "$AWS_BATCH_JOB_ARRAY_INDEX" ] || [ -n "$ARRAY_INDEX_OFFSET" ]
+then
+    RECORD_INDEX=$(( ${ARRAY_INDEX_OFFSET:-0} + ${AWS_BATCH_JOB_ARRAY_INDEX:-0} ))
+    INPUT_S3_FOLDER=$INPUT_S3_FOLDER/$RECORD_INDEX
+    OUTPUT_S3_FOLDER=$OUTPUT_S3_FOLDER/$RECORD_INDEX
+fi
 
 if [ -z "$UUID" ]
 then
@@ -76,12 +97,83 @@ fi
 
 IN=$WDIR/input.fa
 
+# Profile a command as one stage, see rfutils.profiling
+PROFILE=$WDIR/profile.jsonl
+: > $PROFILE
+profile () {
+    PYTHONPATH=$SCRIPTDIR python -m rfutils.profiling run --stage $1 \
+        --output $PROFILE --job-id $UUID -- "${@:2}"
+}
+
+# S3 uploads run in the background, overlapped with the next stage, and
+# wait_transfers checks that all of them succeeded. With -z, A3M files are
+# stored gzipped as <name>.a3m.gz.
+TRANSFER_PIDS=""
+upload () {
+    local STAGE=$1 FILE=$2 DEST=$3
+    {
+        if [ -n "$COMPRESS_A3M" ] && [[ $FILE == *.a3m ]]
+        then
+            gzip -c $FILE > $FILE.gz && FILE=$FILE.gz && DEST=$DEST.gz
+        fi &&
+        profile $STAGE aws s3 cp --only-show-errors $FILE $DEST
+    } &
+    TRANSFER_PIDS="$TRANSFER_PIDS $!"
+}
+
+# Download in the background, preferring the gzipped copy of A3M files with -z
+download () {
+    local STAGE=$1 SOURCE=$2 FILE=$3
+    {
+        if [ -n "$COMPRESS_A3M" ] && [[ $FILE == *.a3m ]] &&
+            profile $STAGE aws s3 cp --only-show-errors $SOURCE.gz $FILE.gz 2> /dev/null
+        then
+            gunzip -f $FILE.gz
+        else
+            profile $STAGE aws s3 cp --only-show-errors $SOURCE $FILE
+        fi
+    } &
+    TRANSFER_PIDS="$TRANSFER_PIDS $!"
+}
+
+wait_transfers () {
+    local PID FAILED=0
+    for PID in $TRANSFER_PIDS
+    do
+        wait $PID || FAILED=$[ $FAILED + 1 ]
+    done
+    TRANSFER_PIDS=""
+    if [ $FAILED -gt 0 ]
+    then
+        echo "${FAILED} S3 transfers failed"
+        exit 1
+    fi
+}
+
 conda activate RoseTTAFold
 
-aws s3 cp $INPUT_S3_FOLDER/$UUID.msa0.a3m $WDIR/t000_.msa0.a3m 
-aws s3 cp $INPUT_S3_FOLDER/$UUID.hhr $WDIR/t000_.hhr 
-aws s3 cp $INPUT_S3_FOLDER/$UUID.atab $WDIR/t000_.atab 
-aws s3 cp $INPUT_S3_FOLDER/metrics.yaml $WDIR/metrics.yaml 
+if [ "$RUN_MODE" = "split" ]
+then
+    download s3_download_msa $INPUT_S3_FOLDER/$UUID.msa0.a3m $WDIR/t000_.msa0.a3m
+    download s3_download_hhr $INPUT_S3_FOLDER/$UUID.hhr $WDIR/t000_.hhr
+    download s3_download_atab $INPUT_S3_FOLDER/$UUID.atab $WDIR/t000_.atab
+    download s3_download_metrics $INPUT_S3_FOLDER/metrics.yaml $WDIR/metrics.yaml
+    wait_transfers
+fi
+
+############################################################
+# MSA depth reduction
+############################################################
+MSA=$WDIR/t000_.msa0.a3m
+touch $WDIR/msa_depth.yaml
+if [ -n "$MAX_MSA_DEPTH" ]
+then
+    echo "Reducing MSA to at most ${MAX_MSA_DEPTH} sequences"
+    MSA=$WDIR/t000_.msa0.reduced.a3m
+    profile msa_reduce env PYTHONPATH=$SCRIPTDIR python -m rfutils.msa reduce $WDIR/t000_.msa0.a3m $MSA \
+        --max-depth $MAX_MSA_DEPTH --indent 2 > $WDIR/msa_depth.yaml
+    upload s3_upload_reduced_msa $MSA $OUTPUT_S3_FOLDER/$UUID.msa0.reduced.a3m
+fi
 
 ############################################################
 # End-to-end prediction
@@ -92,18 +184,21 @@ then
     echo "Running end-to-end prediction"    
     DB="$DBDIR/pdb100_2021Mar03/pdb100_2021Mar03"
 
-    python $SCRIPTDIR/network/predict_e2e.py \
+    # Records the predict_e2e, model_load and inference stages
+    PYTHONPATH=$SCRIPTDIR python -m rfutils.profiling python \
+        --output $PROFILE --job-id $UUID -- $SCRIPTDIR/network/predict_e2e.py \
         -m $MODEL_WEIGHTS_DIR/weights \
-        -i $WDIR/t000_.msa0.a3m \
+        -i $MSA \
         -o $WDIR/t000_.e2e \
         --hhr $WDIR/t000_.hhr \
         --atab $WDIR/t000_.atab \
         --db $DB
 fi
 
-aws s3 cp $WDIR/t000_.e2e.pdb $OUTPUT_S3_FOLDER/$UUID.e2e.pdb
-aws s3 cp $WDIR/t000_.e2e_init.pdb $OUTPUT_S3_FOLDER/$UUID.e2e_init.pdb
-aws s3 cp $WDIR/t000_.e2e.npz $OUTPUT_S3_FOLDER/$UUID.e2e.npz
+upload s3_upload_pdb $WDIR/t000_.e2e.pdb $OUTPUT_S3_FOLDER/$UUID.e2e.pdb
+upload s3_upload_init_pdb $WDIR/t000_.e2e_init.pdb $OUTPUT_S3_FOLDER/$UUID.e2e_init.pdb
+upload s3_upload_npz $WDIR/t000_.e2e.npz $OUTPUT_S3_FOLDER/$UUID.e2e.npz
+wait_transfers
 
 TOTAL_PREDICT_DURATION=$[ $(date +%s) - ${PREDICT_START} ]
 echo "${UUID} prediction duration: ${TOTAL_PREDICT_DURATION} sec"
@@ -113,15 +208,20 @@ echo "PREDICT:" >> $WDIR/metrics.yaml
 echo "  JOB_ID: ${UUID}" >> $WDIR/metrics.yaml
 echo "  INPUT_S3_FOLDER: ${INPUT_S3_FOLDER}" >> $WDIR/metrics.yaml
 echo "  OUTPUT_S3_FOLDER: ${OUTPUT_S3_FOLDER}" >> $WDIR/metrics.yaml
-echo "  WDIR: ${WDIR}" >> $WDIR/metrics_data_prep.yaml
+echo "  WDIR: ${WDIR}" >> $WDIR/metrics.yaml
 echo "  DBDIR: ${DBDIR}" >> $WDIR/metrics.yaml
 echo "  MODEL_WEIGHTS_DIR: ${MODEL_WEIGHTS_DIR}" >> $WDIR/metrics.yaml
 echo "  CPU: ${CPU}" >> $WDIR/metrics.yaml
 echo "  MEM: ${MEM}" >> $WDIR/metrics.yaml
 echo "  GPU: ${CUDA_VISIBLE_DEVICES}" >> $WDIR/metrics.yaml
+echo "  MODE: ${RUN_MODE}" >> $WDIR/metrics.yaml
+cat $WDIR/msa_depth.yaml >> $WDIR/metrics.yaml
 echo "  START_TIME: ${PREDICT_START}" >> $WDIR/metrics.yaml
+echo "  STAGING_DURATION: $[ ${PREDICT_START} - ${START} ]" >> $WDIR/metrics.yaml
 echo "  TOTAL_PREDICT_DURATION: ${TOTAL_PREDICT_DURATION}" >> $WDIR/metrics.yaml
+PYTHONPATH=$SCRIPTDIR python -m rfutils.profiling summary $PROFILE --indent 2 >> $WDIR/metrics.yaml
 
 aws s3 cp $WDIR/metrics.yaml $OUTPUT_S3_FOLDER/metrics.yaml
+aws s3 cp $PROFILE $OUTPUT_S3_FOLDER/$UUID.predict.profile.jsonl
 
 echo "Done"
\ No newline at end of file
@@ -0,0 +1,298 @@
+"""
+Caches for AWS-RoseTTAFold results.
+"""
+
+## Load dependencies
+from contextlib import contextmanager
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+import yaml
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .clients import get_client
+
+## The data prep cache key covers the sequence and the versions of the
+## databases searched by run_aws_data_prep_ver.sh. Change DB_VERSIONS in the
+## script together with this list.
+DATA_PREP_DB_VERSIONS = [
+    "UniRef30_2020_06",
+    "bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt",
+    "pdb100_2021Mar03",
+]
+DATA_PREP_CACHE_FILES = ["msa0.a3m", "ss2", "hhr", "atab"]
+DATA_PREP_CACHE_PREFIX = "data-prep-cache"
+
+LOCAL_CACHE_DIR = "data/cache"
+LOCAL_CACHE_MAX_BYTES = 5 * 1024**3
+
+
+def normalize_sequence(fasta):
+
+    """
+    Join the sequence lines of a FASTA string, drop whitespace, and upper-case them.
+    """
+
+    lines = [line for line in fasta.splitlines() if not line.startswith(">")]
+    return "".join("".join(lines).split()).upper()
+
+
+def get_data_prep_cache_key(fasta, db_versions=DATA_PREP_DB_VERSIONS):
+
+    """
+    Return the data prep cache key of a FASTA string or plain sequence.
+    Matches the CACHE_KEY computed by run_aws_data_prep_ver.sh.
+    """
+
+    text = normalize_sequence(fasta) + "\n" + " ".join(db_versions)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def lookup_data_prep_cache(
+    bucket, cache_key, cache_prefix=DATA_PREP_CACHE_PREFIX, client=None
+):
+
+    """
+    Check whether all data prep results for a cache key are in the cache.
+    """
+
+    client = client or get_client("s3")
+    response = client.list_objects_v2(
+        Bucket=bucket, Prefix=f"{cache_prefix}/{cache_key}/"
+    )
+    names = {obj["Key"].rsplit("/", 1)[-1] for obj in response.get("Contents", [])}
+    return all(name in names for name in DATA_PREP_CACHE_FILES)
+
+
+def restore_data_prep_cache(
+    bucket,
+    cache_key,
+    job_name,
+    input_file="input.fa",
+    cache_prefix=DATA_PREP_CACHE_PREFIX,
+    client=None,
+):
+
+    """
+    Copy cached data prep results into a job folder, named the way the data
+    prep job would have named them, and write its DATA_PREP metrics.
+    """
+
+    client = client or get_client("s3")
+    for name in DATA_PREP_CACHE_FILES:
+        client.copy_object(
+            Bucket=bucket,
+            Key=f"{job_name}/{job_name}.{name}",
+            CopySource={"Bucket": bucket, "Key": f"{cache_prefix}/{cache_key}/{name}"},
+        )
+
+    ## Reuse the counts of the job that filled the cache, if it saved them
+    try:
+        cached = client.get_object(
+            Bucket=bucket, Key=f"{cache_prefix}/{cache_key}/metrics.yaml"
+        )
+        metrics = yaml.safe_load(cached["Body"].read())["DATA_PREP"]
+    except (client.exceptions.NoSuchKey, KeyError, TypeError):
+        metrics = {}
+
+    working_folder = f"s3://{bucket}/{job_name}"
+    metrics.update(
+        {
+            "JOB_ID": str(job_name),
+            "INPUT_S3_FOLDER": working_folder,
+            "INPUT_FILE": input_file,
+            "OUTPUT_S3_FOLDER": working_folder,
+            "CACHE_KEY": cache_key,
+            "CACHE_HITS": len(DATA_PREP_CACHE_FILES),
+            "CACHE_MISSES": 0,
+            "MSA_DURATION": 0,
+            "SS_DURATION": 0,
+            "TEMPLATE_DURATION": 0,
+            "TOTAL_DATA_PREP_DURATION": 0,
+        }
+    )
+    client.put_object(
+        Bucket=bucket,
+        Key=f"{job_name}/metrics.yaml",
+        Body=yaml.safe_dump({"DATA_PREP": metrics}, sort_keys=False).encode(),
+    )
+    return metrics
+
+
+class LocalCache:
+
+    """
+    On-disk cache of S3 objects keyed by bucket, key and ETag.
+
+    Every get() revalidates the cached copy with a conditional GET, which
+    only returns the object if its ETag changed. Entries are stored as
+    cache_dir/<hash of bucket and key>/<ETag>/<file name> and written through
+    a temporary file and an atomic rename. When the cache grows beyond
+    max_bytes, the least recently used entries are removed. A lock file
+    serializes updates between processes sharing the same cache_dir.
+    """
+
+    def __init__(self, cache_dir=LOCAL_CACHE_DIR, max_bytes=LOCAL_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, ".lock"), "a") as handle:
+                if fcntl is not None:
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _entry_dir(self, bucket, key):
+        digest = hashlib.sha256(f"{bucket}/{key}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:32])
+
+    def _cached(self, bucket, key):
+        entry_dir = self._entry_dir(bucket, key)
+        if not os.path.isdir(entry_dir):
+            return None, None
+        for etag in os.listdir(entry_dir):
+            path = os.path.join(entry_dir, etag, os.path.basename(key))
+            if os.path.isfile(path):
+                return etag, path
+        return None, None
+
+    def get(self, bucket, key, client=None):
+
+        """
+        Return the local path of an up-to-date copy of s3://bucket/key.
+        """
+
+        client = client or get_client("s3")
+        etag, path = self._cached(bucket, key)
+        ## The body and ETag come from the same response, so an object that is
+        ## overwritten meanwhile cannot be stored under the ETag of another one
+        try:
+            if etag is None:
+                response = client.get_object(Bucket=bucket, Key=key)
+            else:
+                response = client.get_object(
+                    Bucket=bucket, Key=key, IfNoneMatch=f'"{etag}"'
+                )
+        except client.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if etag is None or code not in ["304", "NotModified"]:
+                raise
+            with self._locked():
+                ## Not modified, mark the entry as recently used
+                if os.path.isfile(path):
+                    os.utime(path)
+                    return path
+            response = client.get_object(Bucket=bucket, Key=key)
+
+        etag = response["ETag"].strip('"')
+        entry_dir = self._entry_dir(bucket, key)
+        path = os.path.join(entry_dir, etag, os.path.basename(key))
+        ## Download outside the entry folders so eviction cannot remove it
+        tmp_dir = os.path.join(self.cache_dir, ".tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, "wb") as handle:
+                shutil.copyfileobj(response["Body"], handle, 1024**2)
+            with self._locked():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                ## Drop older versions of the same object
+                for old_etag in os.listdir(entry_dir):
+                    if old_etag != etag:
+                        shutil.rmtree(os.path.join(entry_dir, old_etag), True)
+                self._evict(keep=path)
+        finally:
+            response["Body"].close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            if root == self.cache_dir:
+                dirs[:] = [d for d in dirs if d != ".tmp"]
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _remove(self, path):
+        etag_dir = os.path.dirname(path)
+        shutil.rmtree(etag_dir, True)
+        try:
+            os.rmdir(os.path.dirname(etag_dir))
+        except OSError:
+            pass
+
+    def _evict(self, keep=None):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+                total -= size
+
+    def size(self):
+
+        """
+        Return the total size of the cached files in bytes.
+        """
+
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+
+        """
+        Remove every cached file.
+        """
+
+        with self._locked():
+            for _, _, path in list(self._entries()):
+                self._remove(path)
+
+
+_local_cache = None
+
+
+def get_local_cache():
+
+    """
+    Return the local download cache shared by the rfutils display helpers.
+    """
+
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = LocalCache()
+    return _local_cache
+
+
+def configure_local_cache(cache_dir=LOCAL_CACHE_DIR, max_bytes=LOCAL_CACHE_MAX_BYTES):
+
+    """
+    Replace the shared local download cache, e.g. to change its size limit.
+    """
+
+    global _local_cache
+    _local_cache = LocalCache(cache_dir, max_bytes)
+    return _local_cache
@@ -0,0 +1,113 @@
+"""
+Lazily created, shared AWS service clients for AWS-RoseTTAFold.
+
+Nothing in this module talks to AWS until a client, the default bucket, or the
+execution role is first requested.
+"""
+
+## Load dependencies
+import threading
+
+_lock = threading.RLock()
+_session = None
+_sm_session = None
+_clients = {}
+_role = None
+
+
+def get_session():
+
+    """
+    Return the shared boto3 session, creating it on first use.
+    """
+
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import boto3
+
+                _session = boto3.session.Session()
+    return _session
+
+
+def get_region():
+
+    """
+    Return the region of the shared boto3 session.
+    """
+
+    return get_session().region_name
+
+
+def get_client(service, region=None):
+
+    """
+    Return a pooled boto3 client for a service and region.
+
+    Clients are created once per (service, region) pair and shared between
+    threads, which boto3 supports for low-level clients.
+    """
+
+    key = (service, region)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = get_session().client(service, region_name=region)
+                _clients[key] = client
+    return client
+
+
+def get_sagemaker_session():
+
+    """
+    Return the shared SageMaker session, creating it on first use.
+    """
+
+    global _sm_session
+    if _sm_session is None:
+        with _lock:
+            if _sm_session is None:
+                import sagemaker
+
+                _sm_session = sagemaker.session.Session(boto_session=get_session())
+    return _sm_session
+
+
+def get_default_bucket():
+
+    """
+    Return the default SageMaker bucket for the current account and region.
+    """
+
+    return get_sagemaker_session().default_bucket()
+
+
+def get_execution_role():
+
+    """
+    Return the SageMaker execution role, looked up on first use.
+    """
+
+    global _role
+    if _role is None:
+        with _lock:
+            if _role is None:
+                import sagemaker
+
+                _role = sagemaker.get_execution_role(get_sagemaker_session())
+    return _role
+
+
+def reset_clients():
+
+    """
+    Drop all pooled sessions and clients, e.g. after changing credentials.
+    """
+
+    global _session, _sm_session, _role
+    with _lock:
+        _session, _sm_session, _role = None, None, None
+        _clients.clear()
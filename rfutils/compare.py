@@ -0,0 +1,276 @@
+"""
+Batched structural comparison of CA coordinates for AWS-RoseTTAFold.
+
+Every function takes stacks of coordinates of shape (N, L, 3), or a single
+(L, 3) array, with residues in corresponding order, and compares all N pairs
+at once with vectorized NumPy.
+"""
+
+## Load dependencies
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from time import perf_counter
+
+from .structure import Structure, read_pdb
+
+LDDT_CUTOFF = 15.0
+LDDT_THRESHOLDS = (0.5, 1.0, 2.0, 4.0)
+
+
+def _stack(coords):
+    coords = np.asarray(coords, dtype=np.float64)
+    return coords[None] if coords.ndim == 2 else coords
+
+
+def _broadcast(first, second):
+    first, second = _stack(first), _stack(second)
+    n = max(len(first), len(second))
+    return (
+        np.broadcast_to(first, (n,) + first.shape[1:]),
+        np.broadcast_to(second, (n,) + second.shape[1:]),
+    )
+
+
+def ca_coords(structures):
+
+    """
+    Stack the CA coordinates of PDB files, PDB strings or Structure objects
+    into an (N, L, 3) array. All structures must have the same length.
+    """
+
+    return np.stack(
+        [
+            (s if isinstance(s, Structure) else read_pdb(s)).ca.coords
+            for s in structures
+        ]
+    ).astype(np.float64)
+
+
+def kabsch(mobile, target, weights=None):
+
+    """
+    Return the rotations (N, 3, 3) and translations (N, 3) that superpose
+    mobile onto target with the lowest (weighted) RMSD, as
+    mobile @ rotation + translation. All N SVDs are computed in one call.
+    """
+
+    mobile, target = _broadcast(mobile, target)
+    if weights is None:
+        weights = np.ones(mobile.shape[:-1])
+    weights = weights / weights.sum(-1, keepdims=True)
+    mobile_center = (weights[..., None] * mobile).sum(-2)
+    target_center = (weights[..., None] * target).sum(-2)
+    covariance = np.einsum(
+        "nl,nli,nlj->nij",
+        weights,
+        mobile - mobile_center[:, None],
+        target - target_center[:, None],
+    )
+    u, _, vt = np.linalg.svd(covariance)
+    ## Flip the last axis where needed to get proper rotations, not reflections
+    sign = np.sign(np.linalg.det(u @ vt))
+    u[:, :, -1] *= sign[:, None]
+    rotation = u @ vt
+    translation = target_center - np.einsum("ni,nij->nj", mobile_center, rotation)
+    return rotation, translation
+
+
+def superpose(mobile, target, weights=None):
+
+    """
+    Return mobile superposed onto target, see kabsch.
+    """
+
+    rotation, translation = kabsch(mobile, target, weights)
+    return _stack(mobile) @ rotation + translation[:, None]
+
+
+def rmsd(mobile, target, superposition=True):
+
+    """
+    Return the CA RMSD of every pair, after optimal superposition by default.
+    """
+
+    if superposition:
+        mobile = superpose(mobile, target)
+    deviation = _stack(mobile) - _stack(target)
+    return np.sqrt((deviation**2).sum(-1).mean(-1))
+
+
+def tm_d0(length):
+
+    """
+    Return the TM-score distance scale d0 for a target length.
+    """
+
+    return max(1.24 * np.cbrt(max(length, 19) - 15) - 1.8, 0.5)
+
+
+def tm_score(mobile, target, n_iter=5):
+
+    """
+    Return the TM-score of every pair, normalized by the target length.
+
+    The superposition starts from the Kabsch fit of all residues and is
+    refined n_iter times by a Kabsch fit weighted with the TM-score terms,
+    which favours the well-aligned core. TM-align searches more starting
+    fragments, so this can be slightly lower than its score for poorly
+    matching structures.
+    """
+
+    mobile, target = _broadcast(mobile, target)
+    d0 = tm_d0(target.shape[-2])
+    best = np.zeros(len(mobile))
+    weights = None
+    for _ in range(n_iter + 1):
+        distance2 = ((superpose(mobile, target, weights) - target) ** 2).sum(-1)
+        terms = 1 / (1 + distance2 / d0**2)
+        best = np.maximum(best, terms.mean(-1))
+        weights = terms + 1e-6
+    return best
+
+
+def lddt(
+    model,
+    reference,
+    cutoff=LDDT_CUTOFF,
+    thresholds=LDDT_THRESHOLDS,
+    per_residue=False,
+):
+
+    """
+    Return the CA-lDDT of every model against its reference.
+
+    For all residue pairs closer than cutoff in the reference, the fraction
+    of pair distances in the model that are within each threshold of the
+    reference distance is averaged over the thresholds. No superposition is
+    needed. With per_residue=True, return (N, L) scores instead.
+    """
+
+    model, reference = _broadcast(model, reference)
+    n = len(model)
+    scores = np.empty((n, model.shape[1]) if per_residue else n)
+    length = model.shape[1]
+    ## Limit the (batch, L, L) temporaries to about 32M elements
+    batch = max(1, (1 << 25) // max(length * length, 1))
+    for start in range(0, n, batch):
+        m, r = model[start : start + batch], reference[start : start + batch]
+        ref_dist = np.linalg.norm(r[:, :, None] - r[:, None], axis=-1)
+        model_dist = np.linalg.norm(m[:, :, None] - m[:, None], axis=-1)
+        pairs = (ref_dist < cutoff) & ~np.eye(length, dtype=bool)
+        difference = np.abs(ref_dist - model_dist)
+        preserved = sum((difference < t) & pairs for t in thresholds)
+        preserved = preserved / len(thresholds)
+        if per_residue:
+            scores[start : start + batch] = preserved.sum(-1) / np.maximum(
+                pairs.sum(-1), 1
+            )
+        else:
+            scores[start : start + batch] = preserved.sum((-2, -1)) / np.maximum(
+                pairs.sum((-2, -1)), 1
+            )
+    return scores
+
+
+METRICS = {"rmsd": rmsd, "tm_score": tm_score, "lddt": lddt}
+
+
+def compare(models, reference):
+
+    """
+    Compare a stack of models with one reference (or a stack of references).
+    Returns a DataFrame with the RMSD, TM-score and CA-lDDT of every model.
+    """
+
+    return pd.DataFrame(
+        {name: metric(models, reference) for name, metric in METRICS.items()}
+    )
+
+
+## Coordinates shared with the worker processes of pairwise_matrix
+_worker_coords = None
+
+
+def _init_worker(coords):
+    global _worker_coords
+    _worker_coords = coords
+
+
+def _all_vs_one(index, metric, coords=None):
+    coords = _worker_coords if coords is None else coords
+    return METRICS[metric](coords, coords[index])
+
+
+def pairwise_matrix(coords, metric="tm_score", max_workers=None):
+
+    """
+    Return the (N, N) matrix of a metric between all structures in a stack.
+
+    Entry (i, j) compares structure i with structure j as the reference.
+    Each column is one batched call, and with max_workers the columns are
+    spread over a process pool.
+    """
+
+    coords = _stack(coords)
+    indices = range(len(coords))
+    if max_workers is None or max_workers < 2:
+        columns = [_all_vs_one(j, metric, coords) for j in indices]
+    else:
+        with ProcessPoolExecutor(
+            max_workers, initializer=_init_worker, initargs=(coords,)
+        ) as executor:
+            columns = list(executor.map(_all_vs_one, indices, [metric] * len(coords)))
+    return np.stack(columns, axis=1)
+
+
+def random_ca_trace(length, n=1, noise=1.0, seed=0):
+
+    """
+    Return n noisy copies of a random CA trace with 3.8 A steps, as (n, L, 3).
+    """
+
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(size=(length, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1, keepdims=True)
+    trace = np.cumsum(steps, axis=0)
+    return trace + rng.normal(scale=noise, size=(n, length, 3))
+
+
+def benchmark(lengths=(100, 300, 1000), n=64, max_workers=None, seed=0):
+
+    """
+    Time each metric on n synthetic structures against one reference, and
+    an all-vs-all TM-score matrix, for every length in lengths.
+    Returns a DataFrame of seconds and comparisons per second.
+    """
+
+    rows = []
+    for length in lengths:
+        models = random_ca_trace(length, n, seed=seed)
+        reference = models[0]
+        tasks = [
+            (name, metric, (models, reference)) for name, metric in METRICS.items()
+        ]
+        tasks.append(
+            (
+                "all_vs_all_tm_score",
+                lambda coords: pairwise_matrix(coords, "tm_score", max_workers),
+                (models,),
+            )
+        )
+        for name, function, args in tasks:
+            start = perf_counter()
+            function(*args)
+            seconds = perf_counter() - start
+            comparisons = n * n if name.startswith("all_vs_all") else n
+            rows.append(
+                {
+                    "length": length,
+                    "metric": name,
+                    "comparisons": comparisons,
+                    "seconds": seconds,
+                    "per_second": comparisons / seconds,
+                }
+            )
+    return pd.DataFrame(rows)
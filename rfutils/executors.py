@@ -0,0 +1,395 @@
+"""
+Execution backends for AWS-RoseTTAFold jobs.
+
+The submit, status and log helpers in rfutils call an executor with the part
+of the AWS Batch and CloudWatch Logs client APIs they use: submit_job,
+describe_jobs, list_jobs and get_log_events. BatchExecutor forwards these
+calls to AWS and is the default. LocalExecutor runs the job commands on this
+machine instead, e.g. for small jobs on a workstation or to exercise the
+orchestration code offline:
+
+    set_executor(LocalExecutor(max_workers=4, command=stub_command(0.1)))
+"""
+
+## Load dependencies
+from concurrent.futures import ThreadPoolExecutor
+import os
+import subprocess
+import sys
+import threading
+from time import time
+from types import SimpleNamespace
+import uuid
+
+from .clients import get_client
+
+LOG_GROUP = "/aws/batch/job"
+STATUSES = ["PENDING", "RUNNABLE", "RUNNING", "SUCCEEDED", "FAILED"]
+SUMMARY_FIELDS = ["jobArn", "jobId", "jobName", "createdAt", "status"]
+
+_lock = threading.RLock()
+_executor = None
+
+
+def _now():
+    return round(time() * 1000)
+
+
+class BatchExecutor:
+
+    """
+    Run jobs on AWS Batch, with logs from CloudWatch Logs.
+    """
+
+    def __init__(self, client=None, logs_client=None):
+        self._client = client
+        self._logs_client = logs_client
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_client("batch")
+        return self._client
+
+    @property
+    def logs_client(self):
+        if self._logs_client is None:
+            self._logs_client = get_client("logs")
+        return self._logs_client
+
+    @property
+    def exceptions(self):
+        return self.logs_client.exceptions
+
+    def submit_job(self, **kwargs):
+        return self.client.submit_job(**kwargs)
+
+    def describe_jobs(self, jobs):
+        return self.client.describe_jobs(jobs=jobs)
+
+    def list_jobs(self, **kwargs):
+        return self.client.list_jobs(**kwargs)
+
+    def get_log_events(self, logStreamName, logGroupName=LOG_GROUP, **kwargs):
+        return self.logs_client.get_log_events(
+            logGroupName=logGroupName, logStreamName=logStreamName, **kwargs
+        )
+
+
+class ResourceNotFoundException(Exception):
+    pass
+
+
+def stub_command(seconds=0.0, exit_code=0):
+
+    """
+    Return a command function for LocalExecutor that replaces every job with
+    a Python process that prints its original command, sleeps for seconds
+    and exits with exit_code.
+    """
+
+    def command(job):
+        return [
+            sys.executable,
+            "-c",
+            "import sys, time; print(' '.join(sys.argv[3:]), flush=True); "
+            "time.sleep(float(sys.argv[1])); sys.exit(int(sys.argv[2]))",
+            str(seconds),
+            str(exit_code),
+        ] + list(job["container"]["command"])
+
+    return command
+
+
+class LocalExecutor:
+
+    """
+    Run jobs as local processes, at most max_workers at a time.
+
+    Jobs go through the AWS Batch states: PENDING until their dependencies
+    succeeded (or FAILED if one of them failed), RUNNABLE until a worker is
+    free, then RUNNING, SUCCEEDED or FAILED by exit code. Array jobs get one
+    child per index, and N_TO_N dependencies link children with the same
+    index. The output of every job is kept as log events.
+
+    command is a function from a job description to the command to run; by
+    default the containerOverrides command runs in working_dir, e.g. a
+    RoseTTAFold folder with the container scripts. Environment overrides, the
+    AWS_BATCH_JOB_ID and AWS_BATCH_JOB_ARRAY_INDEX variables are set as on
+    Batch.
+    """
+
+    exceptions = SimpleNamespace(ResourceNotFoundException=ResourceNotFoundException)
+
+    def __init__(self, max_workers=None, working_dir=None, command=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.working_dir = working_dir
+        self.command = command
+        self.jobs = {}
+        self.logs = {}
+        self._pool = ThreadPoolExecutor(self.max_workers)
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _new_job(self, job_id, kwargs, array_index=None):
+        overrides = kwargs.get("containerOverrides", {})
+        job = {
+            "jobArn": f"local:job/{job_id}",
+            "jobName": kwargs["jobName"],
+            "jobId": job_id,
+            "jobQueue": kwargs["jobQueue"],
+            "jobDefinition": kwargs["jobDefinition"],
+            "status": "SUBMITTED",
+            "createdAt": _now(),
+            "dependsOn": list(kwargs.get("dependsOn", [])),
+            "tags": dict(kwargs.get("tags", {})),
+            "container": {
+                "command": list(overrides.get("command", [])),
+                "environment": list(overrides.get("environment", [])),
+                "resourceRequirements": list(
+                    overrides.get("resourceRequirements", [])
+                ),
+            },
+        }
+        if array_index is not None:
+            job["arrayProperties"] = {"index": array_index}
+        self.jobs[job_id] = job
+        return job
+
+    def submit_job(self, **kwargs):
+
+        """
+        Submit a job, with the arguments of the Batch SubmitJob API.
+        """
+
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            job = self._new_job(job_id, kwargs)
+            size = kwargs.get("arrayProperties", {}).get("size")
+            if size:
+                job["arrayProperties"] = {"size": size}
+                job["children"] = [
+                    self._new_job(f"{job_id}:{i}", kwargs, i)["jobId"]
+                    for i in range(size)
+                ]
+            for child_id in job.get("children", [job_id]):
+                self.jobs[child_id]["status"] = "PENDING"
+            self._schedule()
+        return {"jobArn": job["jobArn"], "jobName": job["jobName"], "jobId": job_id}
+
+    def _dependencies(self, job):
+        index = job.get("arrayProperties", {}).get("index")
+        for dependency in job["dependsOn"]:
+            job_id = dependency["jobId"]
+            if dependency.get("type") == "N_TO_N" and index is not None:
+                job_id = f"{job_id}:{index}"
+            yield job_id
+
+    def _status(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return "FAILED"
+        if "children" not in job:
+            return job["status"]
+        ## An array job is active while any child is, and fails if any child failed
+        statuses = {self.jobs[child]["status"] for child in job["children"]}
+        for status in ["RUNNING", "RUNNABLE", "PENDING", "FAILED"]:
+            if status in statuses:
+                return status
+        return "SUCCEEDED"
+
+    def _schedule(self):
+
+        """
+        Queue every pending job whose dependencies succeeded, and fail the
+        ones with a failed dependency. Called with the lock held.
+        """
+
+        changed = True
+        while changed:
+            changed = False
+            for job in list(self.jobs.values()):
+                if job["status"] != "PENDING" or "children" in job:
+                    continue
+                statuses = [self._status(d) for d in self._dependencies(job)]
+                if "FAILED" in statuses:
+                    job["status"] = "FAILED"
+                    job["statusReason"] = "Dependent Job failed"
+                    job["stoppedAt"] = _now()
+                    changed = True
+                elif all(status == "SUCCEEDED" for status in statuses):
+                    job["status"] = "RUNNABLE"
+                    self._pool.submit(self._run, job["jobId"])
+        self._changed.notify_all()
+
+    def _environment(self, job):
+        environment = dict(os.environ)
+        for variable in job["container"]["environment"]:
+            environment[variable["name"]] = variable["value"]
+        environment["AWS_BATCH_JOB_ID"] = job["jobId"]
+        index = job.get("arrayProperties", {}).get("index")
+        if index is not None:
+            environment["AWS_BATCH_JOB_ARRAY_INDEX"] = str(index)
+        return environment
+
+    def _run(self, job_id):
+        with self._lock:
+            job = self.jobs[job_id]
+            job["status"] = "RUNNING"
+            job["startedAt"] = _now()
+            job["container"]["logStreamName"] = f"local/{job_id}"
+            events = self.logs.setdefault(job["container"]["logStreamName"], [])
+            self._changed.notify_all()
+        command = self.command(job) if self.command else job["container"]["command"]
+        try:
+            process = subprocess.Popen(
+                command,
+                cwd=self.working_dir,
+                env=self._environment(job),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                errors="replace",
+            )
+            for line in process.stdout:
+                events.append({"timestamp": _now(), "message": line.rstrip("\n")})
+            exit_code = process.wait()
+            reason = f"Essential container exited with code {exit_code}"
+        except OSError as e:
+            exit_code, reason = None, str(e)
+            events.append({"timestamp": _now(), "message": reason})
+        with self._lock:
+            job["container"]["exitCode"] = exit_code
+            job["status"] = "SUCCEEDED" if exit_code == 0 else "FAILED"
+            job["statusReason"] = reason
+            job["stoppedAt"] = _now()
+            self._schedule()
+
+    def _describe(self, job_id):
+        job = dict(self.jobs[job_id])
+        job["container"] = dict(job["container"])
+        job["status"] = self._status(job_id)
+        if "children" in job:
+            children = [self.jobs[child] for child in job.pop("children")]
+            job["arrayProperties"] = dict(
+                job["arrayProperties"],
+                statusSummary={
+                    status: sum(c["status"] == status for c in children)
+                    for status in STATUSES
+                },
+            )
+        return job
+
+    def describe_jobs(self, jobs):
+
+        """
+        Describe jobs by id, like the Batch DescribeJobs API.
+        """
+
+        with self._lock:
+            jobs = [job_id for job_id in jobs if job_id in self.jobs]
+            return {"jobs": [self._describe(job_id) for job_id in jobs]}
+
+    def list_jobs(self, jobQueue, filters=(), nextToken=None, **kwargs):
+
+        """
+        List the jobs of a queue, like the Batch ListJobs API. Only the
+        AFTER_CREATED_AT filter is supported, and all jobs fit on one page.
+        """
+
+        after = 0
+        for f in filters:
+            if f["name"] == "AFTER_CREATED_AT":
+                after = int(f["values"][0])
+        with self._lock:
+            jobs = [
+                self._describe(job_id)
+                for job_id, job in self.jobs.items()
+                if job["jobQueue"] == jobQueue
+                and job["createdAt"] > after
+                ## Array children are not listed, as on Batch
+                and "index" not in job.get("arrayProperties", {})
+            ]
+        return {
+            "jobSummaryList": [
+                {
+                    key: job[key]
+                    for key in SUMMARY_FIELDS + ["startedAt", "stoppedAt"]
+                    if key in job
+                }
+                for job in jobs
+            ]
+        }
+
+    def get_log_events(
+        self, logStreamName, logGroupName=LOG_GROUP, nextToken=None, **kwargs
+    ):
+
+        """
+        Return the log events of a job that were not read yet, like the
+        CloudWatch Logs GetLogEvents API reading forward from the head, at
+        most limit (default 10,000) events per page.
+        """
+
+        limit = kwargs.get("limit", 10000)
+        with self._lock:
+            if logStreamName not in self.logs:
+                raise ResourceNotFoundException(logStreamName)
+            start = int(nextToken.split("/")[-1]) if nextToken else 0
+            events = self.logs[logStreamName][start : start + limit]
+        page = [dict(event, ingestionTime=event["timestamp"]) for event in events]
+        return {"events": page, "nextForwardToken": f"f/{start + len(page)}"}
+
+    def wait(self, job_ids=None, timeout=None):
+
+        """
+        Block until the given jobs (all jobs by default) have finished.
+        Returns their final statuses.
+        """
+
+        with self._lock:
+            job_ids = list(self.jobs) if job_ids is None else list(job_ids)
+            self._changed.wait_for(
+                lambda: all(
+                    self._status(job_id) in ["SUCCEEDED", "FAILED"]
+                    for job_id in job_ids
+                ),
+                timeout,
+            )
+            return {job_id: self._status(job_id) for job_id in job_ids}
+
+
+def get_executor():
+
+    """
+    Return the executor used by the rfutils submit, status and log helpers.
+    """
+
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = BatchExecutor()
+    return _executor
+
+
+def set_executor(executor):
+
+    """
+    Use executor for all later jobs, or None to go back to AWS Batch.
+    Returns the previous executor.
+    """
+
+    global _executor
+    with _lock:
+        previous, _executor = _executor, executor
+    return previous
@@ -0,0 +1,260 @@
+"""
+Memory-mapped reader for HH-suite ffindex/ffdata databases.
+
+The sequence and template databases in the database folder (e.g.
+pdb100_2021Mar03/pdb100_2021Mar03_a3m) are pairs of an .ffdata file with the
+concatenated entries and a sorted .ffindex file with one "name offset length"
+line per entry. FFindexDatabase maps both files and finds entries by binary
+search over the index, so no file is loaded as a whole and only the pages
+that are used are read. It can also warm the page cache with the index and a
+chosen set of entries, e.g. before hhsearch starts on FSx for Lustre. This
+module only uses the standard library:
+
+    python -m rfutils.ffindex get /fsx/pdb100_2021Mar03/pdb100_2021Mar03_a3m 5X6G_A
+    python -m rfutils.ffindex extract DB_a3m templates --hhr t000_.hhr
+    python -m rfutils.ffindex warm DB_cs219 --all
+"""
+
+## Load dependencies
+import argparse
+import mmap
+import os
+import sys
+
+
+def _map(path):
+    with open(path, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _touch(mapped, start, end):
+
+    """
+    Read the pages of mapped[start:end] into the page cache. Returns the
+    number of bytes covered.
+    """
+
+    if end <= start or not isinstance(mapped, mmap.mmap):
+        return 0
+    start -= start % mmap.PAGESIZE
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_WILLNEED, start, end - start)
+    for position in range(start, end, mmap.PAGESIZE):
+        mapped[position]
+    return end - start
+
+
+class FFindexDatabase:
+
+    """
+    Read-only access to the entries of an ffindex/ffdata pair by name.
+
+    prefix is the path without the .ffindex and .ffdata extensions, or use
+    data_path and index_path for other names. Lookups assume the index is
+    sorted by name, as written by ffindex_build.
+    """
+
+    def __init__(self, prefix=None, data_path=None, index_path=None):
+        self.data_path = data_path or f"{prefix}.ffdata"
+        self.index_path = index_path or f"{prefix}.ffindex"
+        self.index = _map(self.index_path)
+        self.data = _map(self.data_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for mapped in [self.index, self.data]:
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def _line(self, position):
+        start = self.index.rfind(b"\n", 0, position) + 1
+        end = self.index.find(b"\n", position)
+        return start, len(self.index) if end == -1 else end
+
+    def lookup(self, name):
+
+        """
+        Return the (offset, length) of an entry in the .ffdata file, or None.
+        """
+
+        key = name.encode() if isinstance(name, str) else name
+        low, high = 0, len(self.index)
+        ## low and high are always at the start of a line
+        while low < high:
+            start, end = self._line((low + high) // 2)
+            entry, offset, length = self.index[start:end].split(b"\t")
+            if entry == key:
+                return int(offset), int(length)
+            if entry < key:
+                low = end + 1
+            else:
+                high = start
+        return None
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def get(self, name, default=None):
+
+        """
+        Return the contents of an entry as bytes, without the trailing null
+        byte, or default if there is no entry of that name.
+        """
+
+        location = self.lookup(name)
+        if location is None:
+            return default
+        offset, length = location
+        return self.data[offset : offset + length].rstrip(b"\0")
+
+    def __getitem__(self, name):
+        entry = self.get(name)
+        if entry is None:
+            raise KeyError(name)
+        return entry
+
+    def __iter__(self):
+
+        """
+        Iterate over the entry names in index order.
+        """
+
+        start = 0
+        while start < len(self.index):
+            end = self.index.find(b"\n", start)
+            end = len(self.index) if end == -1 else end
+            if end > start:
+                yield self.index[start : self.index.find(b"\t", start)].decode()
+            start = end + 1
+
+    def extract(self, names, output_folder, suffix=""):
+
+        """
+        Write entries to output_folder/<name><suffix>, in the order of their
+        offsets to read the .ffdata file sequentially. Returns the names that
+        were not found.
+        """
+
+        os.makedirs(output_folder, exist_ok=True)
+        locations, missing = [], []
+        for name in names:
+            location = self.lookup(name)
+            if location is None:
+                missing.append(name)
+            else:
+                locations.append((location, name))
+        for (offset, length), name in sorted(locations):
+            with open(os.path.join(output_folder, f"{name}{suffix}"), "wb") as handle:
+                handle.write(self.data[offset : offset + length].rstrip(b"\0"))
+        return missing
+
+    def warm(self, names=(), index=True, data=False):
+
+        """
+        Read the index (if index), the whole .ffdata file (if data) or only
+        the given entries into the page cache, so later reads by this or
+        other processes do not wait on the file system. Returns the number
+        of bytes warmed.
+        """
+
+        warmed = _touch(self.index, 0, len(self.index)) if index else 0
+        if data:
+            return warmed + _touch(self.data, 0, len(self.data))
+        locations = sorted(filter(None, (self.lookup(name) for name in names)))
+        for offset, length in locations:
+            warmed += _touch(self.data, offset, offset + length)
+        return warmed
+
+
+def read_hhr_hits(path, max_hits=None):
+
+    """
+    Return the template names in the hit list of an HHsearch .hhr file, in
+    rank order, e.g. to look them up in the pdb100 _a3m database.
+    """
+
+    hits = []
+    in_table = False
+    with open(path) as handle:
+        for line in handle:
+            if line.startswith(" No Hit"):
+                in_table = True
+            elif in_table:
+                if not line.strip() or (max_hits and len(hits) >= max_hits):
+                    break
+                hits.append(line[4:].split()[0])
+    return hits
+
+
+def _read_names(args):
+    names = list(args.names)
+    if args.names_file:
+        with open(args.names_file) as handle:
+            names += [line.strip() for line in handle if line.strip()]
+    if args.hhr:
+        names += read_hhr_hits(args.hhr, args.max_hits)
+    return names
+
+
+def main(argv=None):
+
+    """
+    Command line entry point, see the module docstring.
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m rfutils.ffindex")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_names(command_parser):
+        command_parser.add_argument("names", nargs="*", help="Entry names")
+        command_parser.add_argument("--names-file", help="File with one name per line")
+        command_parser.add_argument("--hhr", help="Use the hits of an .hhr file")
+        command_parser.add_argument("--max-hits", type=int, default=None)
+
+    get_parser = commands.add_parser("get", help="Print entries")
+    get_parser.add_argument("prefix", help="Database path without extension")
+    add_names(get_parser)
+
+    extract_parser = commands.add_parser("extract", help="Write entries to files")
+    extract_parser.add_argument("prefix", help="Database path without extension")
+    extract_parser.add_argument("output_folder")
+    extract_parser.add_argument("--suffix", default="")
+    add_names(extract_parser)
+
+    warm_parser = commands.add_parser("warm", help="Read into the page cache")
+    warm_parser.add_argument("prefix", help="Database path without extension")
+    warm_parser.add_argument("--all", action="store_true", help="Warm all entries")
+    warm_parser.add_argument("--no-index", action="store_true")
+    add_names(warm_parser)
+
+    args = parser.parse_args(argv)
+    names = _read_names(args)
+    with FFindexDatabase(args.prefix) as db:
+        if args.command == "get":
+            missing = []
+            for name in names:
+                entry = db.get(name)
+                if entry is None:
+                    missing.append(name)
+                else:
+                    sys.stdout.buffer.write(entry)
+        elif args.command == "extract":
+            missing = db.extract(names, args.output_folder, args.suffix)
+        else:
+            warmed = db.warm(names, not args.no_index, args.all)
+            print(f"Warmed {warmed / 1024**2:.1f} MB of {args.prefix}")
+            missing = [name for name in names if name not in db]
+    for name in missing:
+        print(f"No entry {name} in {args.prefix}", file=sys.stderr)
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
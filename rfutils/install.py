@@ -0,0 +1,529 @@
+"""
+Streaming installer for the RoseTTAFold weights and sequence databases.
+
+Each archive is downloaded with parallel ranged HTTP requests and piped
+through gzip decompression and tar extraction, so no archive is written to
+disk, and the databases are installed concurrently. Extracted members are
+recorded as they complete, so an interrupted install can simply be rerun:
+installed databases are skipped, and an interrupted archive is streamed again
+without rewriting the members it already extracted. The SHA-256 of every
+archive is computed on the fly, checked against a known value if given, and
+recorded with the database version in manifest.json. This module only uses
+the standard library:
+
+    python -m rfutils.install install /fsx
+    python -m rfutils.install selftest
+"""
+
+## Load dependencies
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import functools
+import hashlib
+import http.client
+import http.server
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.request
+
+## The versions match the DB_VERSIONS of the data prep cache key
+DATABASES = [
+    {
+        "name": "weights",
+        "version": "RoseTTAFold-v1.1",
+        "url": "https://files.ipd.uw.edu/pub/RoseTTAFold/weights.tar.gz",
+        "directory": ".",
+    },
+    {
+        "name": "uniref30",
+        "version": "UniRef30_2020_06",
+        "url": "http://wwwuser.gwdg.de/~compbiol/uniclust/2020_06/UniRef30_2020_06_hhsuite.tar.gz",
+        "directory": "UniRef30_2020_06",
+    },
+    {
+        "name": "pdb100",
+        "version": "pdb100_2021Mar03",
+        "url": "https://files.ipd.uw.edu/pub/RoseTTAFold/pdb100_2021Mar03.tar.gz",
+        "directory": ".",
+    },
+    {
+        "name": "bfd",
+        "version": "bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt",
+        "url": "https://bfd.mmseqs.com/bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt.tar.gz",
+        "directory": "bfd",
+    },
+]
+MANIFEST_FILE = "manifest.json"
+PART_SIZE = 64 * 1024**2
+
+_manifest_lock = threading.Lock()
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+class RangeReader(io.RawIOBase):
+
+    """
+    Sequential, read-only file object over a URL.
+
+    Parts of part_size bytes are fetched ahead with up to connections
+    parallel ranged GETs, and a failed part is retried with exponential
+    backoff. Servers without range support are read with a single GET.
+    """
+
+    def __init__(self, url, part_size=PART_SIZE, connections=4, retries=5, timeout=60):
+        self.url = url
+        self.part_size = part_size
+        self.connections = connections
+        self.retries = retries
+        self.timeout = timeout
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            length = response.headers.get("Content-Length")
+            ranges = response.headers.get("Accept-Ranges") == "bytes"
+        self.size = int(length) if length is not None else None
+        self._pool = None
+        if ranges and self.size is not None:
+            self._pool = ThreadPoolExecutor(connections)
+        self._parts = deque()
+        self._next = 0
+        self._buffer = memoryview(b"")
+        self._stream = None
+
+    def readable(self):
+        return True
+
+    def _fetch(self, start, end):
+        for attempt in range(self.retries + 1):
+            try:
+                request = urllib.request.Request(
+                    self.url, headers={"Range": f"bytes={start}-{end - 1}"}
+                )
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    if response.status != 206:
+                        raise OSError(f"Range request returned {response.status}")
+                    data = response.read()
+                if len(data) != end - start:
+                    raise OSError(f"Expected {end - start} bytes, got {len(data)}")
+                return data
+            except (OSError, http.client.HTTPException):
+                if attempt == self.retries:
+                    raise
+                time.sleep(min(60, 2**attempt) * random.uniform(0.5, 1.0))
+
+    def _schedule(self):
+        while len(self._parts) < self.connections and self._next < self.size:
+            end = min(self._next + self.part_size, self.size)
+            self._parts.append(self._pool.submit(self._fetch, self._next, end))
+            self._next = end
+
+    def readinto(self, buffer):
+        if self._pool is None:
+            if self._stream is None:
+                self._stream = urllib.request.urlopen(self.url, timeout=self.timeout)
+            return self._stream.readinto(buffer)
+        if not self._buffer:
+            self._schedule()
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._schedule()
+        n = min(len(buffer), len(self._buffer))
+        buffer[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if self._pool is not None:
+            for part in self._parts:
+                part.cancel()
+            self._pool.shutdown(wait=True)
+        if self._stream is not None:
+            self._stream.close()
+        super().close()
+
+
+class HashingReader(io.RawIOBase):
+
+    """
+    Pass reads through to a raw file object, keeping the SHA-256 and count
+    of the bytes read.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.raw.readinto(buffer)
+        self.sha256.update(memoryview(buffer)[:n])
+        self.bytes += n
+        return n
+
+
+def read_manifest(root):
+
+    """
+    Return the installed databases recorded in root/manifest.json, by name.
+    """
+
+    path = os.path.join(root, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def _update_manifest(root, name, entry):
+    with _manifest_lock:
+        manifest = read_manifest(root)
+        manifest[name] = entry
+        path = os.path.join(root, MANIFEST_FILE)
+        with open(f"{path}.tmp", "w") as handle:
+            json.dump(manifest, handle, indent=2, sort_keys=True)
+        os.replace(f"{path}.tmp", path)
+
+
+def _safe_member(member):
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name == ".." or name.startswith(f"..{os.sep}"):
+        return False
+    return not (member.issym() or member.islnk()) or not (
+        os.path.isabs(member.linkname) or ".." in member.linkname.split("/")
+    )
+
+
+def install_database(
+    database,
+    root,
+    part_size=PART_SIZE,
+    connections=4,
+    expected_sha256=None,
+    progress=None,
+):
+
+    """
+    Stream one database archive from its URL into root/directory.
+
+    Skips databases already in the manifest with the same URL (and SHA-256,
+    if expected_sha256 is given). progress is
+    called with (name, member name, archive bytes read) after every
+    extracted member. Returns the manifest entry.
+    """
+
+    name = database["name"]
+    installed = read_manifest(root).get(name)
+    if installed and installed["url"] == database["url"]:
+        if not expected_sha256 or installed["sha256"] == expected_sha256.lower():
+            return installed
+
+    target = os.path.join(root, database["directory"])
+    os.makedirs(target, exist_ok=True)
+    progress_path = os.path.join(root, f".{name}.progress")
+    done = set()
+    if os.path.isfile(progress_path):
+        with open(progress_path) as handle:
+            done = set(handle.read().splitlines())
+
+    ## Python 3.12 and later validate members with the "data" filter
+    extract_args = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+    members = 0
+    reader = RangeReader(database["url"], part_size, connections)
+    hashing = HashingReader(reader)
+    try:
+        stream = io.BufferedReader(hashing, 1024**2)
+        with open(progress_path, "a") as log, tarfile.open(
+            fileobj=stream, mode="r|gz"
+        ) as tar:
+            for member in tar:
+                members += 1
+                if member.name not in done:
+                    if not _safe_member(member):
+                        raise ValueError(f"Unsafe path {member.name} in {name}")
+                    tar.extract(member, target, **extract_args)
+                    log.write(member.name + "\n")
+                    log.flush()
+                ## Stream mode keeps every TarInfo, which adds up for big archives
+                tar.members = []
+                if progress is not None:
+                    progress(name, member.name, hashing.bytes)
+        ## Hash the end of the archive that tar extraction does not read
+        while stream.read(1024**2):
+            pass
+    finally:
+        reader.close()
+
+    ## Members extracted from a stream that failed verification must not be
+    ## skipped by the next run
+    sha256 = hashing.sha256.hexdigest()
+    if reader.size is not None and hashing.bytes != reader.size:
+        os.remove(progress_path)
+        raise IOError(f"{name}: read {hashing.bytes} of {reader.size} bytes")
+    if expected_sha256 and sha256 != expected_sha256.lower():
+        os.remove(progress_path)
+        raise ChecksumError(f"{name}: SHA-256 {sha256}, expected {expected_sha256}")
+
+    entry = {
+        "version": database["version"],
+        "url": database["url"],
+        "directory": database["directory"],
+        "sha256": sha256,
+        "bytes": hashing.bytes,
+        "members": members,
+        "installed_at": datetime.now(timezone.utc).isoformat(),
+    }
+    _update_manifest(root, name, entry)
+    os.remove(progress_path)
+    return entry
+
+
+def install(
+    root,
+    databases=DATABASES,
+    max_workers=4,
+    connections=4,
+    part_size=PART_SIZE,
+    checksums=None,
+    progress=None,
+):
+
+    """
+    Install databases concurrently, max_workers archives at a time, each
+    with up to connections ranged requests in flight. checksums maps
+    database names to expected SHA-256 values. Returns the manifest entries
+    by name, and raises once all databases were tried if any failed.
+    """
+
+    checksums = checksums or {}
+    os.makedirs(root, exist_ok=True)
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {
+            database["name"]: executor.submit(
+                install_database,
+                database,
+                root,
+                part_size,
+                connections,
+                checksums.get(database["name"]),
+                progress,
+            )
+            for database in databases
+        }
+    errors = {name: f.exception() for name, f in futures.items() if f.exception()}
+    if errors:
+        for name, error in errors.items():
+            print(f"{name}: {error}", file=sys.stderr)
+        raise next(iter(errors.values()))
+    return {name: future.result() for name, future in futures.items()}
+
+
+class _RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    """
+    Static file handler with single byte range support, for self_test.
+    """
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def do_GET(self):
+        byte_range = self.headers.get("Range")
+        if not byte_range:
+            return super().do_GET()
+        path = self.translate_path(self.path)
+        start, end = byte_range.split("=")[1].split("-")
+        with open(path, "rb") as handle:
+            handle.seek(int(start))
+            data = handle.read(int(end) - int(start) + 1)
+        self.send_response(206)
+        size = os.path.getsize(path)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _synthetic_archive(path, prefix, n_files=5, seed=0):
+    rng = random.Random(seed)
+    files = {}
+    with tarfile.open(path, "w:gz") as tar:
+        for i in range(n_files):
+            data = bytes(rng.getrandbits(8) for _ in range(rng.randint(1, 50000)))
+            info = tarfile.TarInfo(f"{prefix}/part_{i}.ffdata")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            files[info.name] = data
+    return files
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def self_test(part_size=4096, connections=3):
+
+    """
+    Install two small synthetic archives from a local HTTP server with
+    ranged requests: interrupt the first after two members and resume it,
+    then check the extracted files, the manifest and checksum verification.
+    Raises RuntimeError on failure.
+    """
+
+    def check(condition, message):
+        if not condition:
+            raise RuntimeError(f"Self test failed: {message}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        served, root = os.path.join(tmp, "served"), os.path.join(tmp, "root")
+        os.makedirs(served)
+        expected = {}
+        for i, name in enumerate(["first", "second"]):
+            expected[name] = _synthetic_archive(
+                os.path.join(served, f"{name}.tar.gz"), name, seed=i
+            )
+        handler = functools.partial(_RangeRequestHandler, directory=served)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        databases = [
+            {
+                "name": name,
+                "version": f"{name}-1",
+                "url": f"{url}/{name}.tar.gz",
+                "directory": "db" if name == "first" else ".",
+            }
+            for name in expected
+        ]
+        try:
+            def interrupt(name, member, read):
+                if member.endswith("part_1.ffdata"):
+                    raise _Interrupted()
+
+            try:
+                install_database(
+                    databases[0], root, part_size, connections, None, interrupt
+                )
+            except _Interrupted:
+                pass
+            with open(os.path.join(root, ".first.progress")) as handle:
+                check(len(handle.read().splitlines()) == 2, "progress not recorded")
+            check(not read_manifest(root), "interrupted archive in manifest")
+
+            bad = {"second": "0" * 64}
+            try:
+                install(root, databases, 2, connections, part_size, checksums=bad)
+                check(False, "checksum mismatch not detected")
+            except ChecksumError:
+                pass
+            check(
+                not os.path.exists(os.path.join(root, ".second.progress")),
+                "progress of a failed checksum kept",
+            )
+            manifest = install(root, databases, 2, connections, part_size)
+            try:
+                install(root, databases[1:], 1, connections, part_size, bad)
+                check(False, "installed database with another checksum skipped")
+            except ChecksumError:
+                pass
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        for database in databases:
+            name = database["name"]
+            for member, data in expected[name].items():
+                path = os.path.join(root, database["directory"], member)
+                with open(path, "rb") as handle:
+                    check(handle.read() == data, f"{member} differs")
+            with open(os.path.join(served, f"{name}.tar.gz"), "rb") as handle:
+                sha256 = hashlib.sha256(handle.read()).hexdigest()
+            check(manifest[name]["sha256"] == sha256, f"{name} checksum differs")
+            check(read_manifest(root)[name]["version"] == f"{name}-1", "no version")
+        check(
+            not any(f.endswith(".progress") for f in os.listdir(root)),
+            "progress files left",
+        )
+    print("Self test passed")
+
+
+def main(argv=None):
+
+    """
+    Command line entry point, see the module docstring.
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m rfutils.install")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    install_parser = commands.add_parser(
+        "install", help="Install the RoseTTAFold weights and databases"
+    )
+    install_parser.add_argument("root", help="Folder to install into, e.g. /fsx")
+    install_parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=[database["name"] for database in DATABASES],
+        help="Databases to install (all by default)",
+    )
+    install_parser.add_argument("--workers", type=int, default=4)
+    install_parser.add_argument("--connections", type=int, default=4)
+    install_parser.add_argument("--part-size-mb", type=int, default=64)
+    install_parser.add_argument(
+        "--sha256",
+        nargs="+",
+        default=[],
+        metavar="NAME=SHA256",
+        help="Expected archive checksums",
+    )
+
+    commands.add_parser("selftest", help="Install synthetic archives locally")
+
+    args = parser.parse_args(argv)
+    if args.command == "selftest":
+        self_test()
+        return 0
+
+    databases = [
+        database
+        for database in DATABASES
+        if not args.only or database["name"] in args.only
+    ]
+
+    def progress(name, member, read):
+        print(f"{name}: extracted {member} ({read / 1024**3:.1f} GB read)", flush=True)
+
+    manifest = install(
+        args.root,
+        databases,
+        args.workers,
+        args.connections,
+        args.part_size_mb * 1024**2,
+        dict(value.split("=", 1) for value in args.sha256),
+        progress,
+    )
+    for name, entry in manifest.items():
+        print(f"{name}: {entry['version']} sha256 {entry['sha256']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
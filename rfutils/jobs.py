@@ -0,0 +1,385 @@
+"""
+Helpers for following many AWS Batch jobs at once.
+"""
+
+## Load dependencies
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import pandas as pd
+import queue
+import random
+from time import sleep, time
+
+from .executors import get_executor
+
+## describe_jobs accepts at most 100 job ids per call
+DESCRIBE_JOBS_LIMIT = 100
+ACTIVE_STATUSES = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]
+## Jobs that describe_jobs does not return, e.g. past the Batch retention
+## period, submitted in another region or mistyped
+UNKNOWN_STATUS = "UNKNOWN"
+TERMINAL_STATUSES = ["SUCCEEDED", "FAILED", UNKNOWN_STATUS]
+THROTTLING_ERRORS = [
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+]
+
+JobEvent = namedtuple("JobEvent", ["job_id", "job_name", "previous", "status", "job"])
+
+
+def is_throttling_error(error):
+
+    """
+    Check whether a botocore error was caused by API rate limiting.
+    """
+
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in THROTTLING_ERRORS
+
+
+class JobTracker:
+
+    """
+    Keep a local status snapshot of any number of AWS Batch jobs.
+
+    Job ids are described in chunks of 100. When the Batch API throttles, the
+    tracker waits with an exponential, jittered delay and keeps a pause
+    between chunks until calls succeed again. A job that is missing from
+    unknown_after polls in a row gets the terminal status UNKNOWN.
+    """
+
+    def __init__(
+        self,
+        job_ids=(),
+        client=None,
+        base_delay=1.0,
+        max_delay=60.0,
+        max_retries=8,
+        unknown_after=3,
+    ):
+        self._client = client
+        self.unknown_after = unknown_after
+        self._missing = {}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.delay = 0.0
+        self.jobs = {}
+        self.add(*job_ids)
+
+    @property
+    def job_ids(self):
+        return list(self.jobs)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_executor()
+        return self._client
+
+    def add(self, *job_ids):
+
+        """
+        Start tracking one or more job ids. None ids, e.g. of a data prep step
+        served from the data prep cache, are ignored.
+        """
+
+        for job_id in job_ids:
+            if job_id is not None:
+                self.jobs.setdefault(job_id, None)
+
+    def remove(self, *job_ids):
+
+        """
+        Stop tracking one or more job ids.
+        """
+
+        for job_id in job_ids:
+            self.jobs.pop(job_id, None)
+
+    def _describe_chunk(self, chunk):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.describe_jobs(jobs=chunk)
+            except Exception as e:
+                if not is_throttling_error(e) or attempt == self.max_retries:
+                    raise
+                self.delay = min(self.max_delay, max(self.base_delay, 2 * self.delay))
+                sleep(self.delay * random.uniform(0.5, 1.0))
+                continue
+            ## Relax the pause between chunks again after a successful call
+            self.delay = self.delay / 2 if self.delay > self.base_delay / 8 else 0.0
+            return response["jobs"]
+
+    def describe(self, job_ids=None):
+
+        """
+        Describe jobs (all tracked jobs by default) and update the snapshot.
+        Returns a dict of job descriptions keyed by job id.
+        """
+
+        job_ids = list(dict.fromkeys(self.job_ids if job_ids is None else job_ids))
+        output = {}
+        for start in range(0, len(job_ids), DESCRIBE_JOBS_LIMIT):
+            if start > 0 and self.delay > 0:
+                sleep(self.delay)
+            for job in self._describe_chunk(
+                job_ids[start : start + DESCRIBE_JOBS_LIMIT]
+            ):
+                output[job["jobId"]] = job
+        self.add(*output)
+        self.jobs.update(output)
+        return output
+
+    def poll(self):
+
+        """
+        Describe all tracked jobs that have not finished yet.
+        Returns only the jobs whose status changed since the last poll.
+        """
+
+        previous = {job_id: self.status(job_id) for job_id in self.job_ids}
+        pending = [
+            job_id
+            for job_id, status in previous.items()
+            if status not in TERMINAL_STATUSES
+        ]
+        described = self.describe(pending)
+        ## A new job may take a moment to show up, so only give up on a job
+        ## after it was missing several times
+        for job_id in pending:
+            if job_id in described:
+                self._missing.pop(job_id, None)
+                continue
+            self._missing[job_id] = self._missing.get(job_id, 0) + 1
+            if self._missing[job_id] >= self.unknown_after:
+                described[job_id] = self.jobs[job_id] = {
+                    "jobId": job_id,
+                    "jobName": None,
+                    "status": UNKNOWN_STATUS,
+                    "statusReason": "Job not found by describe_jobs",
+                }
+        return {
+            job_id: job
+            for job_id, job in described.items()
+            if job["status"] != previous.get(job_id)
+        }
+
+    def status(self, job_id):
+
+        """
+        Return the last known status of a job, or None if it was never described.
+        """
+
+        job = self.jobs.get(job_id)
+        return job["status"] if job else None
+
+    @property
+    def statuses(self):
+        return {job_id: self.status(job_id) for job_id in self.job_ids}
+
+    @property
+    def done(self):
+        return all(self.status(job_id) in TERMINAL_STATUSES for job_id in self.job_ids)
+
+
+class JobWatcher:
+
+    """
+    Follow AWS Batch jobs from asyncio code and report every status change.
+
+    Jobs can be added as job ids, submit_job responses, or the list returned by
+    submit_2_step_job. Both steps of a 2-step job share the same job name, so
+    events can be matched to their pair through JobEvent.job_name. The
+    polling interval starts at min_interval, grows by backoff (with jitter)
+    while nothing changes, and resets once a job changes state. Jobs that
+    Batch does not know end with an UNKNOWN event, see JobTracker.
+    """
+
+    def __init__(
+        self,
+        jobs=(),
+        client=None,
+        min_interval=5.0,
+        max_interval=60.0,
+        backoff=2.0,
+        callbacks=(),
+    ):
+        self.tracker = JobTracker(client=client)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.callbacks = list(callbacks)
+        self.add(*jobs)
+
+    def add(self, *jobs):
+
+        """
+        Start following job ids, submit_job responses, or lists of either.
+        Jobs without an id, like the data prep step of a submit_2_step_job
+        cache hit, are skipped.
+        """
+
+        for job in jobs:
+            if isinstance(job, (list, tuple)):
+                self.add(*job)
+            elif isinstance(job, dict):
+                self.tracker.add(job["jobId"])
+            else:
+                self.tracker.add(job)
+
+    def on_event(self, callback):
+
+        """
+        Register a function or coroutine function to call with every JobEvent.
+        """
+
+        self.callbacks.append(callback)
+        return callback
+
+    async def _poll(self):
+        previous = self.tracker.statuses
+        loop = asyncio.get_running_loop()
+        changed = await loop.run_in_executor(None, self.tracker.poll)
+        return [
+            JobEvent(job_id, job["jobName"], previous.get(job_id), job["status"], job)
+            for job_id, job in changed.items()
+        ]
+
+    async def events(self):
+
+        """
+        Asynchronously iterate over status changes until every job has finished.
+        """
+
+        interval = self.min_interval
+        while True:
+            events = await self._poll()
+            for event in events:
+                for callback in self.callbacks:
+                    result = callback(event)
+                    if inspect.isawaitable(result):
+                        await result
+                yield event
+            if self.tracker.done:
+                return
+            if events:
+                interval = self.min_interval
+            else:
+                interval = min(self.max_interval, interval * self.backoff)
+            await asyncio.sleep(interval * random.uniform(0.5, 1.0))
+
+    async def run(self):
+
+        """
+        Follow all jobs until they finish and return their final statuses.
+        """
+
+        async for _ in self.events():
+            pass
+        return self.tracker.statuses
+
+
+def iter_recent_jobs(job_queues, after=None, hrs_in_past=1, client=None, max_workers=8):
+
+    """
+    Yield the summaries of all jobs created after a timestamp in any of the queues.
+
+    after is in milliseconds since the epoch and defaults to hrs_in_past hours
+    ago. Every page of every queue is fetched, with the queues listed
+    concurrently in a thread pool, and summaries are yielded as pages arrive.
+    """
+
+    client = client or get_executor()
+    if after is None:
+        after = round(time() * 1000) - hrs_in_past * 3600 * 1000
+    pages = queue.Queue()
+
+    def list_queue(job_queue):
+        try:
+            kwargs = {
+                "jobQueue": job_queue,
+                "filters": [{"name": "AFTER_CREATED_AT", "values": [str(after)]}],
+            }
+            while True:
+                response = client.list_jobs(**kwargs)
+                pages.put(response["jobSummaryList"])
+                if not response.get("nextToken"):
+                    break
+                kwargs["nextToken"] = response["nextToken"]
+        finally:
+            pages.put(None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(list_queue, job_queue) for job_queue in job_queues]
+        remaining = len(futures)
+        while remaining:
+            page = pages.get()
+            if page is None:
+                remaining -= 1
+            else:
+                yield from page
+        for future in futures:
+            future.result()
+
+
+class RecentJobs:
+
+    """
+    Incrementally refreshed listing of recent jobs in one or more queues.
+
+    Each refresh only lists jobs created after the newest createdAt seen so
+    far. Summaries are not updated after they were first listed; use
+    JobTracker to follow their status.
+    """
+
+    def __init__(self, job_queues, hrs_in_past=1, client=None, max_workers=8):
+        self.job_queues = list(job_queues)
+        self.client = client
+        self.max_workers = max_workers
+        self.newest = round(time() * 1000) - hrs_in_past * 3600 * 1000
+        self.jobs = {}
+
+    def iter_new_jobs(self):
+
+        """
+        Yield summaries of jobs that were not listed before.
+        """
+
+        ## Step back one millisecond so jobs created in the same millisecond
+        ## as the newest known job are not missed, then drop duplicates.
+        for job in iter_recent_jobs(
+            self.job_queues,
+            after=self.newest - 1,
+            client=self.client,
+            max_workers=self.max_workers,
+        ):
+            if job["jobId"] not in self.jobs:
+                self.jobs[job["jobId"]] = job
+                self.newest = max(self.newest, job["createdAt"])
+                yield job
+
+    def refresh(self):
+
+        """
+        List new jobs and return them.
+        """
+
+        return list(self.iter_new_jobs())
+
+    def to_dataframe(self, refresh=True):
+
+        """
+        Return all listed jobs as a DataFrame, newest first.
+        """
+
+        if refresh:
+            self.refresh()
+        df = pd.DataFrame.from_dict(list(self.jobs.values()))
+        if len(df) > 0:
+            df = df.sort_values(by="createdAt", ascending=False, ignore_index=True)
+        return df
@@ -0,0 +1,144 @@
+"""
+Streaming access to the CloudWatch logs of AWS-RoseTTAFold Batch jobs.
+
+Events are yielded one page at a time, so memory use does not grow with the
+length of a log.
+"""
+
+## Load dependencies
+import re
+from time import sleep
+
+from .executors import LOG_GROUP, get_executor
+from .jobs import JobTracker, TERMINAL_STATUSES
+
+## Matches the "<prefix> <stage> duration: <n> sec" lines written by the
+## container scripts, e.g. "T1078 MSA duration: 512 sec"
+STAGE_DURATION = re.compile(
+    r"^(?P<prefix>\S+) (?P<stage>.+?) duration: (?P<seconds>\d+) sec\s*$"
+)
+
+
+class LogTail:
+
+    """
+    Read position in a single CloudWatch log stream.
+    """
+
+    def __init__(self, log_stream_name, log_group=LOG_GROUP, client=None):
+        self.log_stream_name = log_stream_name
+        self.log_group = log_group
+        self.client = client or get_executor()
+        self.token = None
+        self.at_end = False
+
+    def read(self):
+
+        """
+        Return the next page of events. at_end is set once the stream has no
+        newer events; a running job may still add more later.
+        """
+
+        kwargs = {
+            "logGroupName": self.log_group,
+            "logStreamName": self.log_stream_name,
+            "startFromHead": True,
+        }
+        if self.token:
+            kwargs["nextToken"] = self.token
+        try:
+            response = self.client.get_log_events(**kwargs)
+        except self.client.exceptions.ResourceNotFoundException:
+            ## The stream is created shortly after the container starts
+            self.at_end = True
+            return []
+        token = response["nextForwardToken"]
+        self.at_end = token == self.token or not response["events"]
+        self.token = token
+        return response["events"]
+
+
+def iter_log_events(
+    log_stream_name, follow=False, until=None, poll_interval=5, client=None
+):
+
+    """
+    Yield all events of a log stream, following nextForwardToken.
+
+    With follow=True the stream is tailed until until() returns True
+    (or forever if until is not given), checking for new events every
+    poll_interval seconds.
+    """
+
+    tail = LogTail(log_stream_name, client=client)
+    while True:
+        finished = not follow or (until is not None and until())
+        yield from tail.read()
+        if tail.at_end:
+            if finished:
+                return
+            sleep(poll_interval)
+
+
+def iter_job_logs(job_ids, follow=True, poll_interval=10, tracker=None, client=None):
+
+    """
+    Yield (jobId, event) pairs from the logs of many Batch jobs at once.
+
+    Streams are read one page at a time in turn, so a chatty job does not hold
+    up the others. With follow=True, jobs are followed until they have
+    finished and their logs have been read to the end; otherwise only the
+    events that exist now are returned.
+    """
+
+    ## Data prep steps served from the data prep cache have no job id, and
+    ## fused jobs appear twice in the list of submit_2_step_job
+    job_ids = [job_id for job_id in dict.fromkeys(job_ids) if job_id is not None]
+    tracker = tracker or JobTracker(job_ids)
+    tracker.add(*job_ids)
+    tails, done = {}, set()
+    while len(done) < len(job_ids):
+        tracker.poll()
+        for job_id in job_ids:
+            job = tracker.jobs.get(job_id) or {}
+            stream = job.get("container", {}).get("logStreamName")
+            if stream and job_id not in tails:
+                tails[job_id] = LogTail(stream, client=client)
+            elif not stream and job_id not in done:
+                if not follow or tracker.status(job_id) in TERMINAL_STATUSES:
+                    done.add(job_id)
+
+        waiting = True
+        for job_id, tail in tails.items():
+            if job_id in done:
+                continue
+            finished = not follow or tracker.status(job_id) in TERMINAL_STATUSES
+            for event in tail.read():
+                waiting = False
+                yield job_id, event
+            if tail.at_end and finished:
+                done.add(job_id)
+        if waiting and len(done) < len(job_ids):
+            sleep(poll_interval)
+
+
+def iter_stage_durations(events):
+
+    """
+    Pick the stage duration lines out of a stream of log events.
+
+    Accepts the events of iter_log_events or the (jobId, event) pairs of
+    iter_job_logs, and yields one dict per stage as it is logged.
+    """
+
+    for item in events:
+        job_id, event = item if isinstance(item, tuple) else (None, item)
+        match = STAGE_DURATION.match(event["message"])
+        if match:
+            yield {
+                "jobId": job_id,
+                "prefix": match["prefix"],
+                "stage": match["stage"],
+                "seconds": int(match["seconds"]),
+                "timestamp": event["timestamp"],
+            }
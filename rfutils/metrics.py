@@ -0,0 +1,306 @@
+"""
+Bulk collection of AWS-RoseTTAFold job metrics into a local columnar store.
+
+Every job writes a metrics.yaml file with a DATA_PREP and a PREDICT section.
+harvest_metrics lists these files in a bucket, downloads new or changed ones
+concurrently, flattens them into one typed row per job, and appends the rows
+to a MetricsStore of Parquet or Feather part files.
+"""
+
+## Load dependencies
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import glob
+import os
+import pandas as pd
+import uuid
+import yaml
+
+from .cache import DATA_PREP_CACHE_PREFIX
+from .clients import get_client
+
+METRICS_STORE_DIR = "data/metrics"
+METRICS_FILE_NAME = "metrics.yaml"
+METRICS_SECTIONS = ["DATA_PREP", "PREDICT"]
+
+## Column types of the flattened metrics, by field name. Fields that are not
+## listed are stored as strings, and list values (e.g. per-position
+## statistics) are left out.
+INTEGER_FIELDS = [
+    "LENGTH",
+    "MSA_COUNT",
+    "TEMPLATE_COUNT",
+    "CPU",
+    "MEM",
+    "START_TIME",
+    "MSA_DURATION",
+    "SS_DURATION",
+    "TEMPLATE_DURATION",
+    "TOTAL_DATA_PREP_DURATION",
+    "TOTAL_PREDICT_DURATION",
+    "STAGING_DURATION",
+    "CACHE_HITS",
+    "CACHE_MISSES",
+    "MSA_UNIQUE_COUNT",
+    "MSA_NEFF_ROWS",
+    "MSA_DEPTH_BEFORE",
+    "MSA_DEPTH_AFTER",
+    "CPU_SECONDS",
+    "READ_BYTES",
+    "WRITE_BYTES",
+]
+FLOAT_FIELDS = [
+    "MSA_NEFF_THRESHOLD",
+    "MSA_NEFF",
+    "MSA_NEFF_PER_LENGTH",
+    "MSA_MEAN_POSITION_NEFF",
+    "MSA_MEAN_COVERAGE",
+    "PEAK_MEM",
+]
+
+
+def flatten_metrics(metrics):
+
+    """
+    Flatten the sections of a parsed metrics.yaml into one dict, with keys
+    like DATA_PREP_LENGTH and PREDICT_TOTAL_PREDICT_DURATION.
+    """
+
+    row = {}
+    for section in METRICS_SECTIONS:
+        for field, value in ((metrics or {}).get(section) or {}).items():
+            if not isinstance(value, (list, dict)):
+                row[f"{section}_{field}"] = value
+    return row
+
+
+def metrics_dataframe(rows):
+
+    """
+    Build a typed DataFrame from flattened metrics rows.
+    """
+
+    df = pd.DataFrame.from_records(rows)
+    for column in df.columns:
+        field = None
+        for section in METRICS_SECTIONS:
+            if column.startswith(f"{section}_"):
+                field = column[len(section) + 1 :]
+        if field in INTEGER_FIELDS:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("Int64")
+        elif field in FLOAT_FIELDS:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("float64")
+        elif column not in ["etag", "last_modified", "harvested_at"]:
+            df[column] = df[column].astype("string")
+    return df
+
+
+def list_metrics_files(
+    bucket, prefix="", client=None, exclude=(DATA_PREP_CACHE_PREFIX,)
+):
+
+    """
+    Yield the key, ETag and last modified time of every metrics.yaml file
+    under a prefix, skipping folders that start with one of exclude.
+    """
+
+    client = client or get_client("s3")
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if os.path.basename(key) != METRICS_FILE_NAME:
+                continue
+            if any(key.startswith(f"{folder}/") for folder in exclude):
+                continue
+            yield {
+                "key": key,
+                "etag": obj["ETag"].strip('"'),
+                "last_modified": obj["LastModified"],
+            }
+
+
+class MetricsStore:
+
+    """
+    Local, append-only store of harvested job metrics.
+
+    Each append writes a new part file to the store folder, in Parquet or
+    Feather format (both need pyarrow). read() combines the parts and keeps
+    the latest row of every metrics file.
+    """
+
+    def __init__(self, path=METRICS_STORE_DIR, format="parquet"):
+        if format not in ["parquet", "feather"]:
+            raise ValueError(f"Unsupported metrics store format {format}")
+        self.path = path
+        self.format = format
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, f"part-*.{self.format}")))
+
+    def _read_part(self, path):
+        if self.format == "parquet":
+            return pd.read_parquet(path)
+        return pd.read_feather(path)
+
+    def read(self):
+
+        """
+        Return all harvested metrics as a DataFrame with one row per job.
+        """
+
+        parts = [self._read_part(path) for path in self.parts()]
+        if not parts:
+            return pd.DataFrame()
+        df = pd.concat(parts, ignore_index=True)
+        df = df.sort_values("harvested_at", kind="stable")
+        df = df.drop_duplicates(subset="key", keep="last")
+        return df.sort_values("key", ignore_index=True)
+
+    def harvested(self):
+
+        """
+        Return the ETag of every metrics file in the store, keyed by S3 key.
+        """
+
+        df = self.read()
+        if len(df) == 0:
+            return {}
+        return dict(zip(df["key"], df["etag"]))
+
+    def append(self, df):
+
+        """
+        Write a DataFrame of new rows as a new part file.
+        """
+
+        if len(df) == 0:
+            return None
+        os.makedirs(self.path, exist_ok=True)
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+        path = os.path.join(
+            self.path, f"part-{timestamp}-{uuid.uuid4().hex[:8]}.{self.format}"
+        )
+        df = df.reset_index(drop=True)
+        if self.format == "parquet":
+            df.to_parquet(path, index=False)
+        else:
+            df.to_feather(path)
+        return path
+
+    def compact(self):
+
+        """
+        Replace all part files with a single one holding the current rows.
+        """
+
+        parts = self.parts()
+        if len(parts) > 1:
+            self.append(self.read())
+            for path in parts:
+                os.remove(path)
+
+
+def _fetch_metrics(client, bucket, item):
+    body = client.get_object(Bucket=bucket, Key=item["key"])["Body"].read()
+    try:
+        metrics = yaml.safe_load(body)
+    except yaml.YAMLError:
+        metrics = None
+    row = {
+        "key": item["key"],
+        "job_name": os.path.dirname(item["key"]),
+        "etag": item["etag"],
+        "last_modified": item["last_modified"],
+    }
+    row.update(flatten_metrics(metrics if isinstance(metrics, dict) else None))
+    return row
+
+
+def harvest_metrics(
+    bucket,
+    store=None,
+    prefix="",
+    max_workers=32,
+    batch_size=1000,
+    client=None,
+):
+
+    """
+    Download new and changed metrics.yaml files and append them to a store.
+
+    Files whose ETag is already in the store are skipped, so repeated runs
+    only fetch jobs that finished (or moved from data prep to predict) since
+    the last run. Files are fetched with max_workers threads and written to
+    the store every batch_size files. Returns the number of files harvested.
+    """
+
+    store = store or MetricsStore()
+    client = client or get_client("s3")
+    harvested = store.harvested()
+    pending = [
+        item
+        for item in list_metrics_files(bucket, prefix, client)
+        if harvested.get(item["key"]) != item["etag"]
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start : start + batch_size]
+            rows = list(
+                executor.map(lambda item: _fetch_metrics(client, bucket, item), batch)
+            )
+            df = metrics_dataframe(rows)
+            df["harvested_at"] = pd.Timestamp.now(tz="UTC")
+            store.append(df)
+    return len(pending)
+
+
+def run_mode_summary(metrics, length_bins=(0, 100, 200, 400, 800, 1600)):
+
+    """
+    Compare fused and split runs (PREDICT_MODE, split for jobs that predate
+    it) in a DataFrame of harvested metrics. For every mode and sequence
+    length bin, returns the job count and the median seconds from the start
+    of data prep to the end of prediction, of the data prep step, and
+    between the end of data prep and the start of the prediction itself
+    (queueing, container start and input transfers).
+    """
+
+    def column(name):
+        if name in metrics:
+            return pd.to_numeric(metrics[name], errors="coerce")
+        return pd.Series(float("nan"), index=metrics.index)
+
+    data_prep_start = column("DATA_PREP_START_TIME")
+    data_prep_seconds = column("DATA_PREP_TOTAL_DATA_PREP_DURATION")
+    predict_start = column("PREDICT_START_TIME")
+    df = pd.DataFrame(
+        {
+            "mode": (
+                metrics["PREDICT_MODE"].fillna("split")
+                if "PREDICT_MODE" in metrics
+                else "split"
+            ),
+            "length": pd.cut(
+                column("DATA_PREP_LENGTH"), list(length_bins) + [float("inf")]
+            ),
+            "total_seconds": (
+                predict_start
+                + column("PREDICT_TOTAL_PREDICT_DURATION")
+                - data_prep_start
+            ),
+            "data_prep_seconds": data_prep_seconds,
+            "handoff_seconds": predict_start - data_prep_start - data_prep_seconds,
+        },
+        index=metrics.index,
+    )
+    df = df.dropna(subset=["total_seconds"])
+    summary = df.groupby(["mode", "length"], observed=True).agg(
+        jobs=("total_seconds", "size"),
+        total_seconds=("total_seconds", "median"),
+        data_prep_seconds=("data_prep_seconds", "median"),
+        handoff_seconds=("handoff_seconds", "median"),
+    )
+    return summary.reset_index()
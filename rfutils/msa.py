@@ -0,0 +1,544 @@
+"""
+Multiple sequence alignment helpers for AWS-RoseTTAFold.
+
+This module only depends on NumPy so that it can also run inside the
+RoseTTAFold container.
+"""
+
+## Load dependencies
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import io
+import numpy as np
+import os
+import re
+import string
+
+A3M_ALPHABET = b"ARNDCQEGHILKMFPSTWYV-"
+GAP = 20
+## Rows weighted by the stats command, which runs in every data prep job
+NEFF_MAX_ROWS = 10000
+
+## Every byte maps to its alphabet index, unknown characters are treated as gaps.
+## Header lines are collapsed to a single ">" which marks the start of a record.
+_A3M_RECORD = 255
+_A3M_TABLE = bytearray([GAP]) * 256
+for _i, _c in enumerate(A3M_ALPHABET):
+    _A3M_TABLE[_c] = _i
+_A3M_TABLE[ord(">")] = _A3M_RECORD
+_A3M_TABLE = bytes(_A3M_TABLE)
+
+## Insertions (lower case) and whitespace are dropped
+_A3M_DELETE = (string.ascii_lowercase + string.whitespace).encode()
+_A3M_HEADER = re.compile(rb"^>[^\n]*", re.M)
+
+
+def _open_a3m(source):
+
+    """
+    Return a binary handle, an initial buffer size, and whether to close the handle.
+    """
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source), len(source), True
+    if isinstance(source, (str, os.PathLike)):
+        if os.fspath(source).endswith(".gz"):
+            return gzip.open(source, "rb"), 1 << 24, True
+        return open(source, "rb"), os.path.getsize(source), True
+    try:
+        size = os.fstat(source.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        size = 1 << 24
+    return source, size, False
+
+
+def parse_a3m(source, max_seqs=None, chunk_size=1 << 24):
+
+    """
+    Read A3M and convert letters into integers in the 0..20 range.
+
+    The input can be a file path (optionally gzipped), a binary or text file
+    object, or bytes. It is read in chunks of chunk_size bytes and every byte
+    goes through a single lookup table into a preallocated uint8 buffer. Set
+    max_seqs to stop after the first max_seqs sequences (at least 1).
+    Based on https://github.com/RosettaCommons/RoseTTAFold/blob/main/network/parsers.py
+    """
+
+    if max_seqs is not None and max_seqs < 1:
+        raise ValueError(f"max_seqs must be at least 1, got {max_seqs}")
+    handle, size, close = _open_a3m(source)
+    buf = np.empty(max(size, 1), dtype=np.uint8)
+    n_codes, n_seqs, length, pending = 0, 0, None, 0
+    carry = b""
+    try:
+        done = False
+        while not done:
+            chunk = handle.read(chunk_size)
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = carry + chunk
+            if chunk:
+                cut = data.rfind(b"\n") + 1
+                data, carry = data[:cut], data[cut:]
+            else:
+                carry, done = b"", True
+            codes = np.frombuffer(
+                _A3M_HEADER.sub(b">", data).translate(_A3M_TABLE, _A3M_DELETE),
+                dtype=np.uint8,
+            )
+            starts = np.flatnonzero(codes == _A3M_RECORD)
+            if n_seqs == 0:
+                ## Skip anything before the first header
+                first = starts[0] if len(starts) > 0 else len(codes)
+                codes, starts = codes[first:], starts - first
+            if max_seqs is not None and n_seqs + len(starts) > max_seqs:
+                codes = codes[: starts[max_seqs - n_seqs]]
+                starts = starts[: max_seqs - n_seqs]
+                done = True
+            if len(starts) == 0:
+                pending += len(codes)
+            else:
+                ## Residue counts of the records that end in this chunk
+                lengths = np.diff(starts) - 1
+                if n_seqs > 0:
+                    lengths = np.concatenate([[pending + starts[0]], lengths])
+                if length is None and len(lengths) > 0:
+                    length = int(lengths[0])
+                if np.any(lengths != length):
+                    raise ValueError(
+                        f"A3M sequences do not all have the query length of {length} columns"
+                    )
+                pending = len(codes) - starts[-1] - 1
+                codes = np.delete(codes, starts)
+            if n_codes + len(codes) > buf.size:
+                grown = np.empty(max(2 * buf.size, n_codes + len(codes)), np.uint8)
+                grown[:n_codes] = buf[:n_codes]
+                buf = grown
+            buf[n_codes : n_codes + len(codes)] = codes
+            n_codes += len(codes)
+            n_seqs += len(starts)
+    finally:
+        if close:
+            handle.close()
+
+    if n_seqs == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    if length is None:
+        length = pending
+    if pending != length:
+        raise ValueError(
+            f"A3M sequences do not all have the query length of {length} columns"
+        )
+    buf.resize(n_codes, refcheck=False)
+    return buf.reshape(n_seqs, length)
+
+
+def unique_row_indices(msa, chunk_size=4096, seed=0, return_inverse=False):
+
+    """
+    Return the indices of the first occurrence of every distinct row, in order.
+
+    Rows are hashed to 64-bit values with random weights, a chunk of rows at a
+    time, so only the hashes are sorted instead of the whole rows. With
+    return_inverse=True, also return the position of every row in the output.
+    """
+
+    weights = np.random.default_rng(seed).integers(
+        1, np.iinfo(np.uint64).max, msa.shape[1], dtype=np.uint64, endpoint=True
+    )
+    hashes = np.empty(len(msa), dtype=np.uint64)
+    for start in range(0, len(msa), chunk_size):
+        chunk = msa[start : start + chunk_size].astype(np.uint64)
+        hashes[start : start + chunk_size] = chunk @ weights
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    order = first.argsort()
+    if not return_inverse:
+        return first[order]
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)]
+
+
+def identity_to_query(msa, rows=None, chunk_size=4096):
+
+    """
+    Return the fraction of columns of each row that match the first row.
+    rows optionally selects the rows to compare, e.g. from unique_row_indices.
+    """
+
+    rows = np.arange(len(msa)) if rows is None else np.asarray(rows)
+    seqid = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), chunk_size):
+        chunk = msa[rows[start : start + chunk_size]]
+        seqid[start : start + chunk_size] = (chunk == msa[0]).mean(-1)
+    return seqid
+
+
+def coverage_image(msa, max_rows=1000, chunk_size=4096):
+
+    """
+    Summarize an MSA for plotting sequence coverage.
+
+    Distinct rows are sorted by identity to the query and binned into at most
+    max_rows image rows. Each pixel is the mean identity of the non-gap
+    residues in its bin, or NaN if the bin only has gaps in that column.
+    Returns the image, the number of non-gap residues per column, and the
+    number of distinct rows.
+    """
+
+    rows = unique_row_indices(msa, chunk_size)
+    seqid = identity_to_query(msa, rows, chunk_size)
+    order = seqid.argsort(kind="stable")
+    rows, seqid = rows[order], seqid[order]
+
+    n_bins = min(len(rows), max_rows)
+    edges = np.linspace(0, len(rows), n_bins + 1).astype(int)
+    image = np.empty((n_bins, msa.shape[1]), dtype=np.float32)
+    coverage = np.zeros(msa.shape[1], dtype=np.int64)
+    for b in range(n_bins):
+        weighted = np.zeros(msa.shape[1])
+        counts = np.zeros(msa.shape[1], dtype=np.int64)
+        for start in range(edges[b], edges[b + 1], chunk_size):
+            end = min(start + chunk_size, edges[b + 1])
+            non_gaps = msa[rows[start:end]] != GAP
+            weighted += seqid[start:end] @ non_gaps
+            counts += non_gaps.sum(0)
+        coverage += counts
+        with np.errstate(invalid="ignore", divide="ignore"):
+            image[b] = np.where(counts > 0, weighted / counts, np.nan)
+    return image, coverage, len(rows)
+
+
+def _one_hot(rows):
+
+    """
+    Encode a block of rows as a (rows, 21 * columns) float32 indicator matrix,
+    so that the dot product of two encoded rows counts their identical columns.
+    """
+
+    n_states = len(A3M_ALPHABET)
+    encoded = np.zeros((len(rows), rows.shape[1] * n_states), dtype=np.float32)
+    offsets = np.arange(rows.shape[1]) * n_states
+    encoded[np.arange(len(rows))[:, None], rows + offsets] = 1
+    return encoded
+
+
+## Rows and multiplicities shared with the worker processes of sequence_weights
+_worker_args = None
+
+
+def _init_worker(msa, counts):
+    global _worker_args
+    _worker_args = msa, counts
+
+
+def _block_neighbours(start, min_matches, block_size, msa=None, counts=None):
+
+    """
+    Count the neighbours of rows start:start + block_size and add the
+    symmetric counts for all later rows. Returns the partial neighbour counts
+    of every row.
+    """
+
+    if msa is None:
+        msa, counts = _worker_args
+    neighbours = np.zeros(len(msa))
+    end = min(start + block_size, len(msa))
+    block = _one_hot(msa[start:end])
+    for other in range(start, len(msa), block_size):
+        other_end = min(other + block_size, len(msa))
+        similar = block @ _one_hot(msa[other:other_end]).T >= min_matches
+        neighbours[start:end] += similar @ counts[other:other_end]
+        if other != start:
+            neighbours[other:other_end] += counts[start:end] @ similar
+    return neighbours
+
+
+def sequence_weights(msa, threshold=0.8, block_size=2048, max_workers=None):
+
+    """
+    Return the weight of every row: one over the number of rows (itself
+    included) that share at least threshold of their columns with it.
+
+    Identical rows are collapsed first. Pairwise identities are computed
+    block by block as matrix products of one-hot encoded rows, using each
+    pair of blocks once. With max_workers, row blocks are spread over a
+    process pool.
+    """
+
+    rows, inverse = unique_row_indices(msa, return_inverse=True)
+    counts = np.bincount(inverse).astype(np.float64)
+    unique = msa[rows]
+    min_matches = np.ceil(threshold * msa.shape[1] - 1e-6)
+    starts = range(0, len(unique), block_size)
+
+    if max_workers is None or max_workers < 2 or len(starts) < 2:
+        neighbours = sum(
+            _block_neighbours(start, min_matches, block_size, unique, counts)
+            for start in starts
+        )
+    else:
+        with ProcessPoolExecutor(
+            max_workers, initializer=_init_worker, initargs=(unique, counts)
+        ) as executor:
+            neighbours = sum(
+                executor.map(
+                    _block_neighbours,
+                    starts,
+                    [min_matches] * len(starts),
+                    [block_size] * len(starts),
+                )
+            )
+    return 1 / np.asarray(neighbours)[inverse]
+
+
+def msa_statistics(
+    msa,
+    threshold=0.8,
+    block_size=2048,
+    max_workers=None,
+    chunk_size=4096,
+    max_rows=None,
+):
+
+    """
+    Return depth statistics of an MSA from parse_a3m.
+
+    The dict holds the number of rows and distinct rows, the sequence
+    weights at the given identity threshold, Neff (the sum of the weights),
+    and per column the Neff of the rows without a gap there and the number
+    of such rows (coverage). Sequence weights take time quadratic in the
+    number of rows, so with max_rows only the first max_rows rows (the best
+    hits in HHblits output) are weighted; the row counts and coverage still
+    cover the whole MSA.
+    """
+
+    weighted = msa if not max_rows else msa[:max_rows]
+    weights = sequence_weights(weighted, threshold, block_size, max_workers)
+    position_neff = np.zeros(msa.shape[1])
+    coverage = np.zeros(msa.shape[1], dtype=np.int64)
+    for start in range(0, len(msa), chunk_size):
+        non_gaps = msa[start : start + chunk_size] != GAP
+        n_weighted = max(0, min(chunk_size, len(weighted) - start))
+        position_neff += weights[start : start + n_weighted] @ non_gaps[:n_weighted]
+        coverage += non_gaps.sum(0)
+    return {
+        "n_seqs": len(msa),
+        "n_unique": len(unique_row_indices(msa, chunk_size)),
+        "n_weighted": len(weighted),
+        "threshold": threshold,
+        "weights": weights,
+        "neff": float(weights.sum()),
+        "position_neff": position_neff,
+        "coverage": coverage,
+    }
+
+
+def format_msa_metrics(stats):
+
+    """
+    Format msa_statistics output as the MSA_* lines of metrics.yaml.
+    """
+
+    def values(array, decimals=None):
+        return "[" + ", ".join(str(round(x.item(), decimals)) for x in array) + "]"
+
+    length = max(len(stats["coverage"]), 1)
+    return [
+        f"MSA_UNIQUE_COUNT: {stats['n_unique']}",
+        f"MSA_NEFF_THRESHOLD: {stats['threshold']}",
+        f"MSA_NEFF_ROWS: {stats['n_weighted']}",
+        f"MSA_NEFF: {stats['neff']:.1f}",
+        f"MSA_NEFF_PER_LENGTH: {stats['neff'] / length ** 0.5:.2f}",
+        f"MSA_MEAN_POSITION_NEFF: {stats['position_neff'].mean():.1f}",
+        f"MSA_MEAN_COVERAGE: {stats['coverage'].mean() / max(stats['n_seqs'], 1):.3f}",
+        f"MSA_POSITION_NEFF: {values(stats['position_neff'], 1)}",
+        f"MSA_POSITION_COVERAGE: {values(stats['coverage'])}",
+    ]
+
+
+def _identity_counts(msa, rows, others, block_size):
+
+    """
+    Yield (start, matches) with the identical column counts between
+    rows[start:start + block_size] and every row in others.
+    """
+
+    for start in range(0, len(rows), block_size):
+        block = _one_hot(msa[rows[start : start + block_size]])
+        matches = np.empty((len(block), len(others)), dtype=np.float32)
+        for other in range(0, len(others), block_size):
+            encoded = _one_hot(msa[others[other : other + block_size]])
+            matches[:, other : other + block_size] = block @ encoded.T
+        yield start, matches
+
+
+def filter_msa(
+    msa, max_identity=0.9, min_coverage=0.5, max_depth=None, block_size=2048
+):
+
+    """
+    Select rows of an MSA from parse_a3m, similar to hhfilter.
+
+    1. Rows that cover less than min_coverage of the query residues are dropped.
+    2. Rows are kept in order unless they share more than max_identity of
+       their columns with a row kept before them.
+    3. If more than max_depth rows remain, a diverse subset is picked
+       farthest-first: starting from the query, the rows least identical to
+       all rows picked so far are added in rounds of max_depth // 64.
+
+    The query is always kept. Returns the sorted indices of the kept rows.
+    """
+
+    query_residues = msa[0] != GAP
+    covered = np.empty(len(msa), dtype=np.int64)
+    for start in range(0, len(msa), block_size):
+        rows = msa[start : start + block_size]
+        covered[start : start + block_size] = ((rows != GAP) & query_residues).sum(1)
+    candidates = np.flatnonzero(covered >= min_coverage * query_residues.sum())
+    candidates = np.concatenate([[0], candidates[candidates != 0]])
+
+    ## Greedy redundancy filter, one block of candidates at a time
+    max_matches = np.floor(max_identity * msa.shape[1] + 1e-6)
+    kept = np.zeros(0, dtype=np.int64)
+    for start in range(0, len(candidates), block_size):
+        block = candidates[start : start + block_size]
+        if len(kept) > 0:
+            _, matches = next(_identity_counts(msa, block, kept, len(block)))
+            block = block[(matches <= max_matches).all(1)]
+        encoded = _one_hot(msa[block])
+        similar = encoded @ encoded.T > max_matches
+        keep = np.zeros(len(block), dtype=bool)
+        for i in range(len(block)):
+            keep[i] = not np.any(similar[i, :i] & keep[:i])
+        kept = np.concatenate([kept, block[keep]])
+
+    if max_depth is None or len(kept) <= max_depth:
+        return kept
+
+    ## Farthest-first subsample, tracking the highest identity of every
+    ## remaining row to the picked rows
+    picked = np.zeros(len(kept), dtype=bool)
+    picked[0] = True
+    nearest = np.zeros(len(kept), dtype=np.float32)
+    new = np.array([0])
+    batch = max(1, max_depth // 64)
+    while picked.sum() < max_depth:
+        for start, matches in _identity_counts(msa, kept, kept[new], block_size):
+            end = start + len(matches)
+            nearest[start:end] = np.maximum(nearest[start:end], matches.max(1))
+        nearest[picked] = np.inf
+        n_new = min(batch, max_depth - picked.sum())
+        new = np.argpartition(nearest, n_new - 1)[:n_new]
+        picked[new] = True
+    return kept[picked]
+
+
+def write_a3m_records(source, path, rows):
+
+    """
+    Copy the records with the given indices from an A3M source to path,
+    keeping their headers and insertions unchanged.
+    """
+
+    rows = set(int(row) for row in rows)
+    handle, _, close = _open_a3m(source)
+    try:
+        with open(path, "wb") as out:
+            record = -1
+            for line in handle:
+                if isinstance(line, str):
+                    line = line.encode()
+                if line.startswith(b">"):
+                    record += 1
+                if record in rows:
+                    out.write(line)
+    finally:
+        if close:
+            handle.close()
+
+
+def reduce_a3m(
+    source,
+    path,
+    max_identity=0.9,
+    min_coverage=0.5,
+    max_depth=5000,
+    block_size=2048,
+):
+
+    """
+    Write a reduced copy of an A3M file for prediction, see filter_msa.
+    Returns the number of sequences before and after the reduction.
+    """
+
+    msa = parse_a3m(source)
+    rows = filter_msa(msa, max_identity, min_coverage, max_depth, block_size)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    write_a3m_records(source, path, rows)
+    return {"depth_before": len(msa), "depth_after": len(rows)}
+
+
+def main(argv=None):
+
+    """
+    Command line entry point, e.g. python -m rfutils.msa stats t000_.msa0.a3m
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m rfutils.msa")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    stats_parser = commands.add_parser(
+        "stats", help="Print MSA depth statistics as metrics.yaml lines"
+    )
+    stats_parser.add_argument("a3m", help="Path to the A3M file")
+    stats_parser.add_argument("--threshold", type=float, default=0.8)
+    stats_parser.add_argument("--workers", type=int, default=None)
+    stats_parser.add_argument(
+        "--max-rows",
+        type=int,
+        default=NEFF_MAX_ROWS,
+        help="Rows to compute sequence weights for, 0 for all",
+    )
+    stats_parser.add_argument(
+        "--indent", type=int, default=0, help="Spaces to prefix every line with"
+    )
+
+    reduce_parser = commands.add_parser(
+        "reduce", help="Write a reduced A3M and print its depth as metrics.yaml lines"
+    )
+    reduce_parser.add_argument("a3m", help="Path to the A3M file")
+    reduce_parser.add_argument("output", help="Path to write the reduced A3M to")
+    reduce_parser.add_argument("--max-identity", type=float, default=0.9)
+    reduce_parser.add_argument("--min-coverage", type=float, default=0.5)
+    reduce_parser.add_argument("--max-depth", type=int, default=5000)
+    reduce_parser.add_argument(
+        "--indent", type=int, default=0, help="Spaces to prefix every line with"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "stats":
+        stats = msa_statistics(
+            parse_a3m(args.a3m),
+            args.threshold,
+            max_workers=args.workers,
+            max_rows=args.max_rows,
+        )
+        for line in format_msa_metrics(stats):
+            print(" " * args.indent + line)
+    elif args.command == "reduce":
+        depths = reduce_a3m(
+            args.a3m,
+            args.output,
+            args.max_identity,
+            args.min_coverage,
+            args.max_depth,
+        )
+        print(" " * args.indent + f"MSA_DEPTH_BEFORE: {depths['depth_before']}")
+        print(" " * args.indent + f"MSA_DEPTH_AFTER: {depths['depth_after']}")
+
+
+if __name__ == "__main__":
+    main()
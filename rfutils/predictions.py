@@ -0,0 +1,283 @@
+"""
+Lazy access to the t000_.e2e.npz outputs of RoseTTAFold predictions.
+
+The NPZ file holds the L x L x bins distance ("dist") and orientation
+("omega", "theta", "phi") distributions. Arrays are opened one member at a
+time: stored members of local files are memory-mapped, and compressed
+members are decompressed in blocks of rows, so derived products can be
+computed without holding a full distribution in memory.
+"""
+
+## Load dependencies
+import io
+import numpy as np
+import os
+import pandas as pd
+import struct
+import zipfile
+
+from .cache import get_local_cache
+from .clients import get_client
+
+## The distance distribution has one bin for "no contact" (beyond DIST_MAX)
+## followed by DIST_BINS bins of equal width between DIST_MIN and DIST_MAX.
+DIST_MIN = 2.0
+DIST_MAX = 20.0
+DIST_BINS = 36
+DIST_EDGES = np.linspace(DIST_MIN, DIST_MAX, DIST_BINS + 1)
+DIST_CENTERS = (DIST_EDGES[:-1] + DIST_EDGES[1:]) / 2
+
+RANGE_BLOCK_SIZE = 8 * 1024**2
+
+
+class S3RangeFile(io.RawIOBase):
+
+    """
+    Read-only, seekable file object over an S3 object, using ranged GETs.
+    Wrap it in io.BufferedReader (see open_s3_file) to read ahead in blocks.
+    """
+
+    def __init__(self, bucket, key, client=None):
+        self.bucket = bucket
+        self.key = key
+        self.client = client or get_client("s3")
+        self.size = self.client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        response = self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f"bytes={self.position}-{end - 1}",
+        )
+        data = response["Body"].read()
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def open_s3_file(bucket, key, client=None, block_size=RANGE_BLOCK_SIZE):
+
+    """
+    Open an S3 object for reading with ranged GETs of block_size bytes.
+    """
+
+    return io.BufferedReader(S3RangeFile(bucket, key, client), block_size)
+
+
+class LazyNpz:
+
+    """
+    Open the arrays of an NPZ file on demand.
+
+    source is a local path or a seekable binary file object, e.g. from
+    open_s3_file. Use npz[name] for a whole array, memory-mapped if possible,
+    or iter_blocks to go through a large array a block of rows at a time.
+    """
+
+    def __init__(self, source):
+        self.path = source if isinstance(source, (str, os.PathLike)) else None
+        self.zip = zipfile.ZipFile(source)
+        self.files = [
+            name[: -len(".npy")]
+            for name in self.zip.namelist()
+            if name.endswith(".npy")
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def _read_header(self, handle):
+        version = np.lib.format.read_magic(handle)
+        if version == (1, 0):
+            return np.lib.format.read_array_header_1_0(handle)
+        return np.lib.format.read_array_header_2_0(handle)
+
+    def header(self, name):
+
+        """
+        Return the (shape, fortran_order, dtype) of an array without reading it.
+        """
+
+        with self.zip.open(f"{name}.npy") as handle:
+            return self._read_header(handle)
+
+    def _data_offset(self, name):
+
+        """
+        Return the file offset of the array data of a stored member, or None
+        if the member is compressed.
+        """
+
+        info = self.zip.getinfo(f"{name}.npy")
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+        with open(self.path, "rb") as handle:
+            handle.seek(info.header_offset)
+            local_header = handle.read(30)
+            name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+            handle.seek(info.header_offset + 30 + name_length + extra_length)
+            self._read_header(handle)
+            return handle.tell()
+
+    def __getitem__(self, name):
+        shape, fortran_order, dtype = self.header(name)
+        offset = self._data_offset(name) if self.path else None
+        if offset is not None:
+            return np.memmap(
+                self.path,
+                dtype=dtype,
+                mode="r",
+                offset=offset,
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+        with self.zip.open(f"{name}.npy") as handle:
+            return np.lib.format.read_array(handle)
+
+    def iter_blocks(self, name, block_rows=64):
+
+        """
+        Yield (start, block) pairs covering an array of shape (..., L, L, bins)
+        in blocks of block_rows rows of shape (L, bins). Leading dimensions
+        of size one, like the batch dimension, are dropped.
+        """
+
+        shape, fortran_order, dtype = self.header(name)
+        rows = int(np.prod(shape[:-2], dtype=np.int64))
+        row_shape = shape[-2:]
+        if fortran_order:
+            array = self[name].reshape(rows, *row_shape)
+            for start in range(0, rows, block_rows):
+                yield start, np.ascontiguousarray(array[start : start + block_rows])
+            return
+
+        row_bytes = int(np.prod(row_shape, dtype=np.int64)) * dtype.itemsize
+        with self.zip.open(f"{name}.npy") as handle:
+            self._read_header(handle)
+            for start in range(0, rows, block_rows):
+                n = min(block_rows, rows - start)
+                buffer = bytearray(n * row_bytes)
+                view, read = memoryview(buffer), 0
+                while read < len(buffer):
+                    count = handle.readinto(view[read:])
+                    if not count:
+                        raise ValueError(f"{name}.npy ends after {start} rows")
+                    read += count
+                yield start, np.frombuffer(buffer, dtype=dtype).reshape(n, *row_shape)
+
+
+def open_prediction_npz(bucket, key, download=True, client=None):
+
+    """
+    Open a prediction NPZ file in S3.
+
+    With download=True the file goes through the local download cache, so
+    stored arrays can be memory-mapped. Otherwise it is read in place with
+    ranged GETs, which only transfers the members that are used.
+    """
+
+    if download:
+        return LazyNpz(get_local_cache().get(bucket, key, client=client))
+    return LazyNpz(open_s3_file(bucket, key, client))
+
+
+def contact_probabilities(npz, max_distance=8.0, block_rows=64):
+
+    """
+    Return the L x L probability that residues are closer than max_distance.
+    """
+
+    upper = np.searchsorted(DIST_EDGES, max_distance, side="right")
+    contacts = None
+    for start, block in npz.iter_blocks("dist", block_rows):
+        if contacts is None:
+            contacts = np.empty((block.shape[1], block.shape[1]), dtype=np.float32)
+        contacts[start : start + len(block)] = block[..., 1:upper].sum(
+            -1, dtype=np.float32
+        )
+    return contacts
+
+
+def expected_distances(npz, no_contact_distance=DIST_MAX, block_rows=64):
+
+    """
+    Return the L x L expected distances, counting the no contact bin as
+    no_contact_distance.
+    """
+
+    centers = np.concatenate([[no_contact_distance], DIST_CENTERS]).astype(np.float32)
+    distances = None
+    for start, block in npz.iter_blocks("dist", block_rows):
+        if distances is None:
+            distances = np.empty((block.shape[1], block.shape[1]), dtype=np.float32)
+        block = block.astype(np.float32)
+        distances[start : start + len(block)] = (block @ centers) / block.sum(-1)
+    return distances
+
+
+def residue_confidence(npz, max_distance=8.0, block_rows=64):
+
+    """
+    Summarize the distance distribution of every residue.
+
+    Returns a DataFrame with one row per residue: the expected number of
+    contacts within max_distance, and the mean peak probability and mean
+    entropy (in nats) of its distance distributions to the other residues.
+    Sharper distributions, with higher peaks and lower entropy, indicate
+    higher confidence.
+    """
+
+    upper = np.searchsorted(DIST_EDGES, max_distance, side="right")
+    columns = {"contacts": [], "max_probability": [], "entropy": []}
+    for start, block in npz.iter_blocks("dist", block_rows):
+        block = block.astype(np.float32)
+        index = np.arange(len(block))
+        off_diagonal = np.ones(block.shape[:2], dtype=bool)
+        off_diagonal[index, start + index] = False
+        n_other = max(block.shape[1] - 1, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            entropy = -np.where(block > 0, block * np.log(block), 0).sum(-1)
+        columns["contacts"].append(
+            (block[..., 1:upper].sum(-1) * off_diagonal).sum(-1)
+        )
+        columns["max_probability"].append(
+            (block.max(-1) * off_diagonal).sum(-1) / n_other
+        )
+        columns["entropy"].append((entropy * off_diagonal).sum(-1) / n_other)
+
+    df = pd.DataFrame(
+        {name: np.concatenate(values) for name, values in columns.items()}
+    )
+    df.insert(0, "residue", np.arange(1, len(df) + 1))
+    return df
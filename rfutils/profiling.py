@@ -0,0 +1,244 @@
+"""
+Per-stage resource profiling for the AWS-RoseTTAFold container scripts.
+
+Every profiled stage appends one JSON line to a profile file with its wall
+time, CPU time, peak RSS, bytes read and written, and peak GPU memory where
+available. This module only uses the standard library, so it runs with any
+Python in the container:
+
+    python -m rfutils.profiling run --stage hhblits --output p.jsonl -- make_msa.sh ...
+    python -m rfutils.profiling python --output p.jsonl -- predict_e2e.py ...
+    python -m rfutils.profiling summary p.jsonl
+"""
+
+## Load dependencies
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import resource
+import runpy
+import subprocess
+import sys
+import time
+
+## Stages of predict_e2e.py, keyed by the names of the Predictor methods
+PREDICTOR_STAGES = {"__init__": "model_load", "predict": "inference"}
+
+
+def _io_counters():
+
+    """
+    Return the bytes passed through read and write calls by this process and
+    the children it has waited for, or None where /proc is not available.
+    """
+
+    try:
+        with open("/proc/self/io") as handle:
+            fields = dict(line.split(": ") for line in handle.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def _gpu_memory():
+
+    """
+    Return the torch module if it is loaded and has a GPU, to read its peak
+    memory statistics.
+    """
+
+    torch = sys.modules.get("torch")
+    try:
+        if torch is not None and torch.cuda.is_available():
+            return torch
+    except Exception:
+        pass
+    return None
+
+
+def _write_record(output, record):
+    with open(output, "a") as handle:
+        handle.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def profile_stage(stage, output, job_id=None, scope=resource.RUSAGE_SELF, **extra):
+
+    """
+    Profile the code in a with block as one stage and append its record.
+
+    scope is resource.RUSAGE_SELF for work done in this process, or
+    resource.RUSAGE_CHILDREN for subprocesses. Peak RSS in RUSAGE_SELF scope is
+    the peak of the whole process so far, since Linux cannot reset it.
+    """
+
+    torch = _gpu_memory()
+    if torch is not None:
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    wall = time.perf_counter()
+    usage = resource.getrusage(scope)
+    read, written = _io_counters()
+    record = {"job_id": job_id, "stage": stage, "start_time": start}
+    record.update(extra)
+    try:
+        yield record
+    finally:
+        end_usage = resource.getrusage(scope)
+        end_read, end_written = _io_counters()
+        torch = torch or _gpu_memory()
+        record.update(
+            {
+                "wall_seconds": time.perf_counter() - wall,
+                "cpu_seconds": _cpu_seconds(end_usage) - _cpu_seconds(usage),
+                ## ru_maxrss is in kilobytes on Linux
+                "max_rss_bytes": end_usage.ru_maxrss * 1024,
+                "read_bytes": None if read is None else end_read - read,
+                "write_bytes": None if written is None else end_written - written,
+                "gpu_max_memory_bytes": (
+                    None if torch is None else torch.cuda.max_memory_allocated()
+                ),
+            }
+        )
+        _write_record(output, record)
+
+
+def run_command(stage, output, command, job_id=None):
+
+    """
+    Run a command as a profiled stage and return its exit code.
+
+    The record covers the command and all the processes it waits for, as long
+    as this process runs no other children at the same time.
+    """
+
+    with profile_stage(
+        stage, output, job_id, resource.RUSAGE_CHILDREN, command=" ".join(command)
+    ) as record:
+        record["exit_code"] = subprocess.call(command)
+    return record["exit_code"]
+
+
+def run_python(script, args, output, job_id=None, stage="predict_e2e"):
+
+    """
+    Run a Python script in this process as a profiled stage.
+
+    Calls of Predictor.__init__ and Predictor.predict in the script, as in
+    RoseTTAFold's predict_e2e.py, are recorded as the model_load and
+    inference stages.
+    """
+
+    script = os.path.abspath(script)
+    active = {}
+
+    def tracer(frame, event, arg):
+        code = frame.f_code
+        if code.co_filename != script or code.co_name not in PREDICTOR_STAGES:
+            return
+        if type(frame.f_locals.get("self")).__name__ != "Predictor":
+            return
+        if event == "call" and frame not in active:
+            context = profile_stage(
+                PREDICTOR_STAGES[code.co_name], output, job_id, parent=stage
+            )
+            context.__enter__()
+            active[frame] = context
+        elif event == "return" and frame in active:
+            active.pop(frame).__exit__(None, None, None)
+
+    sys.argv = [script] + list(args)
+    sys.path.insert(0, os.path.dirname(script))
+    with profile_stage(stage, output, job_id, command=" ".join(sys.argv)):
+        sys.setprofile(tracer)
+        try:
+            runpy.run_path(script, run_name="__main__")
+        finally:
+            sys.setprofile(None)
+
+
+def read_records(path):
+
+    """
+    Return the records of a profile file as a list of dicts.
+    """
+
+    with open(path) as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def summarize(records):
+
+    """
+    Return totals over the records of one job, for metrics.yaml. Records of
+    stages within another stage (with a parent) are not counted twice.
+    """
+
+    records = [record for record in records if not record.get("parent")]
+
+    def total(field):
+        return sum(record.get(field) or 0 for record in records)
+
+    return {
+        "PEAK_MEM": round(
+            max((record.get("max_rss_bytes") or 0 for record in records), default=0)
+            / 1024**3,
+            2,
+        ),
+        "CPU_SECONDS": round(total("cpu_seconds")),
+        "READ_BYTES": total("read_bytes"),
+        "WRITE_BYTES": total("write_bytes"),
+    }
+
+
+def main(argv=None):
+
+    """
+    Command line entry point, see the module docstring.
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m rfutils.profiling")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Profile a command as one stage")
+    run_parser.add_argument("--stage", required=True)
+    run_parser.add_argument("--output", required=True)
+    run_parser.add_argument("--job-id", default=None)
+    run_parser.add_argument("cmd", nargs=argparse.REMAINDER)
+
+    python_parser = commands.add_parser(
+        "python", help="Run a Python script and profile its stages"
+    )
+    python_parser.add_argument("--stage", default="predict_e2e")
+    python_parser.add_argument("--output", required=True)
+    python_parser.add_argument("--job-id", default=None)
+    python_parser.add_argument("cmd", nargs=argparse.REMAINDER)
+
+    summary_parser = commands.add_parser(
+        "summary", help="Print profile totals as metrics.yaml lines"
+    )
+    summary_parser.add_argument("profile")
+    summary_parser.add_argument("--indent", type=int, default=0)
+
+    args = parser.parse_args(argv)
+    if args.command == "summary":
+        for key, value in summarize(read_records(args.profile)).items():
+            print(" " * args.indent + f"{key}: {value}")
+        return 0
+
+    command = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    if not command:
+        parser.error("no command given")
+    if args.command == "run":
+        return run_command(args.stage, args.output, command, args.job_id)
+    run_python(command[0], command[1:], args.output, args.job_id, args.stage)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
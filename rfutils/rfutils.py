@@ -4,29 +4,64 @@ Helper functions for the AWS-RoseTTAFold notebook.
 
 ## Load dependencies
 from Bio import SeqIO
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import json
+import io
 import matplotlib.pyplot as plt
 from matplotlib import colors
-import numpy as np
-import os
 import pandas as pd
 import py3Dmol
 import yaml
 from re import sub
-import sagemaker
-import string
 from string import ascii_uppercase, ascii_lowercase
-from time import sleep
+from time import perf_counter, sleep
 import uuid
 
-# Get service clients
-session = boto3.session.Session()
-sm_session = sagemaker.session.Session()
-region = session.region_name
-role = sagemaker.get_execution_role()
-s3 = boto3.client("s3", region_name=region)
+from .cache import (
+    DATA_PREP_CACHE_PREFIX,
+    get_data_prep_cache_key,
+    get_local_cache,
+    lookup_data_prep_cache,
+    normalize_sequence,
+    restore_data_prep_cache,
+)
+from .clients import (
+    get_client,
+    get_default_bucket,
+    get_execution_role,
+    get_region,
+    get_sagemaker_session,
+    get_session,
+)
+from .executors import BatchExecutor, get_executor
+from .jobs import JobTracker, iter_recent_jobs
+from .metrics import METRICS_STORE_DIR, MetricsStore, harvest_metrics
+from .msa import coverage_image, parse_a3m
+from .predictions import open_prediction_npz
+from .profiling import read_records
+from .sizing import ResourceRecommender
+from .structure import Structure, read_pdb
+
+## Service clients are created on first use, see rfutils.clients
+_lazy_globals = {
+    "session": get_session,
+    "sm_session": get_sagemaker_session,
+    "region": get_region,
+    "role": get_execution_role,
+    "s3": lambda: get_client("s3"),
+}
+
+
+def __getattr__(name):
+
+    """
+    Resolve the legacy module-level session and client names on first access.
+    """
+
+    if name in _lazy_globals:
+        return _lazy_globals[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 pymol_color_list = [
     "#33ff33",
@@ -76,6 +111,9 @@ alphabet_list = list(ascii_uppercase + ascii_lowercase)
 
 aatypes = set("ACDEFGHIKLMNPQRSTVWY")
 
+## AWS Batch array jobs have at most 10,000 children
+MAX_ARRAY_SIZE = 10000
+
 
 def create_job_name(suffix=None):
 
@@ -92,28 +130,34 @@ def create_job_name(suffix=None):
         return datetime.utcnow().strftime("%Y%m%dT%H%M%S") + "_" + suffix
 
 
-def display_msa(jobId, bucket):
+def display_msa(jobId, bucket, job_name=None):
     """
-    Display the MSA plot in a Jupyter notebook cell
+    Display the MSA plot in a Jupyter notebook cell.
+    jobId is None when submit_2_step_job restored the data prep results from
+    the cache; the MSA is then read from the folder of job_name.
     """
 
-    info = get_batch_job_info(jobId)
-
-    if info["status"] == "SUCCEEDED":
-        print(
-            f"Downloading MSA file from s3://{bucket}/{info['jobName']}/{info['jobName']}.msa0.a3m"
-        )
-        s3.download_file(
-            bucket,
-            f"{info['jobName']}/{info['jobName']}.msa0.a3m",
-            "data/alignment.msa",
-        )
-        msa_all = parse_a3m("data/alignment.msa")
-        plot_msa_info(msa_all)
-    else:
-        print(
-            f"Data prep job {info['jobId']} is in {info['status']} status. Please try again once the job has completed."
-        )
+    if jobId is not None:
+        info = get_batch_job_info(jobId)
+        if info["status"] != "SUCCEEDED":
+            print(
+                f"Data prep job {info['jobId']} is in {info['status']} status. Please try again once the job has completed."
+            )
+            return
+        job_name = info["jobName"]
+    elif job_name is None:
+        raise ValueError("job_name is required for data prep results from the cache")
+
+    key = f"{job_name}/{job_name}.msa0.a3m"
+    print(f"Downloading MSA file from s3://{bucket}/{key}")
+    s3 = get_client("s3")
+    try:
+        msa_path = get_local_cache().get(bucket, key, client=s3)
+    except s3.exceptions.ClientError:
+        ## Jobs submitted with compress_a3m store the MSA gzipped
+        msa_path = get_local_cache().get(bucket, f"{key}.gz", client=s3)
+    msa_all = parse_a3m(msa_path)
+    plot_msa_info(msa_all)
 
 
 def display_structure(
@@ -138,11 +182,11 @@ def display_structure(
         print(
             f"Downloading PDB file from s3://{bucket}/{info['jobName']}/{info['jobName']}.e2e.pdb"
         )
-        s3.download_file(
-            bucket, f"{info['jobName']}/{info['jobName']}.e2e.pdb", "data/e2e.pdb"
+        pdb_path = get_local_cache().get(
+            bucket, f"{info['jobName']}/{info['jobName']}.e2e.pdb"
         )
         plot_pdb(
-            "data/e2e.pdb",
+            pdb_path,
             show_sidechains=show_sidechains,
             show_mainchains=show_mainchains,
             color=color,
@@ -158,46 +202,55 @@ def display_structure(
         )
 
 
-def get_batch_job_info(jobId):
+def format_batch_job_info(job):
 
     """
-    Retrieve and format information about a batch job.
+    Format a describe_jobs entry the way get_batch_job_info returns it.
     """
 
-    client = boto3.client("batch")
-    job_description = client.describe_jobs(jobs=[jobId])
-
     output = {
-        "jobArn": job_description["jobs"][0]["jobArn"],
-        "jobName": job_description["jobs"][0]["jobName"],
-        "jobId": job_description["jobs"][0]["jobId"],
-        "status": job_description["jobs"][0]["status"],
-        "createdAt": datetime.utcfromtimestamp(
-            job_description["jobs"][0]["createdAt"] / 1000
-        ).strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "dependsOn": job_description["jobs"][0]["dependsOn"],
-        "tags": job_description["jobs"][0]["tags"],
+        "jobArn": job["jobArn"],
+        "jobName": job["jobName"],
+        "jobId": job["jobId"],
+        "status": job["status"],
+        "createdAt": datetime.utcfromtimestamp(job["createdAt"] / 1000).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        ),
+        "dependsOn": job["dependsOn"],
+        "tags": job["tags"],
     }
 
+    ## Array parent jobs have no log stream of their own
     if output["status"] in ["STARTING", "RUNNING", "SUCCEEDED", "FAILED"]:
-        output["logStreamName"] = job_description["jobs"][0]["container"][
-            "logStreamName"
-        ]
+        if "logStreamName" in job.get("container", {}):
+            output["logStreamName"] = job["container"]["logStreamName"]
     return output
 
 
+def get_batch_job_info(jobId):
+
+    """
+    Retrieve and format information about a batch job. A jobId of None, as
+    returned by submit_2_step_job for data prep results restored from the
+    cache, gives a SUCCEEDED record without a job or log stream.
+    """
+
+    if jobId is None:
+        return {"jobId": None, "status": "SUCCEEDED", "cached": True}
+    return format_batch_job_info(JobTracker([jobId]).describe()[jobId])
+
+
 def get_batch_logs(logStreamName):
 
     """
-    Retrieve and format logs for batch job.
+    Retrieve and format the latest page of logs for a batch job. Use
+    rfutils.logs to stream or tail complete logs.
     """
 
-    client = boto3.client("logs")
+    executor = get_executor()
     try:
-        response = client.get_log_events(
-            logGroupName="/aws/batch/job", logStreamName=logStreamName
-        )
-    except client.meta.client.exceptions.ResourceNotFoundException:
+        response = executor.get_log_events(logStreamName=logStreamName)
+    except executor.exceptions.ResourceNotFoundException:
         return f"Log stream {logStreamName} does not exist. Please try again in a few minutes"
 
     logs = pd.DataFrame.from_dict(response["events"])
@@ -217,13 +270,12 @@ def get_rf_job_info(
     """
     from datetime import datetime
 
-    batch_client = boto3.client("batch")
     recent_jobs = list_recent_jobs([cpu_queue, gpu_queue], hrs_in_past)
     recent_job_df = pd.DataFrame.from_dict(recent_jobs)
     list_of_lists = []
     if len(recent_job_df) > 0:
-        detail_list = batch_client.describe_jobs(jobs=recent_job_df.jobId.to_list())
-        for job in detail_list["jobs"]:
+        detail_list = JobTracker(recent_job_df.jobId).describe()
+        for job in detail_list.values():
             resource_dict = {}
             for resource in job["container"]["resourceRequirements"]:
                 resource_dict[resource["type"]] = resource["value"]
@@ -284,13 +336,9 @@ def get_rf_job_metrics(job_name, bucket, region="us-east-1"):
     Retrieve RF job metrics from the metrics.yaml file
     """
 
-    s3.download_file(
-        bucket,
-        f"{job_name}/metrics.yaml",
-        "data/metrics.yaml",
-    )
+    metrics_path = get_local_cache().get(bucket, f"{job_name}/metrics.yaml")
 
-    with open("data/metrics.yaml", "r") as stream:
+    with open(metrics_path, "r") as stream:
         try:
             metrics = yaml.safe_load(stream)
         except yaml.YAMLError as exc:
@@ -299,18 +347,174 @@ def get_rf_job_metrics(job_name, bucket, region="us-east-1"):
     return metrics
 
 
+def harvest_rf_job_metrics(
+    bucket=None, store_path=METRICS_STORE_DIR, prefix="", max_workers=32
+):
+
+    """
+    Collect the metrics of all RF jobs in a bucket into a local Parquet store.
+    Only new or updated metrics.yaml files are downloaded. Returns all
+    harvested metrics as a DataFrame.
+    """
+
+    store = MetricsStore(store_path)
+    count = harvest_metrics(
+        bucket or get_default_bucket(), store, prefix, max_workers=max_workers
+    )
+    print(f"Harvested {count} new or updated metrics files into {store_path}")
+    return store.read()
+
+
+def fit_resource_recommender(store_path=METRICS_STORE_DIR):
+
+    """
+    Fit a ResourceRecommender to the metrics harvested into store_path,
+    for use with submit_2_step_job(recommender=...).
+    """
+
+    return ResourceRecommender().fit(MetricsStore(store_path).read())
+
+
+def profile_dataframe(records):
+
+    """
+    Build a DataFrame from profile records (see rfutils.profiling), with the
+    start and end of every stage in seconds since the first one started.
+    """
+
+    df = pd.DataFrame.from_records(records)
+    if len(df) == 0:
+        return df
+    if "parent" not in df:
+        df["parent"] = None
+    df["start"] = df["start_time"] - df["start_time"].min()
+    df["end"] = df["start"] + df["wall_seconds"]
+    df["max_rss_gb"] = df["max_rss_bytes"] / 1024**3
+    return df.sort_values("start", ignore_index=True)
+
+
+def get_rf_job_profile(job_name, bucket):
+
+    """
+    Retrieve the per-stage profile of an RF job as a DataFrame, with the
+    stages of the data prep and predict steps that have finished.
+    """
+
+    s3 = get_client("s3")
+    records = []
+    for step in ["data_prep", "predict"]:
+        key = f"{job_name}/{job_name}.{step}.profile.jsonl"
+        try:
+            path = get_local_cache().get(bucket, key, client=s3)
+        except s3.exceptions.ClientError:
+            continue
+        records += [dict(record, step=step) for record in read_records(path)]
+    return profile_dataframe(records)
+
+
+def stage_breakdown(profile):
+
+    """
+    Summarize a job profile by stage: total wall and CPU seconds, peak memory
+    and the share of the wall time of the stage's parent (or of the job, for
+    top-level stages). Stages are listed in the order they first ran.
+    """
+
+    profile = profile.assign(parent=profile["parent"].fillna(""))
+    df = profile.groupby(["parent", "stage"], sort=False).agg(
+        start=("start", "min"),
+        wall_seconds=("wall_seconds", "sum"),
+        cpu_seconds=("cpu_seconds", "sum"),
+        max_rss_gb=("max_rss_gb", "max"),
+    )
+    df = df.reset_index()
+    parent_seconds = df.groupby("stage")["wall_seconds"].sum()
+    total = df.loc[df["parent"] == "", "wall_seconds"].sum()
+    df["fraction"] = df["wall_seconds"] / df["parent"].map(parent_seconds).fillna(
+        total
+    )
+    return df.sort_values("start", ignore_index=True).drop(columns="start")
+
+
+def plot_stage_profile(profile):
+
+    """
+    Plot a job profile as a flame chart: one bar per stage over time, with
+    nested stages (like model_load and inference) below their parent.
+    """
+
+    depth = profile["parent"].notna().astype(int)
+    stages = list(dict.fromkeys(profile["stage"]))
+    cmap = plt.get_cmap("tab20")
+    fig, ax = plt.subplots(figsize=(12, 1 + depth.max()), dpi=100)
+    for (_, row), level in zip(profile.iterrows(), depth):
+        ax.barh(
+            -level,
+            row["wall_seconds"],
+            left=row["start"],
+            height=0.9,
+            color=cmap(stages.index(row["stage"]) % 20),
+            edgecolor="white",
+            label=row["stage"],
+        )
+        if row["wall_seconds"] > 0.05 * profile["end"].max():
+            ax.text(
+                row["start"] + row["wall_seconds"] / 2,
+                -level,
+                row["stage"],
+                ha="center",
+                va="center",
+                fontsize=8,
+            )
+    handles, labels = ax.get_legend_handles_labels()
+    unique = dict(zip(labels, handles))
+    ax.legend(
+        unique.values(),
+        unique.keys(),
+        bbox_to_anchor=(1.01, 1),
+        loc="upper left",
+        fontsize=8,
+    )
+    ax.set_yticks([])
+    ax.set_xlabel("Seconds since job start")
+    plt.tight_layout()
+    plt.show()
+
+
+def get_rf_prediction_npz(job_name, bucket, download=True):
+
+    """
+    Open the distance and orientation distributions of a RoseTTAFold prediction.
+    Returns a LazyNpz, see rfutils.predictions for the derived products.
+    """
+
+    return open_prediction_npz(
+        bucket, f"{job_name}/{job_name}.e2e.npz", download=download
+    )
+
+
 def get_rosettafold_batch_resources(region="us-east-1"):
     """
     Retrieve a list of batch job definitions and queues created as part of an
     AWS-RoseTTAFold stack.
     """
-    batch = boto3.client("batch", region_name=region)
+    batch = get_client("batch", region)
 
-    job_definition_response = batch.describe_job_definitions()
-    list_of_lists = []
+    job_definitions = [
+        jd
+        for page in batch.get_paginator("describe_job_definitions").paginate(
+            status="ACTIVE"
+        )
+        for jd in page["jobDefinitions"]
+    ]
+    job_queues = [
+        jq
+        for page in batch.get_paginator("describe_job_queues").paginate()
+        for jq in page["jobQueues"]
+    ]
 
     job_list = []
-    for jd in job_definition_response["jobDefinitions"]:
+    for jd in job_definitions:
         if jd["status"] == "ACTIVE" and "aws-rosettafold" in jd["jobDefinitionName"]:
             name_split = jd["jobDefinitionName"].split("-")
             entry = {
@@ -325,9 +529,7 @@ def get_rosettafold_batch_resources(region="us-east-1"):
             ]
             job_list.append(row)
 
-    job_queue_response = batch.describe_job_queues()
-    jq_list = []
-    for jq in job_queue_response["jobQueues"]:
+    for jq in job_queues:
         if (
             jq["state"] == "ENABLED"
             and jq["status"] == "VALID"
@@ -362,115 +564,50 @@ def list_recent_jobs(job_queues, hrs_in_past=1):
     Display recently-submitted jobs.
     """
 
-    batch_client = boto3.client("batch")
-    result = []
-    for queue in job_queues:
-        recent_queue_jobs = batch_client.list_jobs(
-            jobQueue=queue,
-            filters=[
-                {
-                    "name": "AFTER_CREATED_AT",
-                    "values": [
-                        str(round(datetime.now().timestamp()) - (hrs_in_past * 3600))
-                    ],
-                }
-            ],
-        )
-        result = result + recent_queue_jobs["jobSummaryList"]
-
-    return result
-
-
-def parse_a3m(filename):
-
-    """
-    Read A3M and convert letters into integers in the 0..20 range,
-    Copied from https://github.com/RosettaCommons/RoseTTAFold/blob/main/network/parsers.py
-    """
-
-    msa = []
-    table = str.maketrans(dict.fromkeys(string.ascii_lowercase))
-    # read file line by line
-    for line in open(filename, "r"):
-        # skip labels
-        if line[0] == ">":
-            continue
-        # remove right whitespaces
-        line = line.rstrip()
-        # remove lowercase letters and append to MSA
-        msa.append(line.translate(table))
-    # convert letters into numbers
-    alphabet = np.array(list("ARNDCQEGHILKMFPSTWYV-"), dtype="|S1").view(np.uint8)
-    msa = np.array([list(s) for s in msa], dtype="|S1").view(np.uint8)
-    for i in range(alphabet.shape[0]):
-        msa[msa == alphabet[i]] = i
-    # treat all unknown characters as gaps
-    msa[msa > 20] = 20
-    return msa
+    return list(iter_recent_jobs(job_queues, hrs_in_past=hrs_in_past))
 
 
 def read_pdb_renum(pdb_filename, Ls=None):
 
     """
-    Process pdb file.
-    Copied from https://github.com/sokrypton/ColabFold/blob/main/beta/colabfold.py
+    Process pdb file: number residues consecutively and, with Ls, assign them
+    to chains of those lengths. pdb_filename can also be a Structure.
+    Based on https://github.com/sokrypton/ColabFold/blob/main/beta/colabfold.py
     """
 
-    if Ls is not None:
-        L_init = 0
-        new_chain = {}
-        for L, c in zip(Ls, alphabet_list):
-            new_chain.update({i: c for i in range(L_init, L_init + L)})
-            L_init += L
-    n, pdb_out = 1, []
-    resnum_, chain_ = 1, "A"
-    for line in open(pdb_filename, "r"):
-        if line[:4] == "ATOM":
-            chain = line[21:22]
-            resnum = int(line[22 : 22 + 5])
-            if resnum != resnum_ or chain != chain_:
-                resnum_, chain_ = resnum, chain
-                n += 1
-            if Ls is None:
-                pdb_out.append("%s%4i%s" % (line[:22], n, line[26:]))
-            else:
-                pdb_out.append(
-                    "%s%s%4i%s" % (line[:21], new_chain[n - 1], n, line[26:])
-                )
-    return "".join(pdb_out)
+    if not isinstance(pdb_filename, Structure):
+        pdb_filename = read_pdb(pdb_filename)
+    return pdb_filename.renumber(Ls=Ls).to_pdb()
 
 
-def plot_msa_info(msa):
+def plot_msa_info(msa, max_rows=1000):
 
     """
     Plot a representation of the MSA coverage.
-    Copied from https://github.com/sokrypton/ColabFold/blob/main/beta/colabfold.py
+    Distinct sequences are binned into at most max_rows image rows, so memory
+    use does not depend on the depth of the MSA.
+    Based on https://github.com/sokrypton/ColabFold/blob/main/beta/colabfold.py
     """
 
-    msa_arr = np.unique(msa, axis=0)
-    total_msa_size = len(msa_arr)
+    image, coverage, total_msa_size = coverage_image(msa, max_rows=max_rows)
     print(f"\n{total_msa_size} Sequences Found in Total\n")
 
     if total_msa_size > 1:
         plt.figure(figsize=(8, 5), dpi=100)
         plt.title("Sequence coverage")
-        seqid = (msa[0] == msa_arr).mean(-1)
-        seqid_sort = seqid.argsort()
-        non_gaps = (msa_arr != 20).astype(float)
-        non_gaps[non_gaps == 0] = np.nan
         plt.imshow(
-            non_gaps[seqid_sort] * seqid[seqid_sort, None],
+            image,
             interpolation="nearest",
             aspect="auto",
             cmap="rainbow_r",
             vmin=0,
             vmax=1,
             origin="lower",
-            extent=(0, msa_arr.shape[1], 0, msa_arr.shape[0]),
+            extent=(0, msa.shape[1], 0, total_msa_size),
         )
-        plt.plot((msa_arr != 20).sum(0), color="black")
-        plt.xlim(0, msa_arr.shape[1])
-        plt.ylim(0, msa_arr.shape[0])
+        plt.plot(coverage, color="black")
+        plt.xlim(0, msa.shape[1])
+        plt.ylim(0, total_msa_size)
         plt.colorbar(
             label="Sequence identity to query",
         )
@@ -495,17 +632,21 @@ def plot_pdb(
 ):
 
     """
-    Create a 3D view of a pdb structure
+    Create a 3D view of a pdb structure from a file or a Structure
     Copied from https://github.com/sokrypton/ColabFold/blob/main/beta/colabfold.py
     """
 
+    structure = pred_output_path
+    if not isinstance(structure, Structure):
+        structure = read_pdb(structure)
+    structure = structure.renumber(Ls=Ls)
     if chains is None:
-        chains = 1 if Ls is None else len(Ls)
+        chains = len(structure.chain_ids)
 
     view = py3Dmol.view(
         js="https://3dmol.org/build/3Dmol.js", width=size[0], height=size[1]
     )
-    view.addModel(read_pdb_renum(pred_output_path, Ls), "pdb")
+    view.addModel(structure.to_pdb(), "pdb")
     if color == "lDDT":
         view.setStyle(
             {
@@ -522,7 +663,7 @@ def plot_pdb(
     elif color == "rainbow":
         view.setStyle({"cartoon": {"color": "spectrum"}})
     elif color == "chain":
-        for n, chain, color in zip(range(chains), alphabet_list, pymol_color_list):
+        for chain, color in zip(structure.chain_ids[:chains], pymol_color_list):
             view.setStyle({"chain": chain}, {"cartoon": {"color": color}})
     if show_sidechains:
         BB = ["C", "O", "N"]
@@ -615,9 +756,25 @@ def plot_plddt_legend(dpi=100):
     return plt
 
 
+def _array_job_args(container_overrides, array_size=None, array_offset=None):
+
+    """
+    Pass the input folder offset to the container scripts and return the
+    extra submit_job arguments for an array job.
+    """
+
+    if array_offset is not None:
+        container_overrides.setdefault("environment", []).append(
+            {"name": "ARRAY_INDEX_OFFSET", "value": str(array_offset)}
+        )
+    if array_size is None:
+        return {}
+    return {"arrayProperties": {"size": array_size}}
+
+
 def submit_2_step_job(
-    bucket=sm_session.default_bucket(),
-    job_name=uuid.uuid4(),
+    bucket=None,
+    job_name=None,
     data_prep_input_file="input.fa",
     data_prep_job_definition="AWS-RoseTTAFold-CPU",
     data_prep_queue="AWS-RoseTTAFold-CPU",
@@ -630,26 +787,114 @@ def submit_2_step_job(
     predict_gpu=True,
     db_path="/fsx/aws-rosettafold-ref-data",
     weights_path="/fsx/aws-rosettafold-ref-data",
+    use_cache=None,
+    cache_prefix=DATA_PREP_CACHE_PREFIX,
+    max_msa_depth=None,
+    recommender=None,
+    objective="cost",
+    cpu_predict_job_definition=None,
+    compress_a3m=False,
+    fused_max_length=None,
 ):
 
     """
     Submit a 2-step RoseTTAFold prediction job  to AWS Batch.
+    With use_cache, the data prep job is skipped if its results for the same
+    sequence are already in s3://bucket/cache_prefix, and otherwise adds them.
+    use_cache defaults to True on AWS Batch and to False with other
+    executors, so local runs make no S3 calls unless asked to.
+    With max_msa_depth, the predict job reduces the MSA to at most that many
+    sequences first, see rfutils.msa.filter_msa.
+    With a fitted rfutils.sizing.ResourceRecommender, the cpu, mem and GPU
+    settings are chosen from the sequence length to minimize objective ("cost"
+    or "time"). If cpu_predict_job_definition is given, the prediction may
+    run without a GPU on data_prep_queue.
+    With compress_a3m, A3M outputs are stored gzipped as *.a3m.gz.
+    Sequences of at most fused_max_length residues that are not in the cache
+    run as one fused job on predict_queue instead, see submit_rf_fused_job.
+    The same response is then returned for both steps.
+    Returns the submit_job responses of the data prep and predict jobs. If the
+    data prep results came from the cache, the data prep entry has jobId None
+    and the cacheKey instead.
     """
 
+    if use_cache is None:
+        use_cache = isinstance(get_executor(), BatchExecutor)
+    bucket = bucket or get_default_bucket()
+    job_name = job_name or str(uuid.uuid4())
+
     working_folder = f"s3://{bucket}/{job_name}"
-    batch_client = boto3.client("batch")
     output_pdb_uri = f"{working_folder}/{job_name}.e2e.pdb"
 
-    data_prep_response = submit_rf_data_prep_job(
-        bucket=bucket,
-        job_name=job_name,
-        input_file=data_prep_input_file,
-        job_definition=data_prep_job_definition,
-        job_queue=data_prep_queue,
-        cpu=data_prep_cpu,
-        mem=data_prep_mem,
-        db_path=db_path,
-    )
+    if use_cache or recommender is not None or fused_max_length:
+        fasta = get_client("s3").get_object(
+            Bucket=bucket, Key=f"{job_name}/{data_prep_input_file}"
+        )
+        fasta = fasta["Body"].read().decode()
+        length = len(normalize_sequence(fasta))
+
+    if recommender is not None:
+        resources = recommender.recommend(
+            length,
+            objective,
+            allow_cpu_predict=cpu_predict_job_definition is not None,
+        )
+        data_prep_cpu = resources["data_prep_cpu"]
+        data_prep_mem = resources["data_prep_mem"]
+        predict_cpu = resources["predict_cpu"]
+        predict_mem = resources["predict_mem"]
+        predict_gpu = resources["predict_gpu"]
+        if not predict_gpu:
+            predict_job_definition = cpu_predict_job_definition
+            predict_queue = data_prep_queue
+        print(
+            f"Recommended resources: data prep {data_prep_cpu} vCPU / {data_prep_mem} GB, "
+            f"predict {predict_cpu} vCPU / {predict_mem} GB {'with' if predict_gpu else 'without'} GPU"
+        )
+
+    cache_folder, cache_key = None, None
+    if use_cache:
+        cache_folder = f"s3://{bucket}/{cache_prefix}"
+        cache_key = get_data_prep_cache_key(fasta)
+        if not lookup_data_prep_cache(bucket, cache_key, cache_prefix):
+            cache_key = None
+
+    if cache_key:
+        restore_data_prep_cache(
+            bucket, cache_key, job_name, data_prep_input_file, cache_prefix
+        )
+        print(f"Data prep results restored from {cache_folder}/{cache_key}")
+        data_prep_response = {"jobId": None, "jobName": job_name, "cacheKey": cache_key}
+    elif fused_max_length and length <= fused_max_length:
+        response = submit_rf_fused_job(
+            bucket=bucket,
+            job_name=job_name,
+            input_file=data_prep_input_file,
+            job_definition=predict_job_definition,
+            job_queue=predict_queue,
+            cpu=max(data_prep_cpu, predict_cpu),
+            mem=max(data_prep_mem, predict_mem),
+            gpu=predict_gpu,
+            db_path=db_path,
+            weights_path=weights_path,
+            cache_folder=cache_folder,
+            max_msa_depth=max_msa_depth,
+            compress_a3m=compress_a3m,
+        )
+        return [response, response]
+    else:
+        data_prep_response = submit_rf_data_prep_job(
+            bucket=bucket,
+            job_name=job_name,
+            input_file=data_prep_input_file,
+            job_definition=data_prep_job_definition,
+            job_queue=data_prep_queue,
+            cpu=data_prep_cpu,
+            mem=data_prep_mem,
+            db_path=db_path,
+            cache_folder=cache_folder,
+            compress_a3m=compress_a3m,
+        )
 
     predict_response = submit_rf_predict_job(
         bucket=bucket,
@@ -661,79 +906,306 @@ def submit_2_step_job(
         gpu=predict_gpu,
         db_path=db_path,
         weights_path=weights_path,
-        depends_on=data_prep_response["jobId"],
+        depends_on=data_prep_response["jobId"] or "",
+        max_msa_depth=max_msa_depth,
+        compress_a3m=compress_a3m,
     )
 
+    if cache_key:
+        print(f"Predict job ID {predict_response['jobId']} submitted")
+    else:
+        print(
+            f"Data prep job ID {data_prep_response['jobId']} and predict job ID {predict_response['jobId']} submitted"
+        )
+    return [data_prep_response, predict_response]
+
+
+def submit_fasta_array_job(
+    fasta,
+    bucket=None,
+    job_name=None,
+    data_prep_job_definition="AWS-RoseTTAFold-CPU",
+    data_prep_queue="AWS-RoseTTAFold-CPU",
+    data_prep_cpu=8,
+    data_prep_mem=32,
+    predict_job_definition="AWS-RoseTTAFold-GPU",
+    predict_queue="AWS-RoseTTAFold-GPU",
+    predict_cpu=4,
+    predict_mem=16,
+    predict_gpu=True,
+    db_path="/fsx/aws-rosettafold-ref-data",
+    weights_path="/fsx/aws-rosettafold-ref-data",
+    use_cache=True,
+    cache_prefix=DATA_PREP_CACHE_PREFIX,
+    max_workers=16,
+    max_msa_depth=None,
+    compress_a3m=False,
+):
+
+    """
+    Submit every record of a multi-record FASTA file as a pair of AWS Batch array jobs.
+
+    Record i is uploaded to s3://bucket/job_name/i/input.fa and child i of the
+    predict array job waits for child i of the data prep array job. Returns a
+    manifest DataFrame, also saved as s3://bucket/job_name/manifest.csv,
+    mapping each record to its job ids and output URIs. With use_cache, the data
+    prep children reuse and fill the cache in s3://bucket/cache_prefix.
+    max_msa_depth is passed on to submit_rf_predict_job, and compress_a3m to
+    both jobs.
+    """
+
+    bucket = bucket or get_default_bucket()
+    job_name = job_name or create_job_name()
+    working_folder = f"s3://{bucket}/{job_name}"
+    msa_suffix = ".gz" if compress_a3m else ""
+
+    records = list(SeqIO.parse(fasta, "fasta"))
+    if len(records) == 0:
+        raise ValueError(f"No FASTA records found in {fasta}")
+
+    upload_fasta_records_to_s3(
+        records,
+        bucket,
+        job_names=[f"{job_name}/{i}" for i in range(len(records))],
+        max_workers=max_workers,
+    )
+
+    rows = []
+    for offset in range(0, len(records), MAX_ARRAY_SIZE):
+        size = min(MAX_ARRAY_SIZE, len(records) - offset)
+        ## Array jobs need at least two children
+        array_size = size if size > 1 else None
+        data_prep_response = submit_rf_data_prep_job(
+            bucket=bucket,
+            job_name=job_name,
+            job_definition=data_prep_job_definition,
+            job_queue=data_prep_queue,
+            cpu=data_prep_cpu,
+            mem=data_prep_mem,
+            db_path=db_path,
+            array_size=array_size,
+            array_offset=offset,
+            cache_folder=f"s3://{bucket}/{cache_prefix}" if use_cache else None,
+            compress_a3m=compress_a3m,
+        )
+        predict_response = submit_rf_predict_job(
+            bucket=bucket,
+            job_name=job_name,
+            job_definition=predict_job_definition,
+            job_queue=predict_queue,
+            cpu=predict_cpu,
+            mem=predict_mem,
+            gpu=predict_gpu,
+            db_path=db_path,
+            weights_path=weights_path,
+            depends_on=data_prep_response["jobId"],
+            array_size=array_size,
+            array_offset=offset,
+            max_msa_depth=max_msa_depth,
+            compress_a3m=compress_a3m,
+        )
+        for i in range(size):
+            folder = f"{working_folder}/{offset + i}"
+            suffix = f":{i}" if array_size else ""
+            rows.append(
+                {
+                    "index": offset + i,
+                    "id": records[offset + i].id,
+                    "length": len(records[offset + i].seq),
+                    "data_prep_job_id": data_prep_response["jobId"] + suffix,
+                    "predict_job_id": predict_response["jobId"] + suffix,
+                    "input_uri": f"{folder}/input.fa",
+                    "output_msa_uri": f"{folder}/{job_name}.msa0.a3m{msa_suffix}",
+                    "output_pdb_uri": f"{folder}/{job_name}.e2e.pdb",
+                    "metrics_uri": f"{folder}/metrics.yaml",
+                }
+            )
+
+    manifest = pd.DataFrame(rows)
+    get_client("s3").put_object(
+        Bucket=bucket,
+        Key=f"{job_name}/manifest.csv",
+        Body=manifest.to_csv(index=False).encode(),
+    )
     print(
-        f"Data prep job ID {data_prep_response['jobId']} and predict job ID {predict_response['jobId']} submitted"
+        f"Manifest for {len(manifest)} sequences saved to {working_folder}/manifest.csv"
     )
-    return [data_prep_response, predict_response]
+    return manifest
 
 
 def submit_rf_data_prep_job(
-    bucket=sm_session.default_bucket(),
-    job_name=uuid.uuid4(),
+    bucket=None,
+    job_name=None,
     input_file="input.fa",
     job_definition="AWS-RoseTTAFold-CPU",
     job_queue="AWS-RoseTTAFold-CPU",
     cpu=8,
     mem=32,
     db_path="/fsx/aws-rosettafold-ref-data",
+    array_size=None,
+    array_offset=None,
+    cache_folder=None,
+    compress_a3m=False,
 ):
 
     """
     Submit a RoseTTAFold data prep job (i.e. the first half of the e2e workflow) to AWS Batch.
+    Set array_size to submit an array job over the numbered input folders
+    written by submit_fasta_array_job, starting at folder array_offset.
+    cache_folder is the S3 URI of the data prep cache, if any.
+    With compress_a3m, the MSA is stored gzipped as *.msa0.a3m.gz.
     """
 
+    bucket = bucket or get_default_bucket()
+    job_name = job_name or str(uuid.uuid4())
+
     working_folder = f"s3://{bucket}/{job_name}"
-    batch_client = boto3.client("batch")
+    executor = get_executor()
     output_msa_uri = f"{working_folder}/{job_name}.msa0.a3m"
+    if compress_a3m:
+        output_msa_uri += ".gz"
     output_hhr_uri = f"{working_folder}/{job_name}.hhr"
     output_atab_uri = f"{working_folder}/{job_name}.atab"
 
-    response = batch_client.submit_job(
+    container_overrides = {
+        "command": [
+            "/bin/bash",
+            "run_aws_data_prep_ver.sh",
+            "-i",
+            working_folder,
+            "-n",
+            input_file,
+            "-o",
+            working_folder,
+            "-p",
+            job_name,
+            "-w",
+            "/work",
+            "-d",
+            db_path,
+            "-c",
+            str(cpu),
+            "-m",
+            str(mem),
+        ],
+        "resourceRequirements": [
+            {"value": str(cpu), "type": "VCPU"},
+            {"value": str(mem * 1000), "type": "MEMORY"},
+        ],
+    }
+    if cache_folder:
+        container_overrides["command"] += ["-r", cache_folder]
+    if compress_a3m:
+        container_overrides["command"].append("-z")
+    tags = {
+        "output_msa_uri": output_msa_uri,
+        "output_hhr_uri": output_hhr_uri,
+        "output_atab_uri": output_atab_uri,
+    }
+    array_args = _array_job_args(container_overrides, array_size, array_offset)
+    if array_args or array_offset is not None:
+        tags = {"output_folder": working_folder}
+
+    response = executor.submit_job(
         jobDefinition=job_definition,
         jobName=str(job_name),
         jobQueue=job_queue,
-        containerOverrides={
-            "command": [
-                "/bin/bash",
-                "run_aws_data_prep_ver.sh",
-                "-i",
-                working_folder,
-                "-n",
-                input_file,
-                "-o",
-                working_folder,
-                "-p",
-                job_name,
-                "-w",
-                "/work",
-                "-d",
-                db_path,
-                "-c",
-                str(cpu),
-                "-m",
-                str(mem),
-            ],
-            "resourceRequirements": [
-                {"value": str(cpu), "type": "VCPU"},
-                {"value": str(mem * 1000), "type": "MEMORY"},
-            ],
-        },
-        tags={
-            "output_msa_uri": output_msa_uri,
-            "output_hhr_uri": output_hhr_uri,
-            "output_atab_uri": output_atab_uri,
-        },
+        containerOverrides=container_overrides,
+        tags=tags,
+        **array_args,
     )
     print(f"Job ID {response['jobId']} submitted")
     return response
 
 
+def submit_rf_fused_job(
+    bucket=None,
+    job_name=None,
+    input_file="input.fa",
+    job_definition="AWS-RoseTTAFold-GPU",
+    job_queue="AWS-RoseTTAFold-GPU",
+    cpu=8,
+    mem=32,
+    gpu=True,
+    db_path="/fsx/aws-rosettafold-ref-data",
+    weights_path="/fsx/aws-rosettafold-ref-data",
+    cache_folder=None,
+    max_msa_depth=None,
+    compress_a3m=False,
+):
+
+    """
+    Submit the data prep and prediction steps of the e2e workflow as a single AWS Batch job.
+    The prediction uses the data prep results in the container's working
+    folder, which saves the start of a second job and the transfer of the
+    intermediate files for short sequences. Outputs and metrics.yaml are the
+    same as with submit_rf_data_prep_job and submit_rf_predict_job.
+    """
+
+    bucket = bucket or get_default_bucket()
+    job_name = job_name or str(uuid.uuid4())
+
+    working_folder = f"s3://{bucket}/{job_name}"
+    executor = get_executor()
+    output_msa_uri = f"{working_folder}/{job_name}.msa0.a3m"
+    if compress_a3m:
+        output_msa_uri += ".gz"
+    output_pdb_uri = f"{working_folder}/{job_name}.e2e.pdb"
+
+    container_overrides = {
+        "command": [
+            "/bin/bash",
+            "run_aws_e2e_ver.sh",
+            "-i",
+            working_folder,
+            "-n",
+            input_file,
+            "-o",
+            working_folder,
+            "-p",
+            job_name,
+            "-w",
+            "/work",
+            "-d",
+            db_path,
+            "-x",
+            weights_path,
+            "-c",
+            str(cpu),
+            "-m",
+            str(mem),
+        ],
+        "resourceRequirements": [
+            {"value": str(cpu), "type": "VCPU"},
+            {"value": str(mem * 1000), "type": "MEMORY"},
+        ],
+    }
+
+    if gpu:
+        container_overrides["resourceRequirements"].append(
+            {"value": "1", "type": "GPU"}
+        )
+    if cache_folder:
+        container_overrides["command"] += ["-r", cache_folder]
+    if max_msa_depth:
+        container_overrides["command"].extend(["-s", str(max_msa_depth)])
+    if compress_a3m:
+        container_overrides["command"].append("-z")
+
+    response = executor.submit_job(
+        jobDefinition=job_definition,
+        jobName=str(job_name),
+        jobQueue=job_queue,
+        containerOverrides=container_overrides,
+        tags={"output_msa_uri": output_msa_uri, "output_pdb_uri": output_pdb_uri},
+    )
+    print(f"Fused job ID {response['jobId']} submitted")
+    return response
+
+
 def submit_rf_predict_job(
-    bucket=sm_session.default_bucket(),
-    job_name=uuid.uuid4(),
+    bucket=None,
+    job_name=None,
     job_definition="AWS-RoseTTAFold-GPU",
     job_queue="AWS-RoseTTAFold-GPU",
     cpu=4,
@@ -742,14 +1214,25 @@ def submit_rf_predict_job(
     db_path="/fsx/aws-rosettafold-ref-data",
     weights_path="/fsx/aws-rosettafold-ref-data",
     depends_on="",
+    array_size=None,
+    array_offset=None,
+    max_msa_depth=None,
+    compress_a3m=False,
 ):
 
     """
     Submit a RoseTTAFold prediction job (i.e. the second half of the e2e workflow) to AWS Batch.
+    With array_size set, each child depends on the data prep child with the same index.
+    With max_msa_depth set, the MSA is reduced to at most that many sequences
+    before prediction. With compress_a3m, gzipped A3M inputs are used if
+    present and A3M outputs are stored gzipped.
     """
 
+    bucket = bucket or get_default_bucket()
+    job_name = job_name or str(uuid.uuid4())
+
     working_folder = f"s3://{bucket}/{job_name}"
-    batch_client = boto3.client("batch")
+    executor = get_executor()
     output_pdb_uri = f"{working_folder}/{job_name}.e2e.pdb"
 
     container_overrides = {
@@ -784,33 +1267,114 @@ def submit_rf_predict_job(
             {"value": "1", "type": "GPU"}
         )
 
-    response = batch_client.submit_job(
+    if max_msa_depth:
+        container_overrides["command"].extend(["-s", str(max_msa_depth)])
+
+    if compress_a3m:
+        container_overrides["command"].append("-z")
+
+    tags = {"output_pdb_uri": output_pdb_uri}
+    dependency_type = "SEQUENTIAL"
+    submit_args = _array_job_args(container_overrides, array_size, array_offset)
+    if submit_args or array_offset is not None:
+        tags = {"output_folder": working_folder}
+    if submit_args:
+        dependency_type = "N_TO_N"
+
+    if depends_on:
+        submit_args["dependsOn"] = [{"jobId": depends_on, "type": dependency_type}]
+
+    response = executor.submit_job(
         jobDefinition=job_definition,
         jobName=str(job_name),
         jobQueue=job_queue,
-        dependsOn=[{"jobId": depends_on, "type": "SEQUENTIAL"}],
         containerOverrides=container_overrides,
-        tags={"output_pdb_uri": output_pdb_uri},
+        tags=tags,
+        **submit_args,
     )
     print(f"Job ID {response['jobId']} submitted")
     return response
 
 
-def upload_fasta_to_s3(
-    record, bucket=sm_session.default_bucket(), job_name=uuid.uuid4()
+def _fasta_bytes(record):
+
+    """
+    Serialize one or more SeqRecords to FASTA in memory.
+    """
+
+    buffer = io.StringIO()
+    SeqIO.write(record, buffer, "fasta")
+    return buffer.getvalue().encode()
+
+
+def _fasta_transfer_config():
+
+    """
+    Transfer settings for small FASTA files. Concurrency comes from uploading
+    many files at once, so each transfer runs in its calling thread.
+    """
+
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(use_threads=False)
+
+
+def upload_fasta_records_to_s3(
+    records, bucket=None, job_names=None, max_workers=16, transfer_config=None
 ):
 
     """
-    Create a fasta file and upload it to S3.
+    Upload many SeqRecords to S3 as separate fasta files, concurrently.
+
+    Record i is uploaded to s3://bucket/job_names[i]/input.fa. Job names
+    default to create_job_name(record.id). Returns the S3 URIs in the order
+    of the records and prints the upload throughput.
+    """
+
+    records = list(records)
+    bucket = bucket or get_default_bucket()
+    if job_names is None:
+        job_names = [create_job_name(record.id) for record in records]
+    transfer_config = transfer_config or _fasta_transfer_config()
+    s3 = get_client("s3")
+
+    def upload(i):
+        body = _fasta_bytes(records[i])
+        object_name = f"{job_names[i]}/input.fa"
+        s3.upload_fileobj(io.BytesIO(body), bucket, object_name, Config=transfer_config)
+        return f"s3://{bucket}/{object_name}", len(body)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(upload, range(len(records))))
+    duration = max(perf_counter() - start, 1e-9)
+
+    total_bytes = sum(size for _, size in results)
+    print(
+        f"{len(results)} sequence files ({total_bytes / 1e6:.2f} MB) uploaded to "
+        f"s3://{bucket} in {duration:.1f} sec ({len(results) / duration:.1f} "
+        f"files/sec, {total_bytes / 1e6 / duration:.2f} MB/sec)"
+    )
+    return [uri for uri, _ in results]
+
+
+def upload_fasta_to_s3(record, bucket=None, job_name=None, transfer_config=None):
+
+    """
+    Create a fasta file in memory and upload it to S3.
     """
 
-    s3 = boto3.client("s3", region_name=region)
-    file_out = "_tmp.fasta"
-    with open(file_out, "w") as f_out:
-        SeqIO.write(record, f_out, "fasta")
+    bucket = bucket or get_default_bucket()
+    job_name = job_name or str(uuid.uuid4())
+
+    s3 = get_client("s3")
     object_name = f"{job_name}/input.fa"
-    response = s3.upload_file(file_out, bucket, object_name)
-    os.remove(file_out)
+    s3.upload_fileobj(
+        io.BytesIO(_fasta_bytes(record)),
+        bucket,
+        object_name,
+        Config=transfer_config or _fasta_transfer_config(),
+    )
     s3_uri = f"s3://{bucket}/{object_name}"
     print(f"Sequence file uploaded to {s3_uri}")
     return s3_uri
@@ -822,18 +1386,17 @@ def wait_for_job_start(jobId, pause=30):
     Pause while a job transitions into a running state.
     """
 
-    status = get_batch_job_info(jobId)["status"]
+    if jobId is None:
+        print("No job to wait for, the results were restored from the cache")
+        return
+    tracker = JobTracker([jobId])
+    tracker.poll()
+    status = tracker.status(jobId)
     print(status)
-    while get_batch_job_info(jobId)["status"] in [
-        "SUBMITTED",
-        "PENDING",
-        "RUNNABLE",
-        "STARTING",
-    ]:
-        sleep(30)
-        new_status = get_batch_job_info(jobId)["status"]
-        if new_status != status:
-            print("\n" + new_status)
+    while status in ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING"]:
+        sleep(pause)
+        if tracker.poll():
+            status = tracker.status(jobId)
+            print("\n" + status)
         else:
             print(".", end="")
-        status = new_status
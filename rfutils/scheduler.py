@@ -0,0 +1,331 @@
+"""
+Client-side admission control for large batches of AWS-RoseTTAFold jobs.
+
+Data prep jobs search the sequence databases on the shared FSx for Lustre
+file system, so submitting hundreds at once saturates it and slows every job
+down, while the GPU queue waits on their dependencies. AdmissionController
+keeps a backlog of sequences and submits them (with submit_2_step_job) only
+as fast as needed to keep a target number of predict jobs ready for the GPU,
+with at most a fixed or throughput-tuned number of data prep jobs running.
+"""
+
+## Load dependencies
+import heapq
+import pandas as pd
+from time import sleep, time
+
+from .jobs import JobTracker, TERMINAL_STATUSES
+
+## Predict jobs in these states are ready to use a GPU
+READY_STATUSES = ["RUNNABLE", "STARTING"]
+
+
+class ThroughputLimit:
+
+    """
+    Concurrency limit for data prep jobs, tuned from observed throughput.
+
+    Completed jobs are counted by their estimated work (e.g. seconds), so
+    long and short sequences are weighed by cost. After every window of
+    completions, the throughput of the window is compared with the previous
+    one: the limit keeps moving by step in the same direction while
+    throughput improves by at least tolerance, and turns around otherwise.
+    """
+
+    def __init__(
+        self, initial=4, minimum=1, maximum=64, window=8, step=1, tolerance=0.05
+    ):
+        self.value = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.step = step
+        self.tolerance = tolerance
+        self.direction = 1
+        self.throughput = None
+        self._start = None
+        self._work = []
+
+    def __int__(self):
+        return self.value
+
+    def record(self, work, now):
+
+        """
+        Record a completed job and adjust the limit at the end of a window.
+        """
+
+        if self._start is None:
+            self._start = now
+        self._work.append(work)
+        if len(self._work) < self.window or now <= self._start:
+            return
+        throughput = sum(self._work) / (now - self._start)
+        if (
+            self.throughput is not None
+            and throughput < self.throughput * (1 + self.tolerance)
+        ):
+            self.direction = -self.direction
+        self.value += self.direction * self.step
+        self.value = min(self.maximum, max(self.minimum, self.value))
+        self.throughput = throughput
+        self._start, self._work = now, []
+
+
+class AdmissionController:
+
+    """
+    Release a backlog of 2-step jobs so that data prep keeps the GPU busy
+    without overloading the shared file system.
+
+    max_data_prep caps the number of data prep jobs in flight: a number, or
+    a ThroughputLimit (the default) to tune the cap from observed
+    throughput. New data prep jobs are only released while fewer than
+    target_ready predict jobs are ready or will be once the data prep jobs
+    in flight finish, taking the observed predict rate and data prep latency
+    into account. The backlog is ordered by estimated data prep runtime, from
+    a fitted ResourceRecommender if given and sequence length otherwise.
+
+    submit_kwargs are passed on to submit, which defaults to
+    rfutils.submit_2_step_job; use_cache=False and a bucket avoid S3 calls
+    per job. Call step() periodically, or run() to loop until all jobs
+    finished. history() returns the queue depth, throughput and GPU idle
+    time after every step.
+    """
+
+    def __init__(
+        self,
+        max_data_prep=None,
+        target_ready=2,
+        recommender=None,
+        order="shortest_first",
+        tracker=None,
+        submit=None,
+        rate_window=3600,
+        clock=time,
+        **submit_kwargs,
+    ):
+        if order not in ["shortest_first", "longest_first"]:
+            raise ValueError(f"Unknown order {order}")
+        if submit is None:
+            from .rfutils import submit_2_step_job as submit
+        self.limit = ThroughputLimit() if max_data_prep is None else max_data_prep
+        self.target_ready = target_ready
+        self.recommender = recommender
+        self.order = order
+        self.tracker = tracker or JobTracker()
+        self.submit = submit
+        self.rate_window = rate_window
+        self.clock = clock
+        self.submit_kwargs = submit_kwargs
+        self.backlog = []
+        self.jobs = {}
+        self.data_prep_done = []
+        self.predict_done = []
+        self.gpu_idle_seconds = 0.0
+        self.snapshots = []
+        self._last_step = None
+        self._first_release = None
+        self._count = 0
+
+    def estimate(self, length):
+
+        """
+        Return the estimated data prep runtime of a sequence length.
+        """
+
+        if self.recommender is not None:
+            cpu = self.submit_kwargs.get("data_prep_cpu", 8)
+            seconds = self.recommender.estimate_seconds("data_prep", length, cpu)
+            if seconds is not None:
+                return seconds
+        return float(length)
+
+    def add(self, job_name, length):
+
+        """
+        Add a job to the backlog. Its FASTA file must already be in
+        s3://bucket/job_name/input.fa, e.g. from upload_fasta_records_to_s3.
+        """
+
+        estimate = self.estimate(length)
+        key = estimate if self.order == "shortest_first" else -estimate
+        ## The counter keeps the order of jobs with the same estimate
+        heapq.heappush(self.backlog, (key, self._count, job_name, length, estimate))
+        self._count += 1
+
+    def _update(self, now):
+
+        """
+        Poll job statuses and record data prep and predict completions.
+        """
+
+        self.tracker.poll()
+        for job in self.jobs.values():
+            if job["data_prep_finished"] is None:
+                ## A fused job runs its data prep in the predict job, so it
+                ## counts as data prep in flight until that job finished
+                if job["fused"]:
+                    status = self.tracker.status(job["predict_id"])
+                elif job["data_prep_id"] is None:
+                    status = "SUCCEEDED"
+                else:
+                    status = self.tracker.status(job["data_prep_id"])
+                if status in TERMINAL_STATUSES:
+                    job["data_prep_finished"] = now
+                    if job["data_prep_id"] is not None or job["fused"]:
+                        self.data_prep_done.append(now)
+                        if isinstance(self.limit, ThroughputLimit):
+                            self.limit.record(job["estimate"], now)
+            if job["predict_finished"] is None:
+                if self.tracker.status(job["predict_id"]) in TERMINAL_STATUSES:
+                    job["predict_finished"] = now
+                    self.predict_done.append(now)
+
+    def _counts(self):
+        statuses = [
+            self.tracker.status(job["predict_id"]) for job in self.jobs.values()
+        ]
+        return {
+            "backlog": len(self.backlog),
+            "data_prep_active": sum(
+                job["data_prep_finished"] is None for job in self.jobs.values()
+            ),
+            "predict_ready": sum(status in READY_STATUSES for status in statuses),
+            "predict_running": statuses.count("RUNNING"),
+            "predict_done": sum(status in TERMINAL_STATUSES for status in statuses),
+            "failed": sum(
+                self.tracker.status(job_id) == "FAILED"
+                for job in self.jobs.values()
+                for job_id in [job["data_prep_id"], job["predict_id"]]
+                if job_id is not None
+            ),
+        }
+
+    def _rate_per_hour(self, times, now):
+        span = min(self.rate_window, now - (self._first_release or now))
+        recent = [t for t in times if t > now - self.rate_window]
+        return len(recent) / span * 3600 if span > 0 else 0.0
+
+    def _data_prep_latency(self):
+        latencies = [
+            job["data_prep_finished"] - job["released"]
+            for job in self.jobs.values()
+            if job["data_prep_finished"] is not None and job["data_prep_id"]
+        ]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def _release_count(self, counts, now):
+
+        """
+        Return how many data prep jobs to release now.
+        """
+
+        free = int(self.limit) - counts["data_prep_active"]
+        ## Little's law: the data prep jobs in flight should cover the predict
+        ## jobs the GPU will use while they run, plus the target ready jobs
+        predict_rate = self._rate_per_hour(self.predict_done, now) / 3600
+        latency = self._data_prep_latency()
+        if predict_rate > 0 and latency is not None:
+            wanted = self.target_ready + round(predict_rate * latency)
+            free = min(
+                free, wanted - counts["predict_ready"] - counts["data_prep_active"]
+            )
+        return max(0, min(free, len(self.backlog)))
+
+    def _release(self, now):
+        _, _, job_name, length, estimate = heapq.heappop(self.backlog)
+        if self._first_release is None:
+            self._first_release = now
+        data_prep, predict = self.submit(job_name=job_name, **self.submit_kwargs)
+        job = {
+            "job_name": job_name,
+            "length": length,
+            "estimate": estimate,
+            "released": now,
+            "data_prep_id": data_prep["jobId"],
+            "predict_id": predict["jobId"],
+            "data_prep_finished": None,
+            "predict_finished": None,
+            "fused": data_prep is predict,
+        }
+        if job["fused"]:
+            job["data_prep_id"] = None
+        self.tracker.add(
+            *[job_id for job_id in [job["data_prep_id"], job["predict_id"]] if job_id]
+        )
+        self.jobs[job_name] = job
+
+    def step(self):
+
+        """
+        Update job statuses, release data prep jobs and return a snapshot of
+        the queue depth, throughput and GPU idle time.
+        """
+
+        now = self.clock()
+        if self.jobs:
+            self._update(now)
+        counts = self._counts()
+
+        ## The GPU is idle while no predict job is ready or running, but work
+        ## is left
+        if self._last_step is not None and self.jobs:
+            busy = counts["predict_ready"] + counts["predict_running"]
+            left = counts["backlog"] + len(self.jobs) - counts["predict_done"]
+            if not busy and left:
+                self.gpu_idle_seconds += now - self._last_step
+        self._last_step = now
+
+        for _ in range(self._release_count(counts, now)):
+            self._release(now)
+        counts["backlog"] = len(self.backlog)
+        counts["data_prep_active"] = sum(
+            job["data_prep_finished"] is None for job in self.jobs.values()
+        )
+
+        snapshot = {"time": now, "limit": int(self.limit)}
+        snapshot.update(counts)
+        snapshot["data_prep_per_hour"] = self._rate_per_hour(self.data_prep_done, now)
+        snapshot["predict_per_hour"] = self._rate_per_hour(self.predict_done, now)
+        snapshot["gpu_idle_seconds"] = self.gpu_idle_seconds
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    @property
+    def done(self):
+        return not self.backlog and all(
+            job["predict_finished"] is not None for job in self.jobs.values()
+        )
+
+    def run(self, interval=60, verbose=True):
+
+        """
+        Step every interval seconds until all jobs finished. Returns history().
+        """
+
+        while True:
+            snapshot = self.step()
+            if verbose:
+                print(
+                    f"backlog {snapshot['backlog']}, "
+                    f"data prep {snapshot['data_prep_active']}/{snapshot['limit']}, "
+                    f"predict ready {snapshot['predict_ready']} "
+                    f"running {snapshot['predict_running']} "
+                    f"done {snapshot['predict_done']}, "
+                    f"GPU idle {snapshot['gpu_idle_seconds']:.0f} s"
+                )
+            if self.done:
+                return self.history()
+            sleep(interval)
+
+    def history(self):
+
+        """
+        Return the snapshots of all steps as a DataFrame.
+        """
+
+        df = pd.DataFrame(self.snapshots)
+        if len(df) > 0:
+            df["time"] = pd.to_datetime(df["time"], unit="s")
+        return df
@@ -0,0 +1,307 @@
+"""
+Resource right-sizing for AWS-RoseTTAFold jobs.
+
+Runtime and memory models are fitted to harvested metrics (see
+rfutils.metrics), and ResourceRecommender uses them to pick the vCPU count,
+memory and queue type of each stage for a sequence length, minimizing either
+cost or time to result.
+"""
+
+## Load dependencies
+import numpy as np
+import pandas as pd
+
+## Approximate on-demand prices in USD per hour, used only to compare options.
+## CPU jobs share "optimal" instances, so they are charged per vCPU and GB.
+PRICE_PER_VCPU_HOUR = 0.0425
+PRICE_PER_GB_HOUR = 0.0053
+## GPU jobs run on g4dn instances: (vCPUs, memory in GB, price per hour)
+GPU_INSTANCES = [
+    (4, 16, 0.526),
+    (8, 32, 0.752),
+    (16, 64, 1.204),
+    (32, 128, 2.176),
+]
+## Batch and the ECS agent reserve part of the instance memory
+INSTANCE_MEMORY_OVERHEAD_GB = 2
+
+CPU_OPTIONS = [2, 4, 8, 16, 32]
+MEMORY_OPTIONS = [4, 8, 16, 32, 64, 128, 256]
+
+## Used when there are fewer than min_samples metrics for a stage. These match
+## the settings of the CASP14 analysis notebook.
+DEFAULT_RESOURCES = {
+    "short": {
+        "data_prep_cpu": 8,
+        "data_prep_mem": 32,
+        "predict_cpu": 4,
+        "predict_mem": 16,
+        "predict_gpu": True,
+    },
+    "long": {
+        "data_prep_cpu": 8,
+        "data_prep_mem": 64,
+        "predict_cpu": 4,
+        "predict_mem": 32,
+        "predict_gpu": False,
+    },
+}
+DEFAULT_LONG_LENGTH = 400
+
+STAGES = {
+    "data_prep": {
+        "section": "DATA_PREP",
+        "duration": "TOTAL_DATA_PREP_DURATION",
+    },
+    "predict": {
+        "section": "PREDICT",
+        "duration": "TOTAL_PREDICT_DURATION",
+    },
+}
+
+
+def _runtime_features(length, cpu, gpu=None):
+    columns = [np.ones(np.shape(length)), np.log(length), np.log(cpu)]
+    if gpu is not None:
+        columns.append(np.asarray(gpu, dtype=np.float64))
+    return np.column_stack(columns)
+
+
+def _memory_features(length):
+    return np.column_stack([np.ones(np.shape(length)), np.log(length)])
+
+
+class LogLinearModel:
+
+    """
+    Least squares fit of log(y) to a design matrix, e.g. log(seconds) =
+    c0 + c1 log(length) + c2 log(cpu) + c3 gpu.
+
+    margin is the given quantile of the residuals, so predict(upper=True)
+    returns a value that the training data stays below that often.
+    """
+
+    def __init__(self, quantile=0.95):
+        self.quantile = quantile
+        self.coef = None
+        self.margin = 0.0
+
+    def fit(self, design, y):
+        log_y = np.log(np.asarray(y, dtype=np.float64))
+        self.coef, *_ = np.linalg.lstsq(design, log_y, rcond=None)
+        residuals = log_y - design @ self.coef
+        self.margin = float(max(np.quantile(residuals, self.quantile), 0.0))
+        return self
+
+    def predict(self, design, upper=False):
+        log_y = np.asarray(design) @ self.coef
+        return np.exp(log_y + (self.margin if upper else 0.0))
+
+
+def stage_training_data(metrics, stage):
+
+    """
+    Return the rows of a harvested metrics DataFrame with complete data for a
+    stage, as columns length, cpu, mem, gpu, peak_mem and seconds.
+    """
+
+    section = STAGES[stage]["section"]
+    columns = {
+        "length": "DATA_PREP_LENGTH",
+        "cpu": f"{section}_CPU",
+        "mem": f"{section}_MEM",
+        "seconds": f"{section}_{STAGES[stage]['duration']}",
+        "peak_mem": f"{section}_PEAK_MEM",
+        "gpu": f"{section}_GPU",
+    }
+    df = pd.DataFrame(
+        {
+            name: metrics[column] if column in metrics else np.nan
+            for name, column in columns.items()
+        }
+    )
+    ## The predict scripts record CUDA_VISIBLE_DEVICES, 99 when there is no GPU
+    df["gpu"] = df["gpu"].notna() & (df["gpu"].astype("string") != "99")
+    for name in ["length", "cpu", "mem", "seconds", "peak_mem"]:
+        df[name] = pd.to_numeric(df[name], errors="coerce").astype("float64")
+    ## Without a measured peak, the memory a job succeeded with is an upper bound
+    df["peak_mem"] = df["peak_mem"].fillna(df["mem"])
+    df = df.dropna(subset=["length", "cpu", "mem", "seconds"])
+    return df[(df["length"] > 0) & (df["cpu"] > 0) & (df["seconds"] > 0)]
+
+
+class ResourceRecommender:
+
+    """
+    Recommend per-sequence resources for the data prep and predict jobs.
+
+    fit() trains, for each stage, a runtime model on sequence length, vCPUs
+    and (for predict) GPU use, and a memory model on sequence length. Stages
+    with fewer than min_samples complete metrics rows use
+    DEFAULT_RESOURCES.
+    """
+
+    def __init__(
+        self,
+        cpu_options=CPU_OPTIONS,
+        memory_options=MEMORY_OPTIONS,
+        min_samples=10,
+        quantile=0.95,
+    ):
+        self.cpu_options = list(cpu_options)
+        self.memory_options = list(memory_options)
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self.runtime_models = {}
+        self.memory_models = {}
+        self.gpu_values = {}
+        self.cpu_values = {}
+
+    def fit(self, metrics):
+
+        """
+        Fit the models to a DataFrame of harvested metrics, e.g. from
+        MetricsStore.read().
+        """
+
+        for stage in STAGES:
+            df = stage_training_data(metrics, stage)
+            if len(df) < self.min_samples:
+                continue
+            ## Only model a GPU effect if the data has jobs with and without one,
+            ## and only recommend the kinds of jobs in the data
+            self.gpu_values[stage] = set(df["gpu"].tolist())
+            gpu = df["gpu"] if len(self.gpu_values[stage]) > 1 else None
+            self.cpu_values[stage] = sorted(set(df["cpu"].astype(int).tolist()))
+            self.runtime_models[stage] = LogLinearModel(self.quantile).fit(
+                _runtime_features(df["length"], df["cpu"], gpu), df["seconds"]
+            )
+            self.memory_models[stage] = LogLinearModel(self.quantile).fit(
+                _memory_features(df["length"]), df["peak_mem"]
+            )
+        return self
+
+    def _default(self, length):
+        return DEFAULT_RESOURCES[
+            "long" if length >= DEFAULT_LONG_LENGTH else "short"
+        ].copy()
+
+    def _cost(self, hours, cpu, mem, gpu):
+        if not gpu:
+            return hours * (cpu * PRICE_PER_VCPU_HOUR + mem * PRICE_PER_GB_HOUR)
+        for vcpus, memory, price in GPU_INSTANCES:
+            if cpu <= vcpus and mem <= memory - INSTANCE_MEMORY_OVERHEAD_GB:
+                return hours * price
+        return np.inf
+
+    def estimate_seconds(self, stage, length, cpu, gpu=False):
+
+        """
+        Return the estimated runtime of a stage in seconds, or None if the
+        stage has no fitted model.
+        """
+
+        if stage not in self.runtime_models:
+            return None
+        design = _runtime_features(
+            [length], [cpu], [gpu] if len(self.gpu_values[stage]) > 1 else None
+        )
+        return float(self.runtime_models[stage].predict(design)[0])
+
+    def _options(self, stage, length, gpu_options):
+
+        """
+        Yield (cpu, mem, gpu, seconds, cost) for every option of a stage.
+        Only vCPU counts within the range of the training data are tried, or
+        the counts in the data if cpu_options has none in that range.
+        """
+
+        mem_needed = self.memory_models[stage].predict(
+            _memory_features([length]), upper=True
+        )[0]
+        mem = next((m for m in self.memory_options if m >= mem_needed), None)
+        if mem is None:
+            return
+        seen = self.cpu_values[stage]
+        cpu_options = [c for c in self.cpu_options if seen[0] <= c <= seen[-1]]
+        for gpu in gpu_options:
+            for cpu in cpu_options or seen:
+                seconds = self.estimate_seconds(stage, length, cpu, gpu)
+                cost = self._cost(seconds / 3600, cpu, mem, gpu)
+                if np.isfinite(cost):
+                    yield cpu, mem, gpu, seconds, cost
+
+    def recommend(self, length, objective="cost", allow_cpu_predict=True):
+
+        """
+        Return the resources to use for a sequence length as a dict with the
+        keys of DEFAULT_RESOURCES, plus estimated seconds and cost per stage.
+
+        objective is "cost" to minimize the estimated price, or "time" to
+        minimize the estimated runtime (breaking ties by price).
+        """
+
+        if objective not in ["cost", "time"]:
+            raise ValueError(f"Unknown objective {objective}")
+        resources = self._default(length)
+        for stage in STAGES:
+            if stage not in self.runtime_models:
+                continue
+            gpu_options = [False]
+            if stage == "predict":
+                gpu_options = [True, False] if allow_cpu_predict else [True]
+            gpu_options = [g for g in gpu_options if g in self.gpu_values[stage]]
+            options = list(self._options(stage, length, gpu_options))
+            if not options:
+                continue
+            if objective == "cost":
+                best = min(options, key=lambda option: (option[4], option[3]))
+            else:
+                best = min(options, key=lambda option: (option[3], option[4]))
+            cpu, mem, gpu, seconds, cost = best
+            resources[f"{stage}_cpu"] = cpu
+            resources[f"{stage}_mem"] = mem
+            if stage == "predict":
+                resources["predict_gpu"] = gpu
+            resources[f"{stage}_seconds"] = round(float(seconds))
+            resources[f"{stage}_cost"] = round(float(cost), 4)
+        if not allow_cpu_predict:
+            resources["predict_gpu"] = True
+        return resources
+
+
+def synthetic_metrics(n=200, seed=0):
+
+    """
+    Return a DataFrame of made-up metrics, in the harvested column layout,
+    for trying out the recommender offline.
+    """
+
+    rng = np.random.default_rng(seed)
+    length = rng.integers(50, 1200, n)
+    prep_cpu = rng.choice([4, 8, 16], n)
+    predict_cpu = rng.choice([4, 8], n)
+    gpu = rng.random(n) < 0.7
+
+    def noise():
+        return np.exp(rng.normal(0, 0.15, n))
+
+    return pd.DataFrame(
+        {
+            "DATA_PREP_LENGTH": length,
+            "DATA_PREP_CPU": prep_cpu,
+            "DATA_PREP_MEM": 64,
+            "DATA_PREP_PEAK_MEM": 4 + 0.02 * length * noise(),
+            "DATA_PREP_TOTAL_DATA_PREP_DURATION": (
+                6 * length**1.1 / prep_cpu**0.6 * noise()
+            ).astype(int),
+            "PREDICT_CPU": predict_cpu,
+            "PREDICT_MEM": 32,
+            "PREDICT_PEAK_MEM": 3 + 1e-5 * length**2 * noise(),
+            "PREDICT_GPU": np.where(gpu, "0", "99"),
+            "PREDICT_TOTAL_PREDICT_DURATION": (
+                np.where(gpu, 0.02, 0.4) * length**1.6 / predict_cpu**0.3 * noise()
+            ).astype(int)
+            + 1,
+        }
+    )
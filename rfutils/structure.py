@@ -0,0 +1,290 @@
+"""
+Array-backed representation of PDB structures for AWS-RoseTTAFold.
+
+A PDB file is parsed once into a NumPy structured array with one row per
+atom. Renumbering, chain reassignment and atom selections are array
+operations on that table, and Structure.to_pdb writes it back out.
+"""
+
+## Load dependencies
+import io
+import numpy as np
+import os
+from string import ascii_uppercase, ascii_lowercase
+
+CHAIN_IDS = ascii_uppercase + ascii_lowercase
+BACKBONE_ATOMS = ["N", "CA", "C", "O"]
+
+ATOM_DTYPE = np.dtype(
+    [
+        ("record", "U6"),
+        ("serial", np.int32),
+        ("name", "U4"),
+        ("altloc", "U1"),
+        ("resname", "U3"),
+        ("chain", "U1"),
+        ("resseq", np.int32),
+        ("icode", "U1"),
+        ("xyz", np.float32, 3),
+        ("occupancy", np.float32),
+        ("bfactor", np.float32),
+        ("element", "U2"),
+    ]
+)
+
+## Fixed column ranges of the ATOM/HETATM record fields
+_PDB_COLUMNS = {
+    "record": (0, 6),
+    "serial": (6, 11),
+    "name": (12, 16),
+    "altloc": (16, 17),
+    "resname": (17, 20),
+    "chain": (21, 22),
+    "resseq": (22, 26),
+    "icode": (26, 27),
+    "x": (30, 38),
+    "y": (38, 46),
+    "z": (46, 54),
+    "occupancy": (54, 60),
+    "bfactor": (60, 66),
+    "element": (76, 78),
+}
+
+## A string is PDB text rather than a path if it has several lines or starts
+## with one of these records
+_PDB_RECORDS = ("ATOM", "HETATM", "HEADER", "MODEL", "REMARK", "CRYST1")
+
+_PDB_ATOM_FORMAT = (
+    "{:<6s}{:>5d} {:<4s}{:1s}{:>3s} {:1s}{:>4d}{:1s}   "
+    "{:>8.3f}{:>8.3f}{:>8.3f}{:>6.2f}{:>6.2f}          {:>2s}\n"
+)
+
+
+def _read_text(source):
+
+    """
+    Return the text of a PDB file path, file object, or PDB string.
+    """
+
+    if isinstance(source, str) and (
+        "\n" in source or source.startswith(_PDB_RECORDS)
+    ):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r") as handle:
+            return handle.read()
+    if isinstance(source, bytes):
+        return source.decode()
+    text = source.read()
+    return text.decode() if isinstance(text, bytes) else text
+
+
+def _column(table, field, dtype):
+    start, end = _PDB_COLUMNS[field]
+    values = np.char.strip(table[:, start:end].copy().view(f"S{end - start}")[:, 0])
+    if dtype is str:
+        return values.astype("U")
+    values[values == b""] = b"0"
+    return values.astype(dtype)
+
+
+class Structure:
+
+    """
+    Atoms of a single PDB model as a structured array (see ATOM_DTYPE).
+
+    Methods that select or relabel atoms return new Structure objects and
+    leave the original unchanged.
+    """
+
+    def __init__(self, atoms):
+        self.atoms = np.asarray(atoms, dtype=ATOM_DTYPE)
+
+    def __len__(self):
+        return len(self.atoms)
+
+    def __getitem__(self, index):
+        return Structure(self.atoms[index])
+
+    @property
+    def coords(self):
+        return self.atoms["xyz"]
+
+    @property
+    def chain_ids(self):
+        chains = self.atoms["chain"]
+        _, first = np.unique(chains, return_index=True)
+        return chains[np.sort(first)].tolist()
+
+    @property
+    def residue_starts(self):
+
+        """
+        Return a mask of the atoms that start a new residue.
+        """
+
+        atoms = self.atoms
+        starts = np.ones(len(atoms), dtype=bool)
+        starts[1:] = (
+            (atoms["chain"][1:] != atoms["chain"][:-1])
+            | (atoms["resseq"][1:] != atoms["resseq"][:-1])
+            | (atoms["icode"][1:] != atoms["icode"][:-1])
+        )
+        return starts
+
+    @property
+    def residue_index(self):
+
+        """
+        Return the 0-based position of the residue of every atom.
+        """
+
+        return np.cumsum(self.residue_starts) - 1
+
+    @property
+    def n_residues(self):
+        return int(self.residue_starts.sum())
+
+    def select(self, names=None, chains=None, resnames=None):
+
+        """
+        Return the atoms with the given atom names, chain ids, and residue names.
+        """
+
+        mask = np.ones(len(self.atoms), dtype=bool)
+        if names is not None:
+            mask &= np.isin(self.atoms["name"], names)
+        if chains is not None:
+            mask &= np.isin(self.atoms["chain"], list(chains))
+        if resnames is not None:
+            mask &= np.isin(self.atoms["resname"], resnames)
+        return self[mask]
+
+    @property
+    def ca(self):
+        return self.select(names=["CA"])
+
+    @property
+    def backbone(self):
+        return self.select(names=BACKBONE_ATOMS)
+
+    @property
+    def plddt(self):
+
+        """
+        Return the per-residue confidence stored by RoseTTAFold in the CA B-factors.
+        """
+
+        return self.ca.atoms["bfactor"]
+
+    def split_chains(self):
+
+        """
+        Return a dict of single-chain structures keyed by chain id.
+        """
+
+        return {chain: self.select(chains=[chain]) for chain in self.chain_ids}
+
+    def renumber(self, start=1, Ls=None):
+
+        """
+        Number residues consecutively from start, across all chains.
+
+        With Ls, a list of chain lengths, the residues are also reassigned to
+        chains A, B, ... in that order, e.g. to split a single-chain
+        prediction of a complex into its components.
+        """
+
+        atoms = self.atoms.copy()
+        residue_index = self.residue_index
+        atoms["resseq"] = residue_index + start
+        atoms["icode"] = ""
+        if Ls is not None:
+            if sum(Ls) < self.n_residues:
+                raise ValueError(
+                    f"Chain lengths {Ls} cover fewer than {self.n_residues} residues"
+                )
+            chains = np.repeat(np.array(list(CHAIN_IDS[: len(Ls)])), Ls)
+            atoms["chain"] = chains[residue_index]
+        return Structure(atoms)
+
+    def to_pdb(self):
+
+        """
+        Format the atoms as PDB ATOM/HETATM records.
+        """
+
+        atoms = self.atoms
+        lines = []
+        for atom in atoms.tolist():
+            record, serial, name, altloc, resname, chain, resseq, icode = atom[:8]
+            xyz, occupancy, bfactor, element = atom[8:]
+            ## Atom names start in column 14 unless they fill all four columns
+            if len(name) < 4:
+                name = " " + name
+            lines.append(
+                _PDB_ATOM_FORMAT.format(
+                    record,
+                    serial,
+                    name,
+                    altloc,
+                    resname,
+                    chain,
+                    resseq,
+                    icode,
+                    *xyz,
+                    occupancy,
+                    bfactor,
+                    element,
+                )
+            )
+        return "".join(lines)
+
+    def write_pdb(self, path):
+
+        """
+        Write the atoms to a PDB file.
+        """
+
+        with open(path, "w") as handle:
+            handle.write(self.to_pdb())
+            handle.write("END\n")
+
+
+def read_pdb(source, hetatm=False):
+
+    """
+    Parse the first model of a PDB file into a Structure.
+
+    source can be a file path, a file object, or the PDB text. Only ATOM
+    records are read unless hetatm is True. The fixed-width columns of all
+    atom records are sliced out of one byte array at once.
+    """
+
+    text = _read_text(source)
+    end = text.find("\nENDMDL")
+    if end >= 0:
+        text = text[:end]
+    records = ("ATOM", "HETATM") if hetatm else ("ATOM",)
+    lines = [
+        line.rstrip("\r\n").ljust(80)[:80]
+        for line in io.StringIO(text)
+        if line.startswith(records)
+    ]
+    atoms = np.zeros(len(lines), dtype=ATOM_DTYPE)
+    if not lines:
+        return Structure(atoms)
+
+    table = np.frombuffer(
+        "".join(lines).encode(), dtype=np.uint8
+    ).reshape(len(lines), 80)
+    for field in ["record", "name", "altloc", "resname", "chain", "icode", "element"]:
+        atoms[field] = _column(table, field, str)
+    for field in ["serial", "resseq"]:
+        atoms[field] = _column(table, field, np.int32)
+    for field in ["occupancy", "bfactor"]:
+        atoms[field] = _column(table, field, np.float32)
+    atoms["xyz"] = np.stack(
+        [_column(table, axis, np.float32) for axis in ["x", "y", "z"]], axis=1
+    )
+    return Structure(atoms)